@@ -0,0 +1,9 @@
+-- Dictionary-encoded calendar names: one byte per row instead of a string
+{% macro day_of_week_enum() -%}
+ENUM('Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat')
+{%- endmacro %}
+
+
+{% macro month_of_year_enum() -%}
+ENUM('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+{%- endmacro %}
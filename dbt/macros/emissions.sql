@@ -0,0 +1,45 @@
+-- trip_co2_kgs under var('emissions_model'), over trips t joined to vehicle_emissions ve.
+-- 'constant' and 'speed' are plain SQL (emissions_model.SQL_MODELS); other models, or
+-- any model with var('emissions_udf'), call the Arrow UDFs of scripts/emissions_model.py,
+-- registered on dbt's connection by the udf.emissions plugin (see profiles.yml)
+{% macro trip_co2_kgs() -%}
+{%- if var('emissions_udf', false) -%}
+{{ co2_kgs_udf() }}
+{%- elif var('emissions_model') == 'constant' -%}
+((t.distance * ve.co2_grams_per_mile) / 1000.0)::float
+{%- elif var('emissions_model') == 'speed' -%}
+{{ co2_kgs_speed() }}
+{%- else -%}
+{{ co2_kgs_udf() }}
+{%- endif -%}
+{%- endmacro %}
+
+
+{% macro co2_kgs_udf() -%}
+co2_kgs_{{ var('emissions_model') }}(
+    t.distance, ve.co2_grams_per_mile, ve.mpg_city, ve.mpg_highway,
+    {{ trip_avg_mph() }}
+)
+{%- endmacro %}
+
+
+-- The 'speed' model, the same arithmetic as emissions_model.speed() (keep the
+-- constants in sync): the flat rate scaled by fuel use per mile at avg_mph
+-- relative to the EPA 55/45 combined rating. Up to the city cycle speed
+-- (21.2 mph) that is city consumption, from the highway cycle speed (48.3 mph)
+-- highway consumption, and linear in between. Trips without a usable speed
+-- keep the flat rate. Piecewise rather than clamped with greatest/least, which
+-- DuckDB runs about 1.5x slower.
+{% macro co2_kgs_speed() -%}
+{%- set mph = trip_avg_mph() -%}
+{%- set combined = "(0.55 / ve.mpg_city + 0.45 / ve.mpg_highway)" -%}
+((t.distance * ve.co2_grams_per_mile * (
+    case
+    when not coalesce(isfinite({{ mph }}) and {{ mph }} > 0, false) then 1.0
+    when {{ mph }} <= 21.2 then (1.0 / ve.mpg_city) / {{ combined }}
+    when {{ mph }} >= 48.3 then (1.0 / ve.mpg_highway) / {{ combined }}
+    else (1.0 / ve.mpg_city + ({{ mph }} - 21.2) / (48.3 - 21.2) * (1.0 / ve.mpg_highway - 1.0 / ve.mpg_city))
+        / {{ combined }}
+    end
+)) / 1000.0)::float
+{%- endmacro %}
@@ -0,0 +1,24 @@
+-- Ledger partitions loaded or re-cleaned since the last build of this model
+{% macro changed_partitions() -%}
+(
+    select taxi_type, year, month
+    from {{ source('emissions', 'load_ledger') }}
+    where greatest(loaded_at, coalesce(cleaned_at, loaded_at)) > (
+        select coalesce(max(transformed_at), timestamp '1970-01-01') from {{ this }}
+    )
+)
+{%- endmacro %}
+
+
+-- Removes rows of partitions that changed (they are recomputed by this run)
+-- or that are no longer in the ledger. delete+insert alone only replaces
+-- partitions that still produce rows.
+{% macro drop_stale_partitions() -%}
+delete from {{ this }}
+where (taxi_type::varchar, source_year, source_month) not in (
+    select (taxi_type, year, month) from {{ source('emissions', 'load_ledger') }}
+)
+or (taxi_type::varchar, source_year, source_month) in (
+    select (taxi_type, year, month) from {{ changed_partitions() }}
+)
+{%- endmacro %}
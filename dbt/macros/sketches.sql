@@ -0,0 +1,4 @@
+-- Measures sketched by trip_sketches; scripts/sketches.py reads the same names
+{% macro sketch_measure_enum() -%}
+ENUM('trip_co2_kgs', 'avg_mph')
+{%- endmacro %}
@@ -0,0 +1,33 @@
+-- Derived columns of trips_transformed, over trips t joined to vehicle_emissions ve.
+-- Shared by models/trips_transformed.sql and the parallel transform in
+-- scripts/transform.py, which renders these macros itself.
+{% macro trip_avg_mph() -%}
+(t.distance / (extract(epoch from t.dropoff_datetime - t.pickup_datetime) / 3600.0))
+{%- endmacro %}
+
+
+{% macro trip_transform_columns() -%}
+    -- calculate total co2 for each trip (see macros/emissions.sql)
+    {{ trip_co2_kgs() }} as trip_co2_kgs,
+
+    -- calculate average mph
+    {{ trip_avg_mph() }}::float as avg_mph,
+
+    -- Extract hour of day
+    extract(hour from t.pickup_datetime)::utinyint as hour_of_day,
+
+    -- Extract day of week
+    strftime(t.pickup_datetime, '%a')::{{ day_of_week_enum() }} as day_of_week,
+
+    -- Extract week number
+    extract(week from t.pickup_datetime)::utinyint as week_of_year,
+
+    -- Extract month number
+    strftime(t.pickup_datetime, '%b')::{{ month_of_year_enum() }} as month_of_year,
+
+    -- Extract year(extra added step for plotting)
+    extract(year from t.pickup_datetime)::smallint as specified_year,
+
+    -- build time, the watermark for the next incremental run
+    current_timestamp::timestamp as transformed_at
+{%- endmacro %}
@@ -0,0 +1,58 @@
+-- Emissions cube answering analysis.py from a few thousand rows.
+-- One pass with GROUPING SETS builds the full (year, month, week, day, hour)
+-- grain plus one set per dimension; every set also keeps the source partition
+-- so the cube is refreshed incrementally like trips_transformed.
+{{
+    config(
+        materialized='incremental',
+        incremental_strategy='delete+insert',
+        unique_key=['taxi_type', 'source_year', 'source_month'],
+        pre_hook="{% if is_incremental() %}{{ drop_stale_partitions() }}{% endif %}"
+    )
+}}
+
+select
+    taxi_type,
+    source_year,
+    source_month,
+
+    -- which grouping set the row belongs to
+    case
+        when grouping(specified_year, month_of_year, week_of_year, day_of_week, hour_of_day) = 0 then 'detail'
+        when grouping(hour_of_day) = 0 then 'hour'
+        when grouping(day_of_week) = 0 then 'day'
+        when grouping(week_of_year) = 0 then 'week'
+        when grouping(month_of_year) = 0 then 'month'
+        else 'year'
+    end as grain,
+
+    specified_year,
+    month_of_year,
+    week_of_year,
+    day_of_week,
+    hour_of_day,
+
+    count(*) as trips,
+    sum(trip_co2_kgs) as total_co2_kgs,
+    sum(distance) as total_distance,
+    max(trip_co2_kgs) as max_trip_co2_kgs,
+
+    -- build time, the watermark for the next incremental run
+    current_timestamp::timestamp as transformed_at
+
+from {{ ref('trips_transformed') }}
+
+{% if is_incremental() %}
+where (taxi_type::varchar, source_year, source_month) in (
+    select (taxi_type, year, month) from {{ changed_partitions() }}
+)
+{% endif %}
+
+group by grouping sets (
+    (taxi_type, source_year, source_month, specified_year, month_of_year, week_of_year, day_of_week, hour_of_day),
+    (taxi_type, source_year, source_month, hour_of_day),
+    (taxi_type, source_year, source_month, day_of_week),
+    (taxi_type, source_year, source_month, week_of_year),
+    (taxi_type, source_year, source_month, month_of_year),
+    (taxi_type, source_year, source_month, specified_year)
+)
@@ -0,0 +1,58 @@
+-- Mergeable quantile sketches of trip_co2_kgs and avg_mph (see
+-- scripts/sketches.py), one per (taxi_type, source_year, source_month,
+-- hour_of_day) and measure. A sketch is a DDSketch-style histogram over
+-- logarithmic buckets: a positive value x falls into bucket ceil(ln(x) / ln(gamma))
+-- with gamma = (1 + a) / (1 - a), so every quantile read back is within a
+-- relative error a (var sketch_relative_accuracy) of a true value. Sketches
+-- merge by summing bucket counts, so any time range is answered from these
+-- rows, and only newly loaded or re-cleaned partitions are rebuilt.
+{{
+    config(
+        materialized='incremental',
+        incremental_strategy='delete+insert',
+        unique_key=['taxi_type', 'source_year', 'source_month'],
+        pre_hook="{% if is_incremental() %}{{ drop_stale_partitions() }}{% endif %}"
+    )
+}}
+
+{% set log_gamma %}ln((1 + {{ var('sketch_relative_accuracy') }}) / (1 - {{ var('sketch_relative_accuracy') }})){% endset %}
+
+with partition_trips as (
+    select taxi_type, source_year, source_month, hour_of_day, trip_co2_kgs, avg_mph
+    from {{ ref('trips_transformed') }}
+    {% if is_incremental() %}
+    where (taxi_type::varchar, source_year, source_month) in (
+        select (taxi_type, year, month) from {{ changed_partitions() }}
+    )
+    {% endif %}
+),
+
+measures as (
+    select taxi_type, source_year, source_month, hour_of_day, 'trip_co2_kgs' as measure, trip_co2_kgs as value
+    from partition_trips
+    union all
+    select taxi_type, source_year, source_month, hour_of_day, 'avg_mph' as measure, avg_mph as value
+    from partition_trips
+)
+
+select
+    taxi_type,
+    source_year,
+    source_month,
+    hour_of_day,
+    measure::{{ sketch_measure_enum() }} as measure,
+
+    -- values <= 0 share one bucket, read back as 0
+    case when value > 0 then ceil(ln(value) / {{ log_gamma }}) else -32768 end::smallint as bucket,
+    count(*)::uinteger as trips,
+    -- read back by sketches.py to map buckets to values; changing the
+    -- accuracy needs `dbt run --full-refresh`
+    {{ var('sketch_relative_accuracy') }}::double as relative_accuracy,
+
+    -- build time, the watermark for the next incremental run
+    current_timestamp::timestamp as transformed_at
+
+from measures
+-- NULL, NaN and infinite speeds (zero-duration trips) are left out
+where isfinite(value)
+group by all
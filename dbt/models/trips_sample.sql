@@ -0,0 +1,48 @@
+-- Stratified sample of trips_transformed for approximate analysis (see
+-- scripts/sampling.py). The strata are the source partitions, i.e. fleet and
+-- month; each keeps sample_rate of its trips but at least sample_min_rows,
+-- chosen by a hash of the trip so rebuilding a partition yields the same
+-- sample. Every row carries its stratum's trip count and sample size, the
+-- weights the estimators need. Refreshed per partition like trips_transformed,
+-- so a load or clean resamples only the partitions it changed.
+{{
+    config(
+        materialized='incremental',
+        incremental_strategy='delete+insert',
+        unique_key=['taxi_type', 'source_year', 'source_month'],
+        pre_hook="{% if is_incremental() %}{{ drop_stale_partitions() }}{% endif %}"
+    )
+}}
+
+with partition_trips as (
+    select * from {{ ref('trips_transformed') }}
+    {% if is_incremental() %}
+    where (taxi_type::varchar, source_year, source_month) in (
+        select (taxi_type, year, month) from {{ changed_partitions() }}
+    )
+    {% endif %}
+),
+
+strata as (
+    select taxi_type, source_year, source_month, count(*)::uinteger as stratum_rows
+    from partition_trips
+    group by taxi_type, source_year, source_month
+),
+
+sampled as (
+    select t.* exclude (transformed_at), s.stratum_rows
+    from partition_trips t
+    join strata s
+      on s.taxi_type = t.taxi_type and s.source_year = t.source_year and s.source_month = t.source_month
+    where hash(t.pickup_datetime, t.dropoff_datetime, t.distance, t.passenger_count) % 1000000
+        < greatest({{ var('sample_rate') }}, {{ var('sample_min_rows') }} / s.stratum_rows) * 1000000
+)
+
+select
+    *,
+    (count(*) over (partition by taxi_type, source_year, source_month))::uinteger as stratum_sample,
+
+    -- build time, the watermark for the next incremental run
+    current_timestamp::timestamp as transformed_at
+
+from sampled
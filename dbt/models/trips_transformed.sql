@@ -0,0 +1,31 @@
+-- Incremental on the source partition (taxi_type, source_year, source_month),
+-- the unit load.py loads and clean.py re-cleans. A run only recomputes
+-- partitions whose ledger loaded_at/cleaned_at is newer than the last build;
+-- `dbt run --full-refresh` rebuilds everything, and is needed once after a
+-- column type or the emissions_model var changes.
+{{
+    config(
+        materialized='incremental',
+        incremental_strategy='delete+insert',
+        unique_key=['taxi_type', 'source_year', 'source_month'],
+        pre_hook="{% if is_incremental() %}{{ drop_stale_partitions() }}{% endif %}"
+    )
+}}
+
+SELECT
+    t.*,
+
+    -- trip_co2_kgs, avg_mph and the calendar columns (see macros/transform.sql)
+    {{ trip_transform_columns() }}
+
+from {{ source('emissions','trips') }} t
+join {{ source('emissions','fleets') }} f
+  on f.taxi_type = t.taxi_type
+join {{ source('emissions','vehicle_emissions') }} ve
+  on ve.vehicle_type = f.vehicle_type
+
+{% if is_incremental() %}
+where (t.taxi_type::varchar, t.source_year, t.source_month) in (
+    select (taxi_type, year, month) from {{ changed_partitions() }}
+)
+{% endif %}
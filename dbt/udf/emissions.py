@@ -0,0 +1,14 @@
+from dbt.adapters.duckdb.plugins import BasePlugin
+
+# scripts/ is on the udf target's module_paths (see profiles.yml)
+from emissions_model import register
+
+
+class Plugin(BasePlugin):
+    """
+    Registers the emissions model UDFs (co2_kgs_<model>) on every connection
+    dbt opens, for the trip_co2_kgs() macro
+    """
+
+    def configure_connection(self, conn):
+        register(conn)
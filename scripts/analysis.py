@@ -1,283 +1,224 @@
-import duckdb
+import argparse
 import logging
 import matplotlib.pyplot as plt
 
+from connection import connect
+from instrumentation import timed_stage
+from query_cache import QueryCache
+from sampling import estimate_by, sample_max
+from sketches import quantiles
+from settings import DB_PATH, QUERY_CACHE_DIR, QUERY_CACHE_MAX_MB, TAXI_TYPES, YEARS, current_replica
+
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
     filename='analysis.log'
 )
 logger = logging.getLogger(__name__)
 
-def analyze_tables():
-
+# Per-fleet plot settings; fleets without an entry are plotted with the defaults
+PLOTS = {
+    'yellow': {'color': '#FDB813', 'title': 'Carbon Emission for Yellow Cabs by Year(2015-2024)',
+               'ylabel': 'Total CO₂ (one hundred million kgs)', 'file': 'yellow_cabs_co2_by_year.png'},
+    'green': {'color': '#013220', 'title': 'Carbon Emissions for Green Cabs by Year(2015-2024)',
+              'ylabel': 'Total CO₂ (ten million kgs)', 'file': 'green_cabs_co2_by_year.png'},
+}
+
+
+def run_query(con, cache, sql, params=None):
+    """
+    Runs a query through the result cache, or directly when caching is off
+    """
+    if cache is None:
+        return con.execute(sql, params or []).fetchall()
+    return cache.fetchall(con, sql, params)
+
+
+def co2_by(con, cache, grain, column, where="true", confidence=None):
+    """
+    Sums co2 per fleet and `column` from one grouping set of the
+    emissions_rollup cube. Returns {taxi_type: [(value, total_co2)]} ordered
+    heaviest first.
+    With a `confidence` level the totals are estimated from the trips_sample
+    model instead, as [(value, estimate, low, high)] (see sampling.py).
+    """
+    if confidence:
+        estimates = estimate_by(con, column, where=where, confidence=confidence, cache=cache)
+        return {taxi_type: [row[:4] for row in rows] for taxi_type, rows in estimates.items()}
+    rows = run_query(con, cache, f"""
+        SELECT taxi_type, {column},
+        SUM(total_co2_kgs) as total_co2
+        FROM emissions_rollup
+        WHERE grain = ? AND {where}
+        GROUP BY taxi_type, {column}
+        ORDER BY taxi_type, total_co2 DESC;
+        """, [grain])
+    totals = {}
+    for taxi_type, value, total_co2 in rows:
+        totals.setdefault(taxi_type, []).append((value, total_co2))
+    return totals
+
+
+def interval(row, confidence):
+    """
+    Describes an estimated total and its confidence interval
+    """
+    _, estimate, low, high = row
+    return f" (~{estimate:,.0f} kgs, {confidence:.0%} CI {low:,.0f} to {high:,.0f})"
+
+
+def report_extremes(con, cache, period, grain, column, where="true", confidence=None):
+    """
+    Prints and logs the heaviest and lightest co2 producing `period` for each
+    fleet, with confidence intervals when estimated from the sample
+    """
+    totals = co2_by(con, cache, grain, column, where, confidence)
+    for taxi_type in TAXI_TYPES:
+        if taxi_type not in totals:
+            continue
+        rows = totals[taxi_type]
+        heaviest = rows[0][0]
+        lightest = rows[-1][0]
+
+        if confidence:
+            # Overlapping intervals mean the sample cannot tell the top two apart
+            tied = len(rows) > 1 and rows[1][3] >= rows[0][2]
+            print(f"Heaviest CO₂ producing {period} for {taxi_type} trips: {heaviest}{interval(rows[0], confidence)}"
+                  f"{f', not distinguishable from {rows[1][0]}' if tied else ''}")
+            print(f"Lightest CO₂ producing {period} for {taxi_type} trips: {lightest}{interval(rows[-1], confidence)}")
+        else:
+            print(f"Heaviest CO₂ producing {period} for {taxi_type} trips: {heaviest}")
+            print(f"Lightest CO₂ producing {period} for {taxi_type} trips: {lightest}")
+        logger.info(f"Recorded heaviest CO₂ producing {period} for {taxi_type} trips: {heaviest}")
+        logger.info(f"Recorded Lightest CO₂ producing {period} for {taxi_type} trips: {lightest}")
+
+
+def plot_years(taxi_type, co2_years):
+    """
+    Bar chart of total co2 per year for one fleet, saved to the project directory.
+    Estimated rows (value, estimate, low, high) are drawn with error bars.
+    """
+    config = PLOTS.get(taxi_type, {
+        'color': 'grey', 'title': f'Carbon Emissions for {taxi_type.capitalize()} Cabs by Year',
+        'ylabel': 'Total CO₂ (kgs)', 'file': f'{taxi_type}_cabs_co2_by_year.png',
+    })
+
+    # Extract years (x-axis values)
+    years = [row[0] for row in co2_years]
+    # Extract co2 totals (y-axis values)
+    co2_totals = [row[1] for row in co2_years]
+    # Distance from each estimate to its interval bounds
+    errors = None
+    if co2_years and len(co2_years[0]) == 4:
+        errors = [[row[1] - row[2] for row in co2_years], [row[3] - row[1] for row in co2_years]]
+
+    plt.figure(figsize=(10, 6))
+    # Create bar chart with the fleet's cab color
+    plt.bar(years, co2_totals, color=config['color'], yerr=errors, capsize=4 if errors else 0)
+
+    plt.title(config['title'], fontsize=16, fontweight='bold')
+
+    # Setting axis labels
+    plt.xlabel("Year", fontsize=12)
+    plt.ylabel(config['ylabel'], fontsize=12)
+
+    # Setting xticks
+    plt.xticks(years)  # Set x-ticks to the years
+
+    # Adding gridlines for better readability
+    plt.grid(axis='y', linestyle='--', alpha=0.7)
+
+    # Remove spines for cleaner look
+    plt.gca().spines['top'].set_visible(False)
+    plt.gca().spines['right'].set_visible(False)
+    plt.tight_layout()
+
+    # Save figure to project directory
+    plt.savefig(config['file'])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analyze co2 emissions of the taxi trips")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Bypass the query result cache and always run the queries")
+    parser.add_argument('--primary', action='store_true',
+                        help="Read the primary database instead of the published replica")
+    parser.add_argument('--approximate', action='store_true',
+                        help="Estimate totals from the stratified trip sample, with confidence intervals")
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help="Confidence level of the intervals in --approximate mode")
+    return parser.parse_args()
+
+
+@timed_stage('analysis')
+def analyze_tables(use_cache=True, primary=False, confidence=None):
+    """
+    Answers every question from the pre-aggregated emissions_rollup cube
+    (see dbt/models/emissions_rollup.sql) instead of scanning the trips.
+    Results are cached per data version (see query_cache.py), so re-running
+    over unchanged data does not touch DuckDB beyond the version check.
+    Reads the current published replica (see publish.py) when there is one,
+    otherwise the primary database, always read-only so other readers and
+    (with a replica) loads can run at the same time.
+    With a `confidence` level, answers are estimated from the stratified
+    trips_sample model (see sampling.py) and reported with intervals.
+    """
     con = None
+    cache = QueryCache(QUERY_CACHE_DIR, int(QUERY_CACHE_MAX_MB * 1024**2)) if use_cache else None
 
     try:
-        # Connect to local DuckDB instance
-        con = duckdb.connect(database='emissions.duckdb', read_only=False)
-        logger.info("Connected to DuckDB instance")
-
-        # Finding largest carbon producing trip 
-
-        ## Largest carbon producing trip(yellow taxi)
-        yellow_co2_max = con.execute(f"""
-            SELECT MAX(trip_co2_kgs)
-            FROM yellow_tripdata_transformed;
-            """).fetchone()[0]
-        print(f"The highest co2 producing yellow trip produced {yellow_co2_max} KGs of co2")
-        logger.info(f"Found max co2 trip for yellow taxis as {yellow_co2_max}")
-
-        ## Largest carbon producing trip(green taxi)
-        green_co2_max = con.execute(f"""
-            SELECT MAX(trip_co2_kgs)
-            FROM green_tripdata_transformed;
-            """).fetchone()[0]
-        print(f"The highest co2 producing green trip produced {green_co2_max} KGs of co2")
-        logger.info(f"Found max co2 trip for green taxis as {green_co2_max}")
-
-        # Finding heaviest and lightest carbon producing hours 
-
-        ## Heaviest/lightest co2 hours for yellow trips
-        yellow_co2_hours = con.execute(f"""
-            SELECT hour_of_day,
-            SUM(trip_co2_kgs) as total_co2
-            FROM yellow_tripdata_transformed
-            GROUP BY hour_of_day
-            ORDER BY total_co2 DESC;
-            """).fetchall()
-                
-        # Pulling values from tuples stored in green_co2_hours
-        heaviest_hour = yellow_co2_hours[0][0]
-        lightest_hour = yellow_co2_hours[-1][0]
-
-        print(f"Heaviest CO₂ producing hour for yellow trips: {heaviest_hour}")
-        print(f"Lightest CO₂ producing hour for yellow trips: {lightest_hour}")
-        logger.info(f"Recorded heaviest CO₂ producing hour for yellow trips: {heaviest_hour}")
-        logger.info(f"Recorded Lightest CO₂ producing hour for yellow trips: {lightest_hour}")
-
-        ## Heaviest/lightest co2 hours for green trips
-        green_co2_hours = con.execute(f"""
-            SELECT hour_of_day,
-            SUM(trip_co2_kgs) as total_co2
-            FROM green_tripdata_transformed
-            GROUP BY hour_of_day
-            ORDER BY total_co2 DESC;
-            """).fetchall()
-        
-        # Pulling values from tuples stored in green_co2_hours
-        heaviest_hour = green_co2_hours[0][0]
-        lightest_hour = green_co2_hours[-1][0]
-
-        print(f"Heaviest CO₂ producing hour for green trips: {heaviest_hour}")
-        print(f"Lightest CO₂ producing hour for green trips: {lightest_hour}")
-        logger.info(f"Recorded heaviest CO₂ producing hour for green trips: {heaviest_hour}")
-        logger.info(f"Recorded Lightest CO₂ producing hour for green trips: {lightest_hour}")
-
-        # Finding heaviest and lightest carbon producing days of week 
-
-        ## Heaviest/lightest co2 days for yellow trips
-        yellow_co2_days = con.execute(f"""
-            SELECT day_of_week,
-            SUM(trip_co2_kgs) as total_co2
-            FROM yellow_tripdata_transformed
-            GROUP BY day_of_week
-            ORDER BY total_co2 DESC;
-            """).fetchall()
-                
-        # Pulling values from tuples stored in green_co2_days
-        heaviest_day = yellow_co2_days[0][0]
-        lightest_day = yellow_co2_days[-1][0]
-
-        print(f"Heaviest CO₂ producing day for yellow trips: {heaviest_day}")
-        print(f"Lightest CO₂ producing day for yellow trips: {lightest_day}")
-        logger.info(f"Recorded heaviest CO₂ producing day for yellow trips: {heaviest_day}")
-        logger.info(f"Recorded Lightest CO₂ producing day for yellow trips: {lightest_day}")
-
-        ## Heaviest/lightest co2 days for green trips
-        green_co2_days = con.execute(f"""
-            SELECT day_of_week,
-            SUM(trip_co2_kgs) as total_co2
-            FROM green_tripdata_transformed
-            GROUP BY day_of_week
-            ORDER BY total_co2 DESC;
-            """).fetchall()
-        
-        # Pulling values from tuples stored in green_co2_days
-        heaviest_day = green_co2_days[0][0]
-        lightest_day = green_co2_days[-1][0]
-
-        print(f"Heaviest CO₂ producing day for green trips: {heaviest_day}")
-        print(f"Lightest CO₂ producing day for green trips: {lightest_day}")
-        logger.info(f"Recorded heaviest CO₂ producing day for green trips: {heaviest_day}")
-        logger.info(f"Recorded Lightest CO₂ producing day for green trips: {lightest_day}")
-        
-        # Finding heaviest and lightest carbon producing weeks 
-
-        ## Heaviest/lightest co2 weeks for yellow trips(some years marked as 53 weeks, ignoring)
-        yellow_co2_weeks = con.execute(f"""
-            SELECT week_of_year,
-            SUM(trip_co2_kgs) as total_co2
-            FROM yellow_tripdata_transformed
-            WHERE week_of_year BETWEEN 0 AND 52
-            GROUP BY week_of_year
-            ORDER BY total_co2 DESC;
-            """).fetchall()
-                
-        # Pulling values from tuples stored in green_co2_hours
-        heaviest_week = yellow_co2_weeks[0][0]
-        lightest_week = yellow_co2_weeks[-1][0]
-
-        print(f"Heaviest CO₂ producing week for yellow trips: {heaviest_week}")
-        print(f"Lightest CO₂ producing week for yellow trips: {lightest_week}")
-        logger.info(f"Recorded heaviest CO₂ producing week for yellow trips: {heaviest_week}")
-        logger.info(f"Recorded Lightest CO₂ producing week for yellow trips: {lightest_week}")
-
-        ## Heaviest/lightest co2 weeks for green trips
-        green_co2_weeks = con.execute(f"""
-            SELECT week_of_year,
-            SUM(trip_co2_kgs) as total_co2
-            FROM green_tripdata_transformed
-            WHERE week_of_year BETWEEN 0 AND 52
-            GROUP BY week_of_year
-            ORDER BY total_co2 DESC;
-            """).fetchall()
-        
-        # Pulling values from tuples stored in green_co2_hours
-        heaviest_week = green_co2_weeks[0][0]
-        lightest_week = green_co2_weeks[-1][0]
-
-        print(f"Heaviest CO₂ producing week for green trips: {heaviest_week}")
-        print(f"Lightest CO₂ producing week for green trips: {lightest_week}")
-        logger.info(f"Recorded heaviest CO₂ producing week for green trips: {heaviest_week}")
-        logger.info(f"Recorded Lightest CO₂ producing week for green trips: {lightest_week}")
-
-        # Finding heaviest and lightest carbon producing months 
-
-        ## Heaviest/lightest co2 months for yellow trips
-        yellow_co2_months = con.execute(f"""
-            SELECT month_of_year,
-            SUM(trip_co2_kgs) as total_co2
-            FROM yellow_tripdata_transformed
-            GROUP BY month_of_year
-            ORDER BY total_co2 DESC;
-            """).fetchall()
-                
-        # Pulling values from tuples stored in green_co2_hours
-        heaviest_month = yellow_co2_months[0][0]
-        lightest_month = yellow_co2_months[-1][0]
-
-        print(f"Heaviest CO₂ producing month for yellow trips: {heaviest_month}")
-        print(f"Lightest CO₂ producing month for yellow trips: {lightest_month}")
-        logger.info(f"Recorded heaviest CO₂ producing month for yellow trips: {heaviest_month}")
-        logger.info(f"Recorded Lightest CO₂ producing month for yellow trips: {lightest_month}")
-
-        ## Heaviest/lightest co2 month for green trips
-        green_co2_months = con.execute(f"""
-            SELECT month_of_year,
-            SUM(trip_co2_kgs) as total_co2
-            FROM green_tripdata_transformed
-            GROUP BY month_of_year
-            ORDER BY total_co2 DESC;
-            """).fetchall()
-        
-        # Pulling values from tuples stored in green_co2_hours
-        heaviest_month = green_co2_months[0][0]
-        lightest_month = green_co2_months[-1][0]
-
-        print(f"Heaviest CO₂ producing month for green trips: {heaviest_month}")
-        print(f"Lightest CO₂ producing month for green trips: {lightest_month}")
-        logger.info(f"Recorded heaviest CO₂ producing month for green trips: {heaviest_month}")
-        logger.info(f"Recorded Lightest CO₂ producing month for green trips: {lightest_month}")
+        # Connect read-only to the replica, or the primary database if none is published
+        database = None if primary else current_replica()
+        con = connect('analysis', database=database or DB_PATH, read_only=True)
+        logger.info(f"Connected to DuckDB instance {database or DB_PATH}")
+
+        # Finding largest carbon producing trip per fleet
+        if confidence:
+            co2_max = sample_max(con, cache=cache)
+        else:
+            co2_max = dict(run_query(con, cache, """
+                SELECT taxi_type, MAX(max_trip_co2_kgs)
+                FROM emissions_rollup
+                WHERE grain = 'year'
+                GROUP BY taxi_type;
+                """))
+        for taxi_type in TAXI_TYPES:
+            # The sample maximum is only a lower bound of the true maximum
+            print(f"The highest co2 producing {taxi_type} trip produced {'at least ' if confidence else ''}"
+                  f"{co2_max.get(taxi_type)} KGs of co2")
+            logger.info(f"Found max co2 trip for {taxi_type} taxis as {co2_max.get(taxi_type)}")
+
+        # Trip co2 and speed percentiles per fleet, merged from the per-partition sketches
+        for measure, unit in [('trip_co2_kgs', 'KGs of co2'), ('avg_mph', 'mph')]:
+            for (taxi_type,), (values, _) in quantiles(con, measure, cache=cache).items():
+                percentiles = ", ".join(f"p{q * 100:g} {value:,.2f}" for q, value in values.items())
+                print(f"{taxi_type.capitalize()} trip {measure} percentiles: {percentiles} {unit}")
+                logger.info(f"Recorded {taxi_type} {measure} percentiles as {values}")
+
+        # Finding heaviest and lightest carbon producing hours, days, weeks and months
+        report_extremes(con, cache, 'hour', 'hour', 'hour_of_day', confidence=confidence)
+        report_extremes(con, cache, 'day', 'day', 'day_of_week', confidence=confidence)
+        # Some years are marked as 53 weeks, ignoring
+        report_extremes(con, cache, 'week', 'week', 'week_of_year', "week_of_year BETWEEN 0 AND 52", confidence)
+        report_extremes(con, cache, 'month', 'month', 'month_of_year', confidence=confidence)
 
         # Generating plots
-
-        yellow_co2_years = con.execute(f"""
-            SELECT specified_year,
-            SUM(trip_co2_kgs) as total_co2
-            FROM yellow_tripdata_transformed
-            WHERE specified_year BETWEEN 2015 AND 2024
-            GROUP BY specified_year;
-            """).fetchall()
-        
-        logger.info(f'Recorded yellow trip years as {[row[0] for row in yellow_co2_years]}')
-        logger.info(f'Recorded yellow trip co2 as {[row[1] for row in yellow_co2_years]}')
-
-        # Extract months (x-axis values)
-        years = [row[0] for row in yellow_co2_years]
-        # Extract co2 totals (y-axis values)
-        co2_totals = [row[1] for row in yellow_co2_years]
-
-        plt.figure(figsize=(10, 6))
-        # Create bar chart with yellow cab color
-        plt.bar(years, co2_totals, color='#FDB813')
-
-        plt.title('Carbon Emission for Yellow Cabs by Year(2015-2024)', fontsize=16, fontweight='bold')
-
-        # Setting axis labels
-        plt.xlabel("Year", fontsize=12)
-        plt.ylabel("Total CO₂ (one hundred million kgs)", fontsize=12)
-
-        # Setting xticks
-        plt.xticks(years)  # Set x-ticks to the years
-
-        # Adding gridlines for better readability
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-
-        # Remove spines for cleaner look
-        plt.gca().spines['top'].set_visible(False)
-        plt.gca().spines['right'].set_visible(False)
-        plt.tight_layout()
-
-        # Save figure to project directory
-        plt.savefig("yellow_cabs_co2_by_year.png")
-
-
-        # Creating greencab plot
-
-        green_co2_years = con.execute(f"""
-            SELECT specified_year,
-            SUM(trip_co2_kgs) as total_co2
-            FROM green_tripdata_transformed
-            WHERE specified_year BETWEEN 2015 AND 2024
-            GROUP BY specified_year;
-            """).fetchall()
-        
-        logger.info(f'Recorded green trip years as {[row[0] for row in yellow_co2_years]}')
-        logger.info(f'Recorded green trip co2 as {[row[1] for row in yellow_co2_years]}')
-
-        # Extract months (x-axis values)
-        years = [row[0] for row in green_co2_years]
-        # Extract co2 totals (y-axis values)
-        co2_totals = [row[1] for row in green_co2_years]
-
-        plt.figure(figsize=(10, 6))
-        # Create bar chart with yellow cab color
-        plt.bar(years, co2_totals, color='#013220')
-
-        plt.title('Carbon Emissions for Green Cabs by Year(2015-2024)', fontsize=16, fontweight='bold')
-
-        # Setting axis labels
-        plt.xlabel("Year", fontsize=12)
-        plt.ylabel("Total CO₂ (ten million kgs)", fontsize=12)
-
-        # Setting xticks
-        plt.xticks(years)  # Set x-ticks to the years
-
-        # Adding gridlines for better readability
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        
-        # Remove spines for cleaner look
-        plt.gca().spines['top'].set_visible(False)
-        plt.gca().spines['right'].set_visible(False)
-        plt.tight_layout()
-
-        # Save figure to project directory
-        plt.savefig("green_cabs_co2_by_year.png")
-
+        co2_years = co2_by(con, cache, 'year', 'specified_year',
+                           f"specified_year BETWEEN {YEARS[0]} AND {YEARS[-1]}", confidence)
+        for taxi_type in TAXI_TYPES:
+            rows = sorted(co2_years.get(taxi_type, []))
+            logger.info(f'Recorded {taxi_type} trip years as {[row[0] for row in rows]}')
+            logger.info(f'Recorded {taxi_type} trip co2 as {[row[1] for row in rows]}')
+            plot_years(taxi_type, rows)
+
+        if cache is not None:
+            cache.flush()
+            logger.info(f"Query cache: {cache.hits} hits, {cache.misses} misses")
 
     except Exception as e:
         print(f"An error occurred: {e}")
         logger.error(f"An error occurred: {e}")
 
 if __name__ == "__main__":
-    analyze_tables()
\ No newline at end of file
+    args = parse_args()
+    analyze_tables(use_cache=not args.no_cache, primary=args.primary,
+                   confidence=args.confidence if args.approximate else None)
@@ -0,0 +1,293 @@
+import argparse
+import duckdb
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from connection import connect
+from emissions_model import MODELS
+from settings import YEARS
+from synthetic import write_dataset
+
+logging.basicConfig(
+    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+    filename='benchmark.log'
+)
+logger = logging.getLogger(__name__)
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SCRIPTS_DIR)
+
+# Pipeline stages in run order
+STAGES = ['load', 'clean', 'transform', 'publish', 'analysis']
+
+# Metrics compared between runs; higher is worse for all of them
+COMPARED_METRICS = ['wall_s', 'peak_rss_mb', 'spill_bytes']
+
+
+def stage_command(stage, args, data_dir):
+    """
+    Returns the command running one stage, or None when it cannot run here
+    """
+    python = sys.executable
+    if stage == 'load':
+        return [python, os.path.join(SCRIPTS_DIR, 'load.py'), '--source', data_dir, '--rate', '0',
+                '--workers', str(args.workers), '--scan', args.scan, '--storage', args.storage,
+                '--years', *[str(y) for y in args.years]]
+    if stage == 'clean':
+        return [python, os.path.join(SCRIPTS_DIR, 'clean.py')]
+    if stage == 'transform':
+        if shutil.which('dbt') is None:
+            return None
+        command = [python, os.path.join(SCRIPTS_DIR, 'transform.py'), '--full-refresh',
+                   '--emissions-model', args.emissions_model]
+        if args.transform == 'parallel':
+            command += ['--parallel']
+        return command
+    if stage == 'publish':
+        # Nothing to publish without the dbt models
+        if shutil.which('dbt') is None:
+            return None
+        return [python, os.path.join(SCRIPTS_DIR, 'publish.py')]
+    if stage == 'analysis':
+        return [python, os.path.join(SCRIPTS_DIR, 'analysis.py'), '--no-cache']
+    raise ValueError(f"Unknown stage {stage}")
+
+
+def directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # spill file removed while walking
+    return total
+
+
+def run_stage(command, workdir, env, spill_dir, log_path):
+    """
+    Runs one stage as a child process. Returns wall time, the child's peak RSS,
+    the peak size of DuckDB's spill directory and whether it succeeded.
+    """
+    peak_spill = 0
+    done = threading.Event()
+
+    def watch_spill():
+        nonlocal peak_spill
+        while not done.is_set():
+            peak_spill = max(peak_spill, directory_bytes(spill_dir))
+            done.wait(0.05)
+
+    watcher = threading.Thread(target=watch_spill, daemon=True)
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        watcher.start()
+        # wait4 gives the rusage of this child alone; ru_maxrss is in KB on Linux
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    done.set()
+    watcher.join()
+
+    with open(log_path) as log:
+        output = log.read()
+    # The pipeline scripts catch their errors and print them instead of exiting non-zero
+    ok = os.waitstatus_to_exitcode(status) == 0 and "An error occurred" not in output
+    return {
+        'wall_s': round(wall, 3),
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+        'spill_bytes': peak_spill,
+        'ok': ok,
+    }
+
+
+def stage_rows(db_path, stage):
+    """
+    Rows a stage works through: source rows for load, loaded trips for clean,
+    trips for transform, transformed trips for publish and analysis
+    """
+    queries = {
+        'load': "SELECT COALESCE(SUM(row_count), 0) FROM load_ledger",
+        'clean': "SELECT COALESCE(SUM(loaded_rows), 0) FROM load_file_stats",
+        'transform': "SELECT COUNT(*) FROM trips",
+        'publish': "SELECT COUNT(*) FROM trips_transformed",
+        'analysis': "SELECT COUNT(*) FROM trips_transformed",
+    }
+    con = connect('benchmark', database=db_path, read_only=True)
+    try:
+        return con.execute(queries[stage]).fetchone()[0]
+    except duckdb.Error:
+        return None
+    finally:
+        con.close()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    """
+    Runs load -> clean -> dbt -> publish -> analysis on synthetic data in a scratch
+    directory and appends one result record to the results file
+    """
+    workdir = os.path.abspath(args.workdir)
+    data_dir = os.path.join(
+        workdir, f"data-r{args.rows}-s{args.seed}-d{args.dirty_fraction}-y{args.years[0]}-{args.years[-1]}"
+    )
+    record = {
+        'run_id': uuid.uuid4().hex[:12],
+        'label': args.label,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'params': {
+            'rows': args.rows, 'years': args.years, 'seed': args.seed,
+            'dirty_fraction': args.dirty_fraction, 'workers': args.workers,
+            'scan': args.scan, 'storage': args.storage, 'transform': args.transform,
+            'emissions_model': args.emissions_model,
+        },
+        'stages': {},
+    }
+
+    # Synthetic files are deterministic, so they are generated once per parameter set
+    if not os.path.exists(data_dir):
+        start = time.perf_counter()
+        write_dataset(data_dir, years=args.years, rows=args.rows, seed=args.seed,
+                      dirty_fraction=args.dirty_fraction)
+        record['generate_s'] = round(time.perf_counter() - start, 3)
+
+    run_dir = os.path.join(workdir, 'run')
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(os.path.join(run_dir, 'data'))
+    shutil.copy(os.path.join(REPO_DIR, 'data', 'vehicle_emissions.csv'), os.path.join(run_dir, 'data'))
+    db_path = os.path.join(run_dir, 'emissions.duckdb')
+    env = dict(
+        os.environ, EMISSIONS_DB=db_path, TRIP_WAREHOUSE=os.path.join(run_dir, 'warehouse'),
+        QUERY_CACHE_DIR=os.path.join(run_dir, '.query_cache'),
+        EMISSIONS_REPLICA_DIR=os.path.join(run_dir, 'replica'),
+    )
+
+    for stage in STAGES:
+        command = stage_command(stage, args, data_dir)
+        if command is None:
+            record['stages'][stage] = {'skipped': True}
+            logger.info(f"Skipped {stage}: not available here")
+            print(f"{stage:<10} skipped")
+            continue
+        # Input rows are counted before the stage runs, except for load which creates them
+        rows = None if stage == 'load' else stage_rows(db_path, stage)
+        result = run_stage(command, run_dir, env, f"{db_path}.tmp", os.path.join(run_dir, f"{stage}.out"))
+        if stage == 'load':
+            rows = stage_rows(db_path, stage)
+        result['rows'] = rows
+        result['rows_per_s'] = round(rows / result['wall_s']) if rows and result['wall_s'] else None
+        record['stages'][stage] = result
+        logger.info(f"{stage}: {result}")
+        print(f"{stage:<10} {result['wall_s']:>8.2f}s {result['peak_rss_mb']:>8.1f} MB RSS "
+              f"{result['spill_bytes'] / 1024**2:>8.1f} MB spilled "
+              f"{result['rows_per_s'] or 0:>12,} rows/s {'' if result['ok'] else 'FAILED'}")
+        if not result['ok']:
+            break
+
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"Recorded run {record['run_id']} in {args.results}")
+    return record
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_runs(args):
+    """
+    Compares a candidate run with a baseline run of the same parameters.
+    Returns the regressions beyond the threshold as (stage, metric, baseline, candidate).
+    """
+    runs = read_results(args.results)
+    if not runs:
+        raise ValueError(f"No benchmark runs in {args.results}")
+    by_id = {run['run_id']: run for run in runs}
+    candidate = by_id[args.candidate] if args.candidate else runs[-1]
+    if args.baseline:
+        baseline = by_id[args.baseline]
+    else:
+        earlier = [r for r in runs[:runs.index(candidate)] if r['params'] == candidate['params']]
+        if not earlier:
+            raise ValueError(f"No earlier run with the same parameters as {candidate['run_id']}")
+        baseline = earlier[-1]
+
+    print(f"Baseline {baseline['run_id']} ({baseline['commit']}) vs candidate "
+          f"{candidate['run_id']} ({candidate['commit']})")
+    regressions = []
+    for stage in STAGES:
+        old, new = baseline['stages'].get(stage, {}), candidate['stages'].get(stage, {})
+        if old.get('skipped') or new.get('skipped') or not old or not new:
+            continue
+        for metric in COMPARED_METRICS:
+            before, after = old[metric], new[metric]
+            change = (after - before) / before if before else 0.0
+            # Tiny absolute values (e.g. a few KB of spill) are noise, not regressions
+            regressed = change > args.threshold and after - before > args.min_delta.get(metric, 0)
+            if regressed:
+                regressions.append((stage, metric, before, after))
+            print(f"{stage:<10} {metric:<12} {before:>14,} {after:>14,} {change:>+8.1%}"
+                  f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic TLC data")
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help="JSON lines file the run records are appended to")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="Run every stage and record the results")
+    run.add_argument('--workdir', default='bench_work', help="Scratch directory for data and databases")
+    run.add_argument('--rows', type=int, default=100_000, help="Synthetic yellow trips per month")
+    run.add_argument('--years', type=int, nargs='+', default=YEARS, help="Years of synthetic data")
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--dirty-fraction', type=float, default=0.02)
+    run.add_argument('--workers', type=int, default=4)
+    run.add_argument('--scan', choices=['multi-file', 'per-file'], default='multi-file')
+    run.add_argument('--storage', choices=['table', 'parquet'], default='table')
+    run.add_argument('--transform', choices=['dbt', 'parallel'], default='dbt',
+                     help="Transform engine: one dbt query, or per-partition worker processes")
+    run.add_argument('--emissions-model', choices=list(MODELS), default='constant',
+                     help="trip_co2_kgs model used by the transform stage")
+    run.add_argument('--label', default=None, help="Free-form note stored with the run")
+
+    compare = commands.add_parser('compare', help="Compare two recorded runs")
+    compare.add_argument('--baseline', help="Baseline run id (default: previous run with the same parameters)")
+    compare.add_argument('--candidate', help="Candidate run id (default: latest run)")
+    compare.add_argument('--threshold', type=float, default=0.10,
+                         help="Relative increase counted as a regression")
+    args = parser.parse_args()
+    if args.command == 'compare':
+        args.min_delta = {'wall_s': 0.05, 'peak_rss_mb': 8, 'spill_bytes': 16 * 1024**2}
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == 'run':
+        run_benchmark(args)
+    else:
+        regressions = compare_runs(args)
+        if regressions:
+            print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+            sys.exit(1)
@@ -1,6 +1,14 @@
-import duckdb
+import argparse
 import logging
 
+from connection import connect
+from dedupe import bucket_count, create_duplicate_report, dirty_buckets, record_duplicates, stage_deduplicated
+from instrumentation import timed_stage
+from ledger import create_clean_checkpoints, create_ledger, mark_cleaned, pending_clean, record_clean
+from rules import RULES, rejection_case, rules_version, valid_predicate
+from settings import TAXI_TYPES, YEARS
+from storage import TRIPS_TABLE, replace_partition
+
 # Configure logging to write to clean.log with timestamp, level, and message
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
@@ -8,319 +16,203 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def clean_tables():
-    """
-    Cleans yellow and green taxi trip tables by removing invalid data.
-    Removes: trips with 0 passengers, 0 distance, >100 miles, >24 hours duration.
-    Processes year by year to manage memory efficiently.
-    """
-    con = None
-    
-    try:
-        # Connect to local DuckDB instance
-        con = duckdb.connect(database='emissions.duckdb', read_only=False)
-        logger.info("Connected to DuckDB instance")
-
-        # Setting configurations to optimize performance for large datasets
-        con.execute("PRAGMA max_temp_directory_size='15GB';") 
-        logger.info("Set max_temp_directory_size to 15GB.")
-        
-        con.execute("SET memory_limit='16GB';") 
-        logger.info("Set memory_limit to 16GB.")
-        
-        con.execute("SET threads=4;") 
-        logger.info("Set threads to 4 for stable processing.")
-
-        years = list(range(2015, 2025)) 
-        
-        # Process each year individually to manage memory usage
-        for year in years:
-            logger.info(f"Processing year {year}")
-            
-            # Removing trips with no passengers
-
-            # Count rows before deletion for this specified year
-            before_yellow_length = con.execute(f"""
-                SELECT COUNT(*) FROM yellow_tripdata 
-                --- checks if year = specified year(repeated throughout)
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-
-            # Delete rows where passenger count is 0 or NULL for this year only
-            con.execute(f"""
-                DELETE FROM yellow_tripdata  
-                WHERE (passenger_count = 0 OR passenger_count IS NULL)
-                AND EXTRACT(year FROM pickup_datetime) = {year};
-            """)
-            
-            # Count rows after deletion to calculate rows removed
-            after_yellow_length = con.execute(f"""
-                SELECT COUNT(*) FROM yellow_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-            
-            # Log number of rows removed
-            logger.info(f"Dropped {before_yellow_length-after_yellow_length} rows with no passengers from yellowtrip table for year {year}")
-
-            ## Repeating for greentrips
-            before_green_length = con.execute(f"""
-                SELECT COUNT(*) FROM green_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-
-            con.execute(f"""
-                DELETE FROM green_tripdata  
-                WHERE (passenger_count = 0 OR passenger_count IS NULL)
-                AND EXTRACT(year FROM pickup_datetime) = {year};
-            """)
-            
-            after_green_length = con.execute(f"""
-                SELECT COUNT(*) FROM green_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-
-            logger.info(f"Dropped {before_green_length-after_green_length} rows with no passengers from greentrip table for year {year}")
-
-            # Removing trips with distance of 0
-            
-            ## Removing yellowtrips with distance 0 for this year
-            before_yellow_length = con.execute(f"""
-                SELECT COUNT(*) FROM yellow_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-
-            # Delete rows where distance is 0(or negative) or NULL
-            con.execute(f"""
-                DELETE FROM yellow_tripdata  
-                WHERE (distance = 0 OR distance IS NULL
-                        OR distance < 0
-                        OR distance = 0.0 )
-                AND EXTRACT(year FROM pickup_datetime) = {year};
-            """)
-            
-            after_yellow_length = con.execute(f"""
-                SELECT COUNT(*) FROM yellow_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-
-            # Log how many rows had 0 distance
-            logger.info(f"Dropped {before_yellow_length-after_yellow_length} rows with trip len 0 from yellowtrip table for year {year}")
-
-            ## Repeating for greentrips
-            before_green_length = con.execute(f"""
-                SELECT COUNT(*) FROM green_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-
-            con.execute(f"""
-                DELETE FROM green_tripdata  
-                WHERE (distance = 0 OR distance IS NULL
-                        OR distance < 0
-                        OR distance = 0.0)
-                AND EXTRACT(year FROM pickup_datetime) = {year};
-            """)
-            
-            after_green_length = con.execute(f"""
-                SELECT COUNT(*) FROM green_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-
-            logger.info(f"Dropped {before_green_length-after_green_length} rows with trip len 0 from greentrip table for year {year}")
-
-            # Removing trips with distance > 100(for given year)
-            
-            ## Removing from yellowtrips for distance > 100
-            before_yellow_length = con.execute(f"""
-                SELECT COUNT(*) FROM yellow_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-
-            # Delete unreasonably long distance trips
-            con.execute(f"""
-                DELETE FROM yellow_tripdata  
-                WHERE distance > 100
-                AND EXTRACT(year FROM pickup_datetime) = {year};
-            """)
-            
-            after_yellow_length = con.execute(f"""
-                SELECT COUNT(*) FROM yellow_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-
-            # Log how many rows were dropped for unreasonably long trips
-            logger.info(f"Dropped {before_yellow_length-after_yellow_length} rows with trip len > 100 from yellowtrip table for year {year}")
-
-            ## Repeating for greentrips
-            before_green_length = con.execute(f"""
-                SELECT COUNT(*) FROM green_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
-
-            con.execute(f"""
-                DELETE FROM green_tripdata  
-                WHERE distance > 100
-                --- entry from early jan 1 wasn't removed
-                AND pickup_datetime >= '{year}-01-01 00:00:00'
-                AND pickup_datetime < '{year+1}-01-01 00:00:00';;
-            """)
-            
-            after_green_length = con.execute(f"""
-                SELECT COUNT(*) FROM green_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
+# Verification checks run after cleaning: (label, predicate that should match no rows)
+CHECKS = [
+    ("with 0 passengers", "passenger_count = 0"),
+    ("with no length", "distance = 0"),
+    ("> 100 miles", "distance > 100"),
+    ("> 1 day", "date_diff('second', pickup_datetime, dropoff_datetime) > 86400"),
+]
 
-            logger.info(f"Dropped {before_green_length-after_green_length} rows with trip len>100 from greentrip table for year {year}")
 
-            # Removing trips > 1 day
-            
-            ## Removing yellowtrips over one day for this year
-            before_yellow_length = con.execute(f"""
-                SELECT COUNT(*) FROM yellow_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
+# Rows of one source partition
+PARTITION = "taxi_type = ? AND source_year = ? AND source_month = ?"
 
-            # Calculate trip duration and remove if > 86400 seconds (24 hours)
-            # Also remove if pickup or dropoff times are NULL
-            con.execute(f"""
-                DELETE FROM yellow_tripdata  
-                WHERE (date_diff('second', pickup_datetime, dropoff_datetime) > 86400
-                OR pickup_datetime IS NULL
-                OR dropoff_datetime IS NULL)
-                AND EXTRACT(year FROM pickup_datetime) = {year};
-            """)
-            
-            after_yellow_length = con.execute(f"""
-                SELECT COUNT(*) FROM yellow_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
 
-            # Log how many trips were dropped for having duration > 1 day
-            logger.info(f"Dropped {before_yellow_length-after_yellow_length} rows with trips > 1 day from yellowtrip table for year {year}")
-
-            ## Repeating for greentrips
-            before_green_length = con.execute(f"""
-                SELECT COUNT(*) FROM green_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
+def partition_counts(con, params):
+    """
+    Single scan over one partition counting, per pickup year, how many rows
+    each rule would drop, plus its valid rows.
+    Returns ({(year, rule): rows}, valid rows).
+    """
+    filters = ",\n".join(
+        f"COUNT(*) FILTER (WHERE rejected_by = '{name}') AS {name}" for name, _, _ in RULES
+    )
+    rows = con.execute(f"""
+        SELECT pickup_year, {filters},
+        COUNT(*) FILTER (WHERE rejected_by IS NULL)
+        FROM (
+            SELECT EXTRACT(year FROM pickup_datetime) AS pickup_year,
+            {rejection_case()} AS rejected_by
+            FROM {TRIPS_TABLE}
+            WHERE {PARTITION}
+        )
+        GROUP BY pickup_year;
+    """, params).fetchall()
+    counts, valid = {}, 0
+    for row in rows:
+        for (name, _, _), count in zip(RULES, row[1:]):
+            counts[(row[0], name)] = count
+        valid += row[-1]
+    return counts, valid
+
+
+def clean_partition(con, partition, rules, dedupe='fast', memory_budget=4 * 1024**3, filtered=False):
+    """
+    Cleans one (taxi_type, year, month) partition in a single transaction:
+    its rows breaking a rule and its duplicate trips are removed, and the
+    partition is checkpointed in clean_checkpoints. The counts and dirty
+    buckets are read in the same transaction, so they match the rows being
+    replaced. A crash rolls back the partition being cleaned; every committed
+    partition stays done.
+    Partitions with nothing to remove are only checkpointed. dedupe='fast'
+    only deduplicates the hash buckets of the valid rows that have a repeated
+    fingerprint (see dedupe.dirty_buckets), each bucket's fingerprints within
+    `memory_budget`; 'exact' deduplicates every bucket. A `filtered`
+    partition already had the rules applied on load and is only deduplicated.
+    Returns ({(year, rule): rows dropped}, duplicates dropped).
+    """
+    taxi_type, year, month = partition
+    params = [taxi_type, int(year), int(month)]
+    valid_rows = f"SELECT * FROM {TRIPS_TABLE} WHERE {PARTITION}"
+    if not filtered:
+        valid_rows += f" AND {valid_predicate()}"
 
-            con.execute(f"""
-                DELETE FROM green_tripdata  
-                WHERE (date_diff('second', pickup_datetime, dropoff_datetime) > 86400
-                OR pickup_datetime IS NULL
-                OR dropoff_datetime IS NULL)
-                AND EXTRACT(year FROM pickup_datetime) = {year};
-            """)
-            
-            after_green_length = con.execute(f"""
-                SELECT COUNT(*) FROM green_tripdata 
-                WHERE EXTRACT(year FROM pickup_datetime) = {year};
-            """).fetchone()[0]
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        if filtered:
+            counts = {}
+            valid = con.execute(f"SELECT COUNT(*) FROM {TRIPS_TABLE} WHERE {PARTITION};", params).fetchone()[0]
+        else:
+            counts, valid = partition_counts(con, params)
+        rejected = sum(counts.values())
+        buckets = bucket_count(valid, memory_budget)
+        dirty = []
+        if dedupe == 'exact':
+            dirty = list(range(buckets))
+        elif dedupe == 'fast':
+            dirty = dirty_buckets(con, valid_rows, params, buckets)
+
+        duplicates = 0
+        if dirty:
+            duplicates = stage_deduplicated(con, valid_rows, params, valid, memory_budget, dirty)
+        elif rejected:
+            con.execute(f"CREATE OR REPLACE TEMP TABLE clean_partition AS {valid_rows};", params)
+        if rejected or duplicates:
+            # Staged first: on the table backend the partition's rows are deleted before the insert
+            replace_partition(con, partition, "SELECT * FROM clean_partition")
+            mark_cleaned(con, [partition])
+        if dedupe != 'off':
+            record_duplicates(con, partition, duplicates, dedupe)
+        record_clean(con, partition, rules, dedupe, rejected, duplicates)
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    con.execute("DROP TABLE IF EXISTS clean_partition;")
+    return counts, duplicates
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Clean the trip tables in DuckDB")
+    parser.add_argument('--dedupe', choices=['exact', 'fast', 'off'], default='fast',
+                        help="Duplicate removal mode (fast uses a fingerprint pre-filter)")
+    parser.add_argument('--dedupe-memory-gb', type=float, default=4.0,
+                        help="Memory budget for one duplicate-removal partition")
+    parser.add_argument('--restart', action='store_true',
+                        help="Forget the clean checkpoints and clean every partition again")
+    return parser.parse_args()
+
+
+@timed_stage('clean')
+def clean_tables(dedupe='fast', dedupe_memory_gb=4.0, restart=False):
+    """
+    Cleans the trips table (all fleets) by removing invalid data.
+    Removes: trips with 0 passengers, 0 distance, >100 miles, >24 hours duration,
+    and pickups outside of 2015-2024, then removes duplicate trips.
+
+    Works one source partition at a time, oldest first, each in its own
+    transaction that also writes its checkpoint (see clean_partition). A rerun
+    after a crash resumes at the first unfinished partition; partitions are
+    cleaned again only when reloaded, when the rules change (see rules.py) or
+    with --restart. Cleaning is idempotent, so a repeated partition is harmless.
+    Errors are logged and raised, so a failed clean exits non-zero.
+    """
+    con = None
 
-            logger.info(f"Dropped {before_green_length-after_green_length} rows with trips>1 day from greentrip table for year {year}")
-        
-        # Remove all records outside of daterange
-        con.execute("""
-        DELETE FROM yellow_tripdata
-        WHERE (EXTRACT(YEAR FROM pickup_datetime) < 2015 
-        OR EXTRACT(YEAR FROM pickup_datetime) > 2024)
-        """)
+    try:
+        # Connect to local DuckDB instance. Memory, threads and spill space are
+        # derived from the machine's limits (see connection.py)
+        con = connect('clean')
+        logger.info("Connected to DuckDB instance")
 
-        con.execute("""
-            DELETE FROM green_tripdata 
-            WHERE (EXTRACT(YEAR FROM pickup_datetime) < 2015 
-            OR EXTRACT(YEAR FROM pickup_datetime) > 2024)
-        """)
-        logger.info("Removed all records outside of date range")
-        # All years processed - now run verification checks
+        create_ledger(con)
+        create_duplicate_report(con)
+        create_clean_checkpoints(con)
+        if restart:
+            con.execute("DELETE FROM clean_checkpoints;")
+            logger.info("Cleared clean checkpoints, cleaning every partition")
+
+        rules = rules_version()
+        pending = pending_clean(con, rules, dedupe)
+        done = con.execute("SELECT COUNT(*) FROM load_ledger;").fetchone()[0] - len(pending)
+        logger.info(f"{len(pending)} partitions to clean, {done} already done")
+
+        counts, removed = {}, {}
+        for i, (taxi_type, year, month, filtered) in enumerate(pending, 1):
+            partition = (taxi_type, year, month)
+            try:
+                partition_dropped, duplicates = clean_partition(
+                    con, partition, rules, dedupe, int(dedupe_memory_gb * 1024**3), filtered
+                )
+            except Exception:
+                logger.error(f"Cleaning {taxi_type} {year}-{month:02d} failed; rerun clean.py to resume from it")
+                raise
+            for (pickup_year, name), count in partition_dropped.items():
+                counts[(taxi_type, pickup_year, name)] = counts.get((taxi_type, pickup_year, name), 0) + count
+            removed[taxi_type] = removed.get(taxi_type, 0) + duplicates
+            logger.info(f"Cleaned {taxi_type} {year}-{month:02d} ({i}/{len(pending)}): "
+                        f"{sum(partition_dropped.values())} invalid and {duplicates} duplicate rows removed")
+
+        # Log rows dropped per rule per year, as the old delete loop did
+        for year in YEARS:
+            for name, description, _ in RULES:
+                if name == 'out_of_range':
+                    continue
+                for taxi_type in TAXI_TYPES:
+                    logger.info(f"Dropped {counts.get((taxi_type, year, name), 0)} {description} from {taxi_type}trip table for year {year}")
+
+        for taxi_type in TAXI_TYPES:
+            out_of_range = sum(c for (t, _, name), c in counts.items() if t == taxi_type and name == 'out_of_range')
+            logger.info(f"Removed {out_of_range} {taxi_type} records outside of date range")
+
+        if dedupe != 'off':
+            for taxi_type in TAXI_TYPES:
+                print(f"{taxi_type.capitalize()} duplicate trips removed: {removed.get(taxi_type, 0)}")
+                logger.info(f"{taxi_type.capitalize()} duplicate trips removed: {removed.get(taxi_type, 0)}")
+
+        # All tables processed - now run verification checks
         logger.info("Cleaning complete - running verification checks")
-        
-        # VERIFICATION SECTION - Checking to ensure all invalid data was removed
-    
-
-        ## Verifying 0 passenger trips are removed
 
-        ### Counting yellow trip rows where passengers = 0 (should be 0)
-        yellow_no_pass = con.execute(f"""
-            SELECT COUNT(*) FROM yellow_tripdata
-            WHERE passenger_count = 0;
-        """).fetchone()[0]
-        
-        # Output to console and log - expecting 0
-        print(f"Yellow trip rows with 0 passengers: {yellow_no_pass} remaining after clean")
-        logger.info(f"Yellow trip rows with 0 passengers: {yellow_no_pass} remaining after clean")
+        # VERIFICATION SECTION - one scan checking all invalid data was removed
+        filters = ",\n".join(f"COUNT(*) FILTER (WHERE {predicate})" for _, predicate in CHECKS)
+        remaining = {
+            row[0]: row[1:]
+            for row in con.execute(f"SELECT taxi_type, {filters} FROM {TRIPS_TABLE} GROUP BY taxi_type;").fetchall()
+        }
+        for i, (label, _) in enumerate(CHECKS):
+            for taxi_type in TAXI_TYPES:
+                # Output to console and log - expecting 0
+                print(f"{taxi_type.capitalize()} trip rows {label}: {remaining.get(taxi_type, [0] * len(CHECKS))[i]} remaining after clean")
+                logger.info(f"{taxi_type.capitalize()} trip rows {label}: {remaining.get(taxi_type, [0] * len(CHECKS))[i]} remaining after clean")
 
-        ### Counting green trip rows where passengers = 0 (should be 0)
-        green_no_pass = con.execute(f"""
-            SELECT COUNT(*) FROM green_tripdata
-            WHERE passenger_count = 0;
-        """).fetchone()[0]
-        print(f"Green trip rows with 0 passengers: {green_no_pass} remaining after clean")
-        logger.info(f"Green trip rows with 0 passengers: {green_no_pass} remaining after clean")
-
-        ## Verifying trips with 0 distance are removed
-
-        ### Counting yellow trip rows where distance = 0 (should be 0)
-        yellow_no_dist = con.execute(f"""
-            SELECT COUNT(*) FROM yellow_tripdata
-            WHERE distance = 0;
-        """).fetchone()[0]
-        
-        # Output to console and log - expecting 0
-        print(f"Yellow trip rows with no length: {yellow_no_dist} remaining after clean")
-        logger.info(f"Yellow trip rows with no length: {yellow_no_dist} remaining after clean")
-
-        ### Counting green trip rows where distance = 0 (should be 0)
-        green_no_dist = con.execute(f"""
-            SELECT COUNT(*) FROM green_tripdata
-            WHERE distance = 0;
-        """).fetchone()[0]
-        print(f"Green trip rows with no length: {green_no_dist} remaining after clean")
-        logger.info(f"Green trip rows with no length: {green_no_dist} remaining after clean")
-
-        ## Verifying trips > 100 miles are removed
-
-        ### Counting yellow trip rows where distance > 100 (should be 0)
-        yellow_too_far = con.execute(f"""
-            SELECT COUNT(*) FROM yellow_tripdata
-            WHERE distance > 100;
-        """).fetchone()[0]
-        
-        # Output to console and log - expecting 0
-        print(f"Yellow trip rows > 100 miles: {yellow_too_far} remaining after clean")
-        logger.info(f"Yellow trip rows > 100 miles: {yellow_too_far} remaining after clean")
-
-        ### Counting green trip rows where distance > 100 (should be 0)
-        green_too_far = con.execute(f"""
-            SELECT COUNT(*) FROM green_tripdata
-            WHERE distance > 100;
-        """).fetchone()[0]
-        print(f"Green trip rows > 100: {green_too_far} remaining after clean")
-        logger.info(f"Green trip rows > 100: {green_too_far} remaining after clean")
-
-        ## Verifying trips > 24 hours are removed
-
-        
-        ### Counting yellow trips > 24 hours (should be 0)
-        yellow_too_long = con.execute(f"""
-            SELECT COUNT(*) FROM yellow_tripdata
-            WHERE date_diff('second', pickup_datetime, dropoff_datetime) > 86400;
-        """).fetchone()[0]
-
-        print(f"Yellow trip rows > 1 day: {yellow_too_long} remaining after clean")
-        logger.info(f"Yellow trip rows > 1 day: {yellow_too_long} remaining after clean")
-
-        ### Counting green trips > 24 hours (should be 0)
-        green_too_long = con.execute(f"""
-            SELECT COUNT(*) FROM green_tripdata
-            WHERE date_diff('second', pickup_datetime, dropoff_datetime) > 86400;
-        """).fetchone()[0]
-
-        print(f"Green trip rows > 1 day: {green_too_long} remaining after clean")
-        logger.info(f"Green trip rows > 1 day: {green_too_long} remaining after clean")
-        
     except Exception as e:
-        print(f"An error occurred: {e}")
         logger.error(f"An error occurred: {e}")
-    
+        raise
+    finally:
+        if con is not None:
+            con.close()
+
 if __name__ == "__main__":
-    clean_tables()
\ No newline at end of file
+    args = parse_args()
+    clean_tables(dedupe=args.dedupe, dedupe_memory_gb=args.dedupe_memory_gb, restart=args.restart)
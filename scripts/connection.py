@@ -0,0 +1,123 @@
+import logging
+import os
+import shutil
+
+import duckdb
+
+from instrumentation import instrument
+from settings import DB_PATH
+
+logger = logging.getLogger(__name__)
+
+# Share of the available memory given to DuckDB per stage. The rest is left
+# for Python, Arrow batches held by the load workers, and the page cache.
+MEMORY_FRACTION = {
+    'load': 0.6,
+    'clean': 0.8,
+    'transform': 0.8,
+    'analysis': 0.5,
+    'api': 0.5,
+}
+DEFAULT_MEMORY_FRACTION = 0.7
+
+# Share of the free disk under the temp directory DuckDB may spill into
+TEMP_DISK_FRACTION = 0.8
+
+# cgroup v1 reports "no limit" as a huge number instead of "max"
+_UNLIMITED = 1 << 60
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def memory_limit_bytes():
+    """
+    Memory available to this process: the cgroup limit (v2 or v1) when set,
+    otherwise physical memory
+    """
+    limits = [os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')]
+    v2 = _read('/sys/fs/cgroup/memory.max')
+    if v2 and v2 != 'max':
+        limits.append(int(v2))
+    v1 = _read('/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    if v1 and int(v1) < _UNLIMITED:
+        limits.append(int(v1))
+    return min(limits)
+
+
+def cpu_count():
+    """
+    CPUs available to this process: the cgroup CPU quota when set, otherwise
+    the CPUs it may be scheduled on
+    """
+    counts = [len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1]
+    v2 = _read('/sys/fs/cgroup/cpu.max')
+    if v2 and not v2.startswith('max'):
+        quota, period = v2.split()
+        counts.append(int(quota) / int(period))
+    quota, period = _read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us'), _read('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+        counts.append(int(quota) / int(period))
+    return max(1, int(min(counts)))
+
+
+def temp_directory(database):
+    """
+    DuckDB's spill directory: DUCKDB_TEMP_DIR, otherwise next to the database
+    """
+    if os.environ.get('DUCKDB_TEMP_DIR'):
+        return os.environ['DUCKDB_TEMP_DIR']
+    if database in (':memory:', None):
+        return os.path.abspath('.tmp')
+    return f"{os.path.abspath(database)}.tmp"
+
+
+def _override(stage, name):
+    """
+    Per-stage environment override (e.g. CLEAN_DUCKDB_THREADS), then the
+    global one (DUCKDB_THREADS)
+    """
+    return os.environ.get(f"{stage.upper()}_DUCKDB_{name}") or os.environ.get(f"DUCKDB_{name}")
+
+
+def resource_settings(stage, database=DB_PATH, share=1.0, temp_dir=None):
+    """
+    DuckDB memory_limit, threads, temp_directory and max_temp_directory_size
+    for a stage, derived from cgroup limits, CPU count and free disk.
+    `share` scales memory and threads for one of several concurrent
+    connections, e.g. the load workers. `temp_dir` overrides the spill
+    directory, e.g. one per worker process.
+    """
+    memory = int(memory_limit_bytes() * MEMORY_FRACTION.get(stage, DEFAULT_MEMORY_FRACTION) * share)
+    threads = max(1, int(cpu_count() * share))
+    temp_dir = temp_dir or temp_directory(database)
+    # The temp directory only exists once DuckDB spills, so measure its closest existing parent
+    probe = temp_dir
+    while not os.path.exists(probe):
+        probe = os.path.dirname(probe) or '.'
+    temp_size = int(shutil.disk_usage(probe).free * TEMP_DISK_FRACTION)
+
+    return {
+        'memory_limit': _override(stage, 'MEMORY_LIMIT') or f"{max(memory // 1024**2, 64)}MB",
+        'threads': int(_override(stage, 'THREADS') or threads),
+        'temp_directory': temp_dir,
+        'max_temp_directory_size': _override(stage, 'MAX_TEMP_SIZE') or f"{temp_size // 1024**2}MB",
+    }
+
+
+def connect(stage, database=DB_PATH, read_only=False, share=1.0, temp_dir=None):
+    """
+    Opens an instrumented DuckDB connection configured for the machine and stage
+    """
+    config = resource_settings(stage, database, share, temp_dir)
+    con = duckdb.connect(database=database, read_only=read_only, config=config)
+    logger.info(
+        f"Connected to {database} for {stage}: memory_limit={config['memory_limit']}, "
+        f"threads={config['threads']}, max_temp_directory_size={config['max_temp_directory_size']}"
+    )
+    return instrument(con, stage=stage)
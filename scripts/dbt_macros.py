@@ -0,0 +1,23 @@
+import os
+
+import jinja2
+
+DBT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dbt')
+
+# dbt macro files the scripts render themselves, so the SQL they run outside
+# dbt (parallel transform, emissions benchmark) is the SQL of the dbt models
+MACRO_FILES = ['calendar.sql', 'emissions.sql', 'transform.sql']
+
+
+def dbt_macros(**variables):
+    """
+    The MACRO_FILES macros as callables, with var() reading `variables` like
+    dbt's --vars, e.g. dbt_macros(emissions_model='speed').trip_co2_kgs()
+    """
+    source = ''
+    for name in MACRO_FILES:
+        with open(os.path.join(DBT_DIR, 'macros', name)) as f:
+            source += f.read()
+    return jinja2.Environment().from_string(
+        source, globals={'var': lambda name, default=None: variables.get(name, default)}
+    ).module
@@ -0,0 +1,112 @@
+import logging
+import math
+
+from storage import TRIPS_TABLE, table_columns
+
+logger = logging.getLogger(__name__)
+
+# Columns identifying a trip; rows equal on all of these are duplicates
+FINGERPRINT_COLUMNS = ['taxi_type', 'pickup_datetime', 'dropoff_datetime', 'distance', 'passenger_count']
+
+# Rough in-memory cost of one row in the per-bucket hash aggregate
+BYTES_PER_ROW = 96
+
+
+def create_duplicate_report(con):
+    """
+    Creates the duplicate_report table: duplicates removed per source partition
+    """
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS duplicate_report (
+            taxi_type VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            duplicates BIGINT,
+            mode VARCHAR,
+            checked_at TIMESTAMP,
+            PRIMARY KEY (taxi_type, year, month)
+        );
+    """)
+
+
+def record_duplicates(con, partition, duplicates, mode):
+    """
+    Replaces the duplicate_report row of one (taxi_type, year, month) partition
+    """
+    taxi_type, year, month = partition
+    con.execute("""
+        INSERT OR REPLACE INTO duplicate_report VALUES (?, ?, ?, ?, ?, current_timestamp);
+    """, [taxi_type, int(year), int(month), duplicates, mode])
+
+
+def bucket_count(row_count, memory_budget):
+    """
+    Number of hash partitions needed so one partition's aggregate fits the budget
+    """
+    return max(1, math.ceil(row_count * BYTES_PER_ROW / memory_budget))
+
+
+def fingerprint():
+    """
+    Hash of the fingerprint columns. Identical rows always share it, so
+    rows minus distinct fingerprints is zero when there are no duplicates; a
+    non-zero difference may also be a hash collision.
+    """
+    return f"hash({', '.join(FINGERPRINT_COLUMNS)})"
+
+
+def dirty_buckets(con, source_sql, params, buckets):
+    """
+    Fast pre-filter: compares row and distinct-fingerprint counts per hash
+    bucket of `source_sql`, one bucket per scan, so only one bucket's 8-byte
+    fingerprints are held in memory. A bucket with no repeated fingerprint has
+    no duplicates; a repeat may be a hash collision and is checked exactly by
+    stage_deduplicated. Returns the buckets with repeats.
+    """
+    dirty = []
+    for bucket in range(buckets):
+        repeats = con.execute(f"""
+            SELECT COUNT(*) - COUNT(DISTINCT fp)
+            FROM (SELECT {fingerprint()} AS fp FROM ({source_sql}))
+            WHERE fp % {buckets} = {bucket};
+        """, params).fetchone()[0]
+        if repeats:
+            dirty.append(bucket)
+    return dirty
+
+
+def stage_deduplicated(con, source_sql, params, row_count, memory_budget, dirty=None, target='clean_partition'):
+    """
+    Creates the temp table `target` with one copy of each trip of `source_sql`
+    (all trips columns), aggregating one hash bucket at a time so no aggregate
+    needs more than `memory_budget` bytes. Only the `dirty` buckets (default
+    all, see dirty_buckets) are aggregated; the others are copied as they are.
+    Returns the duplicate rows left out.
+    """
+    columns = table_columns(con, TRIPS_TABLE)
+    keys = ", ".join(FINGERPRINT_COLUMNS)
+    # Keep one copy of each trip, with all of its columns taken from the same row
+    kept = f"any_value(struct_pack({', '.join(f'{c} := {c}' for c in columns)}))"
+    buckets = bucket_count(row_count, memory_budget)
+    dirty = list(range(buckets)) if dirty is None else dirty
+
+    con.execute(f"CREATE OR REPLACE TEMP TABLE {target} AS SELECT * FROM {TRIPS_TABLE} LIMIT 0;")
+    clean = [bucket for bucket in range(buckets) if bucket not in dirty]
+    if clean:
+        con.execute(f"""
+            INSERT INTO {target}
+            SELECT * FROM ({source_sql})
+            WHERE {fingerprint()} % {buckets} IN ({', '.join(map(str, clean))});
+        """, params)
+    for bucket in dirty:
+        con.execute(f"""
+            INSERT INTO {target}
+            SELECT kept.* FROM (
+                SELECT {kept} AS kept
+                FROM ({source_sql})
+                WHERE {fingerprint()} % {buckets} = {bucket}
+                GROUP BY {keys}
+            );
+        """, params)
+    staged = con.execute(f"SELECT COUNT(*) FROM {target};").fetchone()[0]
+    return row_count - staged
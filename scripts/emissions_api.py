@@ -0,0 +1,136 @@
+import argparse
+import logging
+
+import pyarrow.parquet as pq
+
+from connection import connect
+from settings import DB_PATH, current_replica
+
+logger = logging.getLogger(__name__)
+
+# Query API over the transformed data for notebooks and services. Results come
+# back as Arrow (pyarrow.Table or RecordBatchReader) straight from DuckDB, so
+# .to_pandas() / .to_numpy() never build Python objects row by row.
+#
+#   con = open_dataset()
+#   by_hour = emissions_by(con, 'hour', taxi_types=['yellow']).to_pandas()
+
+# emissions_rollup grouping set and dimension column per grain
+GRAINS = {
+    'hour': 'hour_of_day',
+    'day': 'day_of_week',
+    'week': 'week_of_year',
+    'month': 'month_of_year',
+    'year': 'specified_year',
+}
+
+# trips_transformed columns trips can be ranked by
+TRIP_MEASURES = ['trip_co2_kgs', 'distance', 'avg_mph', 'passenger_count']
+
+# Rows per record batch streamed by trips()
+BATCH_SIZE = 1_000_000
+
+
+def open_dataset(database=None, primary=False):
+    """
+    Read-only connection to the current published replica (see publish.py),
+    or to the primary database when nothing is published or `primary` is set
+    """
+    database = database or (None if primary else current_replica()) or DB_PATH
+    return connect('api', database=database, read_only=True)
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _filters(taxi_types=None, years=None):
+    """
+    WHERE clause and parameters restricting fleets and source years
+    """
+    clauses, params = [], []
+    if taxi_types:
+        clauses.append(f"taxi_type IN ({', '.join('?' * len(taxi_types))})")
+        params += list(taxi_types)
+    if years:
+        clauses.append(f"source_year IN ({', '.join('?' * len(years))})")
+        params += [int(year) for year in years]
+    return " AND ".join(clauses) or "true", params
+
+
+def emissions_by(con, grain, taxi_types=None, years=None):
+    """
+    Trips, co2, distance and the heaviest trip per fleet and `grain` (hour,
+    day, week, month or year) from the emissions_rollup cube, as a pyarrow.Table
+    ordered by fleet and grain. Day and month are Arrow dictionaries in
+    calendar order.
+    """
+    if grain not in GRAINS:
+        raise ValueError(f"Unknown grain {grain}, expected one of {', '.join(GRAINS)}")
+    column = GRAINS[grain]
+    where, params = _filters(taxi_types, years)
+    return con.execute(f"""
+        SELECT taxi_type, {column},
+        SUM(trips)::BIGINT AS trips,
+        SUM(total_co2_kgs) AS total_co2_kgs,
+        SUM(total_distance) AS total_distance,
+        MAX(max_trip_co2_kgs) AS max_trip_co2_kgs
+        FROM emissions_rollup
+        WHERE grain = ? AND {where}
+        GROUP BY taxi_type, {column}
+        ORDER BY taxi_type, {column};
+    """, [grain] + params).to_arrow_table()
+
+
+def top_trips(con, n=10, by='trip_co2_kgs', taxi_types=None, years=None, columns=None):
+    """
+    The `n` trips with the largest `by` (one of TRIP_MEASURES) from
+    trips_transformed as a pyarrow.Table, optionally only `columns`
+    """
+    if by not in TRIP_MEASURES:
+        raise ValueError(f"Cannot rank trips by {by}, expected one of {', '.join(TRIP_MEASURES)}")
+    where, params = _filters(taxi_types, years)
+    select = ", ".join(_quote(c) for c in columns) if columns else "*"
+    return con.execute(f"""
+        SELECT {select} FROM trips_transformed
+        WHERE {where} AND {by} IS NOT NULL
+        ORDER BY {by} DESC
+        LIMIT {int(n)};
+    """, params).to_arrow_table()
+
+
+def trips(con, taxi_types=None, years=None, columns=None, batch_size=BATCH_SIZE):
+    """
+    Streams trips_transformed as a pyarrow.RecordBatchReader of `batch_size`
+    rows, so callers can process more trips than fit in memory
+    """
+    where, params = _filters(taxi_types, years)
+    select = ", ".join(_quote(c) for c in columns) if columns else "*"
+    return con.execute(f"SELECT {select} FROM trips_transformed WHERE {where};", params) \
+        .to_arrow_reader(batch_size)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query the emissions dataset as Arrow")
+    parser.add_argument('query', choices=list(GRAINS) + ['top'], help="Grain to aggregate by, or top trips")
+    parser.add_argument('--taxi-types', nargs='+', default=None)
+    parser.add_argument('--years', type=int, nargs='+', default=None)
+    parser.add_argument('-n', type=int, default=10, help="Trips returned by top")
+    parser.add_argument('--by', choices=TRIP_MEASURES, default='trip_co2_kgs', help="Measure top ranks by")
+    parser.add_argument('--primary', action='store_true', help="Read the primary database, not the replica")
+    parser.add_argument('--out', default=None, help="Write the result to this parquet file instead of printing it")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    con = open_dataset(primary=args.primary)
+    if args.query == 'top':
+        table = top_trips(con, args.n, args.by, args.taxi_types, args.years)
+    else:
+        table = emissions_by(con, args.query, args.taxi_types, args.years)
+    if args.out:
+        pq.write_table(table, args.out)
+        print(f"Wrote {table.num_rows} rows to {args.out}")
+    else:
+        print(table.to_pandas().to_string(index=False))
@@ -0,0 +1,150 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+import pyarrow as pa
+from duckdb.sqltypes import DOUBLE, FLOAT
+
+from connection import connect
+from dbt_macros import dbt_macros
+from settings import DB_PATH
+
+logger = logging.getLogger(__name__)
+
+# Emissions models for trip_co2_kgs. Each model is a NumPy function of whole
+# columns (distance, co2_grams_per_mile, mpg_city, mpg_highway, avg_mph)
+# returning kg of co2 per trip, registered with DuckDB as the Arrow UDF
+# co2_kgs_<model>. DuckDB hands the UDF one vector (2048 rows) at a time, so
+# models that are plain arithmetic also have a SQL macro in
+# dbt/macros/emissions.sql, which is what the transform runs for them.
+#
+# 'constant' is the fleet's flat co2_grams_per_mile. 'speed' scales that rate
+# by fuel use at the trip's average speed: the city and highway mpg are
+# blended by where avg_mph falls between the EPA city and highway test cycle
+# speeds. Consumption per mile is blended (not mpg), and the result is
+# normalised by the EPA 55/45 combined consumption the flat rate stands for,
+# so a fleet's co2_grams_per_mile is unchanged at combined driving.
+
+# Average speeds of the EPA city (FTP-75) and highway (HWFET) test cycles
+CITY_MPH = 21.2
+HIGHWAY_MPH = 48.3
+
+# City share of driving in the EPA combined rating
+CITY_SHARE = 0.55
+
+
+def constant(distance, co2_grams_per_mile, mpg_city, mpg_highway, avg_mph):
+    """
+    Flat rate: distance * co2_grams_per_mile
+    """
+    return distance * co2_grams_per_mile / 1000.0
+
+
+def speed(distance, co2_grams_per_mile, mpg_city, mpg_highway, avg_mph):
+    """
+    Flat rate scaled by the trip's fuel use per mile at avg_mph relative to the
+    combined rating. Trips without a usable speed keep the flat rate.
+    """
+    highway = np.clip((avg_mph - CITY_MPH) / (HIGHWAY_MPH - CITY_MPH), 0.0, 1.0)
+    blended = (1.0 - highway) / mpg_city + highway / mpg_highway
+    combined = CITY_SHARE / mpg_city + (1.0 - CITY_SHARE) / mpg_highway
+    scale = np.where(np.isfinite(avg_mph) & (avg_mph > 0), blended / combined, 1.0)
+    return distance * co2_grams_per_mile * scale / 1000.0
+
+
+MODELS = {
+    'constant': constant,
+    'speed': speed,
+}
+
+# Models trip_co2_kgs() computes in plain SQL; the others call their UDF, so
+# dbt runs them with the plugin registering the UDFs (see dbt/profiles.yml)
+SQL_MODELS = ['constant', 'speed']
+
+
+def arrow_udf(model):
+    """
+    Wraps a model as an Arrow UDF: columns in as float64 NumPy arrays (nulls
+    as NaN), float32 out with NaN results (from null inputs) as nulls
+    """
+    # DuckDB reads the parameter count from the signature, so no *args
+    def udf(distance, co2_grams_per_mile, mpg_city, mpg_highway, avg_mph):
+        columns = [distance, co2_grams_per_mile, mpg_city, mpg_highway, avg_mph]
+        values = [column.to_numpy(zero_copy_only=False).astype(np.float64, copy=False) for column in columns]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = model(*values)
+        return pa.array(result.astype(np.float32), from_pandas=True)
+    return udf
+
+
+def register(con):
+    """
+    Registers every model as co2_kgs_<model>(distance, co2_grams_per_mile,
+    mpg_city, mpg_highway, avg_mph) on a DuckDB connection
+    """
+    for name, model in MODELS.items():
+        # 'special' null handling: a NULL avg_mph must not null the whole result
+        con.create_function(
+            f"co2_kgs_{name}", arrow_udf(model), [DOUBLE] * 5, FLOAT,
+            type='arrow', null_handling='special'
+        )
+
+
+def co2_sql(model='constant', udf=False):
+    """
+    SQL for trip_co2_kgs under `model` from the trip_co2_kgs() dbt macro, over
+    trips `t` joined to their vehicle_emissions row `ve`. With `udf`, the
+    model's UDF even when it has a SQL implementation.
+    """
+    if model not in MODELS:
+        raise ValueError(f"Unknown emissions model {model}, expected one of {', '.join(MODELS)}")
+    return dbt_macros(emissions_model=model, emissions_udf=udf).trip_co2_kgs()
+
+
+def benchmark(con, repeat=3):
+    """
+    Times SUM(trip_co2_kgs) over every trip with each model's SQL macro and
+    its UDF. Returns [(label, best seconds, total co2 kgs)], the constant
+    model's SQL first.
+    """
+    register(con)
+    variants = [(f"sql {name}", co2_sql(name)) for name in SQL_MODELS] + [
+        (f"udf {name}", co2_sql(name, udf=True)) for name in MODELS
+    ]
+    results = []
+    for label, expression in variants:
+        best, total = None, None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            total = con.execute(f"""
+                SELECT SUM({expression})
+                FROM trips t
+                JOIN fleets f ON f.taxi_type = t.taxi_type
+                JOIN vehicle_emissions ve ON ve.vehicle_type = f.vehicle_type;
+            """).fetchone()[0]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((label, best, total))
+        logger.info(f"Emissions model {label}: {best:.3f}s")
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the emissions model UDFs against their SQL macros"
+    )
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per variant; the fastest is reported")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    con = connect('analysis', database=DB_PATH, read_only=True)
+    trips = con.execute("SELECT COUNT(*) FROM trips;").fetchone()[0]
+    results = benchmark(con, args.repeat)
+    baseline = results[0][1]
+    print(f"{trips:,} trips")
+    for label, seconds, total in results:
+        print(f"{label:<16}{seconds:>9.3f}s{seconds / baseline:>8.1f}x{trips / seconds / 1e6:>9.1f}M trips/s"
+              f"{total:>20,.1f} kg")
@@ -0,0 +1,277 @@
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+# Downloads of large source files. A file is split into byte ranges fetched
+# over several connections into `<path>.part`; `<path>.part.json` records the
+# finished ranges so an interrupted download resumes where it stopped. Each
+# range is retried with exponential backoff, and the finished file must have
+# a readable parquet footer whose row groups lie inside the file before it is
+# renamed to `path`.
+
+PARQUET_MAGIC = b'PAR1'
+
+# HTTP statuses worth retrying; any other error status fails at once
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# Network errors worth retrying: dropped connections, timeouts, short reads
+RETRY_ERRORS = (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError)
+
+
+class FetchError(Exception):
+    """
+    Raised when a file cannot be downloaded intact within the allowed retries
+    """
+
+
+class CorruptParquet(FetchError):
+    """
+    Raised when a downloaded file is not a complete parquet file
+    """
+
+
+class SourceChanged(FetchError):
+    """
+    Raised when the upstream file changes while it is being downloaded
+    """
+
+
+def validate_parquet(path, expected_size=None):
+    """
+    Checks that `path` is a whole parquet file: the expected size, PAR1 magic at
+    both ends, a footer that parses, row group counts that add up, and every
+    column chunk inside the data section. Returns the footer's row count.
+    """
+    size = os.path.getsize(path)
+    if expected_size is not None and size != expected_size:
+        raise CorruptParquet(f"{path} has {size:,} bytes, expected {expected_size:,}")
+    if size < 12:
+        raise CorruptParquet(f"{path} is too small to be parquet ({size} bytes)")
+    with open(path, 'rb') as f:
+        head = f.read(4)
+        f.seek(-8, os.SEEK_END)
+        tail = f.read(8)
+    if head != PARQUET_MAGIC or tail[4:] != PARQUET_MAGIC:
+        raise CorruptParquet(f"{path} is missing the parquet magic bytes")
+    footer_length = int.from_bytes(tail[:4], 'little')
+    data_end = size - 8 - footer_length
+    if data_end < 4:
+        raise CorruptParquet(f"{path} has a footer length of {footer_length:,} bytes past the file start")
+
+    try:
+        metadata = pq.ParquetFile(path).metadata
+    except Exception as e:
+        raise CorruptParquet(f"{path} has an unreadable footer: {e}") from e
+    rows = 0
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        rows += row_group.num_rows
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            offsets = [column.data_page_offset]
+            if column.has_dictionary_page and column.dictionary_page_offset:
+                offsets.append(column.dictionary_page_offset)
+            start = min(offsets)
+            if start < 4 or start + column.total_compressed_size > data_end:
+                raise CorruptParquet(
+                    f"{path} row group {i} column {column.path_in_schema} lies outside the data section"
+                )
+    if rows != metadata.num_rows:
+        raise CorruptParquet(f"{path} row groups hold {rows:,} rows, footer says {metadata.num_rows:,}")
+    return metadata.num_rows
+
+
+class RangeFetcher:
+    """
+    Resumable parallel downloader for http(s) files.
+
+    Files are fetched as `chunk_bytes` ranges over up to `connections`
+    concurrent requests when the server supports ranges, else as one stream.
+    Each request is retried up to `retries` times, sleeping `backoff` * 2^n
+    seconds (with jitter) in between. Safe to share between threads.
+    """
+
+    def __init__(self, connections=4, chunk_bytes=16 * 1024**2, retries=5, backoff=1.0, timeout=60):
+        self.connections = connections
+        self.chunk_bytes = chunk_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def fetch(self, url, path):
+        """
+        Downloads `url` to `path` and validates it as parquet. Returns the
+        response headers needed to revalidate the file later: {size, etag,
+        last_modified}.
+        """
+        for attempt in range(self.retries + 1):
+            info = self.head(url)
+            try:
+                self._download(url, path + '.part', info)
+                validate_parquet(path + '.part', info['size'])
+                os.replace(path + '.part', path)
+                self._discard(path + '.part', keep_data=True)
+                return info
+            except (CorruptParquet, SourceChanged) as e:
+                # Resuming would keep the bad bytes, so start this file over
+                self._discard(path + '.part')
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Downloading {url} again from the start: {e}")
+        raise FetchError(f"Could not download {url}")
+
+    def head(self, url):
+        """
+        HEAD request for `url`, retried like the downloads. Returns {size,
+        etag, last_modified, ranges}.
+        """
+        return self._retry(url, self._head, url)
+
+    def _retry(self, url, call, *args):
+        """
+        Runs `call(*args)`, retrying transient network errors with backoff
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return call(*args)
+            except urllib.error.HTTPError as e:
+                if e.code not in RETRY_STATUSES or attempt == self.retries:
+                    raise FetchError(f"{url}: HTTP {e.code} {e.reason}") from e
+                error = e
+            except RETRY_ERRORS as e:
+                if attempt == self.retries:
+                    raise FetchError(f"{url}: {e}") from e
+                error = e
+            delay = self.backoff * 2 ** attempt * (1 + random.random())
+            logger.warning(f"Retrying {url} in {delay:.1f}s after: {error}")
+            time.sleep(delay)
+
+    def _head(self, url):
+        request = urllib.request.Request(url, method='HEAD')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            headers = response.headers
+            length = headers.get('Content-Length')
+            return {
+                'size': int(length) if length else None,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'ranges': headers.get('Accept-Ranges', '').lower() == 'bytes' and bool(length),
+            }
+
+    def _download(self, url, part, info):
+        if not info['ranges']:
+            self._discard(part)
+            self._retry(url, self._stream, url, part, info)
+            return
+
+        state = self._read_state(part, url, info)
+        chunks = [
+            (start, min(start + self.chunk_bytes, info['size']) - 1)
+            for start in range(0, info['size'], self.chunk_bytes)
+        ]
+        pending = [chunk for chunk in chunks if chunk[0] not in state['done']]
+        if len(pending) < len(chunks):
+            logger.info(f"Resuming {url}: {len(chunks) - len(pending)} of {len(chunks)} ranges already done")
+
+        mode = 'r+b' if os.path.exists(part) else 'wb'
+        lock = threading.Lock()
+        with open(part, mode) as f:
+            f.truncate(info['size'])
+            fd = f.fileno()
+
+            def fetch_chunk(chunk):
+                self._retry(url, self._get_range, url, fd, chunk, info)
+                with lock:
+                    state['done'].append(chunk[0])
+                    self._write_state(part, state)
+
+            with ThreadPoolExecutor(max_workers=self.connections) as pool:
+                # list() re-raises the first failed range
+                list(pool.map(fetch_chunk, pending))
+
+    def _get_range(self, url, fd, chunk, info):
+        start, end = chunk
+        request = urllib.request.Request(url, headers={'Range': f"bytes={start}-{end}"})
+        if info['etag']:
+            # The server sends the whole new file instead of a range if it changed
+            request.add_header('If-Range', info['etag'])
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if response.status != 206:
+                raise SourceChanged(f"{url} answered a range request with HTTP {response.status}")
+            offset = start
+            while offset <= end and (data := response.read(min(1 << 20, end + 1 - offset))):
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+        if offset != end + 1:
+            raise http.client.IncompleteRead(b'', end + 1 - offset)
+
+    def _stream(self, url, part, info):
+        """
+        Single-request download for servers without range support
+        """
+        size = 0
+        with open(part, 'wb') as out, urllib.request.urlopen(url, timeout=self.timeout) as response:
+            while chunk := response.read(1 << 20):
+                out.write(chunk)
+                size += len(chunk)
+        if info['size'] is not None and size != info['size']:
+            raise http.client.IncompleteRead(b'', info['size'] - size)
+
+    def _read_state(self, part, url, info):
+        """
+        Finished ranges of an earlier attempt, if it was the same file in the same chunks
+        """
+        state = {'url': url, 'size': info['size'], 'etag': info['etag'],
+                 'last_modified': info['last_modified'], 'chunk_bytes': self.chunk_bytes, 'done': []}
+        try:
+            with open(part + '.json') as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            return state
+        if os.path.exists(part) and all(previous.get(k) == v for k, v in state.items() if k != 'done'):
+            state['done'] = previous['done']
+        return state
+
+    def _write_state(self, part, state):
+        # Write to a temp file then rename so a crash never leaves a torn state file
+        tmp = part + '.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, part + '.json')
+
+    def _discard(self, part, keep_data=False):
+        paths = [part + '.json'] if keep_data else [part, part + '.json']
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Download a parquet file in parallel byte ranges")
+    parser.add_argument('url')
+    parser.add_argument('path', help="Where to write the file; an unfinished download resumes from <path>.part")
+    parser.add_argument('--connections', type=int, default=4, help="Ranges downloaded at once")
+    parser.add_argument('--chunk-mb', type=float, default=16, help="Size of each range in MB")
+    parser.add_argument('--retries', type=int, default=5, help="Retries per request")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    fetcher = RangeFetcher(connections=args.connections, chunk_bytes=int(args.chunk_mb * 1024**2),
+                           retries=args.retries)
+    info = fetcher.fetch(args.url, args.path)
+    print(f"Downloaded {args.url} ({info['size'] or os.path.getsize(args.path):,} bytes, "
+          f"{validate_parquet(args.path):,} rows) to {args.path}")
@@ -0,0 +1,428 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from connection import connect
+from ledger import TRIP_STATS, record_file_stats, record_partition, source_checksum
+from rules import record_rejects, rejection_case, valid_predicate
+from schema_registry import inspect_file, map_columns, select_list, select_names, signature
+from settings import source_url
+from storage import TRIPS_TABLE, discard_staging, stage_partitions, swap_partitions, trips_backend, write_partitions
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter shared by the fetch workers.
+    Allows short bursts of up to `capacity` requests, then `rate` requests per second.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available, then consumes it
+        """
+        # A rate of 0 or None disables limiting
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # Refill based on time elapsed since the last call
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_for = (1 - self.tokens) / self.rate
+            time.sleep(wait_for)
+
+
+def resolve_source(taxi_type, year, month, base=None, mirror=None):
+    """
+    Returns the path to read for one partition: the mirrored copy if a mirror
+    is in use, otherwise the source URL or fixture file
+    """
+    if mirror is not None:
+        return mirror.fetch(taxi_type, year, month)
+    return source_url(taxi_type, year, month, base)
+
+
+def network_request(taxi_type, year, month, base=None, mirror=None):
+    """
+    True when reading one partition goes to the network: a remote source file
+    not already in the mirror. Only these count against the rate limit.
+    """
+    if not source_url(taxi_type, year, month, base).startswith(('http://', 'https://', 's3://')):
+        return False
+    return mirror is None or mirror.entry(taxi_type, year, month) is None
+
+
+# One in-memory DuckDB connection per worker thread, used only for decoding
+_local = threading.local()
+
+
+# Each worker gets this share of the machine's memory and threads
+_worker_share = 1.0
+
+
+def _worker_connection():
+    if not hasattr(_local, 'con'):
+        _local.con = connect('load', database=':memory:', share=_worker_share)
+    return _local.con
+
+
+# Result of fetching one partition in a worker thread. `table` is None when the
+# source is unchanged; `rejects` maps rule name to rows dropped by filter-on-load
+# and `filtered` says whether the rules were applied at all. `stats` holds the
+# ledger.TRIP_STATS aggregates of `table` for load_file_stats.
+FetchedPartition = namedtuple('FetchedPartition', 'checksum table source_rows rejects filtered stats')
+
+
+def arrow_stats(table):
+    """
+    ledger.TRIP_STATS of a decoded batch, computed with Arrow kernels in the
+    worker that decoded it
+    """
+    distance, passengers = table['distance'], table['passenger_count']
+    return (
+        table.num_rows,
+        pc.sum(distance.cast(pa.float64())).as_py() or 0.0,
+        len(distance) - distance.null_count,
+        pc.sum(passengers.cast(pa.int64())).as_py() or 0,
+        len(passengers) - passengers.null_count,
+    )
+
+
+def fetch_partition(taxi_type, year, month, base=None, limiter=None, mirror=None, known=None,
+                    clean=False):
+    """
+    Fetches and decodes one monthly parquet file into an Arrow table with the
+    columns (pickup_datetime, dropoff_datetime, passenger_count, distance).
+    Runs inside a worker thread and never touches the emissions database.
+    When a mirror is given the file is read from (or first downloaded into) it.
+
+    If `known` is given and the source checksum matches it, the file is not
+    decoded. With `clean`, rows breaking a cleaning rule are dropped here and
+    counted per rule instead of being returned.
+    """
+    checksum = partition_checksum(taxi_type, year, month, base, limiter, mirror)
+    if known is not None and checksum == known:
+        return FetchedPartition(checksum, None, 0, {}, clean, None)
+
+    url = resolve_source(taxi_type, year, month, base, mirror)
+    con = _worker_connection()
+    mapping = map_columns(inspect_file(con, url))
+    table = con.execute(f"""
+        SELECT
+        {select_list(mapping)}
+        FROM read_parquet(?);
+    """, [url]).to_arrow_table()
+    if not clean:
+        return FetchedPartition(checksum, table, table.num_rows, {}, False, arrow_stats(table))
+
+    # Label each decoded row with the first rule it breaks, then split
+    con.register('decoded_batch', table)
+    try:
+        rejects = dict(con.execute(f"""
+            SELECT rejected_by, COUNT(*)
+            FROM (SELECT {rejection_case()} AS rejected_by FROM decoded_batch)
+            WHERE rejected_by IS NOT NULL
+            GROUP BY rejected_by;
+        """).fetchall())
+        valid = con.execute(f"""
+            SELECT * FROM decoded_batch WHERE {valid_predicate()};
+        """).to_arrow_table()
+    finally:
+        con.unregister('decoded_batch')
+    return FetchedPartition(checksum, valid, table.num_rows, rejects, True, arrow_stats(valid))
+
+
+def ingest_partitions(con, partitions, base=None, workers=4, rate=None, write=None,
+                      mirror=None, ledger=None, clean=False):
+    """
+    Fetches partitions through a bounded worker pool and appends each result
+    from the calling thread, so the database file only ever has one writer.
+
+    `write(con, taxi_type, year, month, fetched)` performs the append; by
+    default the partition's rows are replaced atomically and recorded in
+    load_ledger. Partitions whose checksum matches `ledger` are skipped.
+    With `clean`, invalid rows are filtered out in the workers (see rules.py).
+    At most 2 * workers decoded files are held in memory at once.
+    Returns (loaded, skipped, failed) lists of partitions.
+    """
+    write = write or replace_partition
+    ledger = ledger or {}
+    limiter = TokenBucket(rate, capacity=workers) if rate else None
+    pending = list(partitions)
+    in_flight = {}
+    loaded, skipped, failed = [], [], []
+
+    # Split the machine's memory and threads between the worker connections
+    global _worker_share
+    _worker_share = 1.0 / workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or in_flight:
+            # Keep the pool busy without decoding the whole backlog into memory
+            while pending and len(in_flight) < 2 * workers:
+                part = pending.pop(0)
+                future = pool.submit(
+                    fetch_partition, *part, base=base, limiter=limiter, mirror=mirror,
+                    known=ledger.get(part), clean=clean
+                )
+                in_flight[future] = part
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                part = in_flight.pop(future)
+                taxi_type, year, month = part
+                try:
+                    fetched = future.result()
+                    if fetched.table is None:
+                        skipped.append(part)
+                        logger.info(f"Skipped unchanged {taxi_type} trip data for {year}-{month}")
+                        continue
+                    write(con, taxi_type, year, month, fetched)
+                    loaded.append(part)
+                    logger.info(f"Added {taxi_type} trip data for {year}-{month} ({fetched.table.num_rows:,} rows)")
+                except Exception as e:
+                    failed.append(part)
+                    logger.error(f"Failed to load {taxi_type} trip data for {year}-{month}: {e}")
+
+    return loaded, skipped, failed
+
+
+def replace_partition(con, taxi_type, year, month, fetched):
+    """
+    Replaces one source partition's rows, reject counts and ledger entry in a
+    single transaction, so readers never see a half-loaded month
+    """
+    con.register('partition_batch', fetched.table)
+    params = [taxi_type, int(year), int(month)]
+    batch = """
+        SELECT ?::taxi_type_enum AS taxi_type,
+        pickup_datetime, dropoff_datetime, passenger_count, distance,
+        ?::SMALLINT AS source_year, ?::UTINYINT AS source_month
+        FROM partition_batch
+    """
+    try:
+        con.execute("BEGIN TRANSACTION;")
+        if trips_backend(con) == 'parquet':
+            write_partitions(con, batch, params, replace=[tuple(params)])
+        else:
+            con.execute(f"""
+                DELETE FROM {TRIPS_TABLE}
+                WHERE taxi_type = ? AND source_year = ? AND source_month = ?;
+            """, params)
+            con.execute(f"INSERT INTO {TRIPS_TABLE} BY NAME {batch};", params)
+        if fetched.filtered:
+            record_rejects(con, taxi_type, year, month, fetched.rejects)
+        record_partition(
+            con, taxi_type, year, month, fetched.checksum, fetched.source_rows,
+            filtered=fetched.filtered
+        )
+        record_file_stats(con, taxi_type, year, month, fetched.source_rows, fetched.stats)
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    finally:
+        con.unregister('partition_batch')
+
+
+def partition_checksum(taxi_type, year, month, base=None, limiter=None, mirror=None):
+    """
+    Source checksum of one partition (see ledger.source_checksum), waiting
+    for the rate limit first when it needs a network request
+    """
+    if limiter is not None and network_request(taxi_type, year, month, base, mirror):
+        limiter.acquire()
+    return source_checksum(taxi_type, year, month, base, mirror)
+
+
+def inspect_partition(taxi_type, year, month, base=None, limiter=None, mirror=None):
+    """
+    Resolves one partition and reads only its parquet footer.
+    Returns (path, column names, footer row count).
+    """
+    if limiter is not None and network_request(taxi_type, year, month, base, mirror):
+        limiter.acquire()
+    path = resolve_source(taxi_type, year, month, base, mirror)
+    con = _worker_connection()
+    names = signature(map_columns(inspect_file(con, path)))
+    row_count = con.execute("""
+        SELECT SUM(num_rows) FROM parquet_file_metadata(?);
+    """, [path]).fetchone()[0]
+    return path, names, row_count
+
+
+def ingest_multi_file(con, partitions, base=None, workers=4, rate=None, mirror=None, ledger=None,
+                      clean=False):
+    """
+    Loads partitions with a few multi-file scans instead of one INSERT per file.
+
+    Source checksums are read first, so unchanged partitions are skipped before
+    any download; with TemporaryDownloads the free space for the changed files
+    is checked before the first one is fetched. Footers are then inspected in
+    parallel and files are grouped by fleet and source
+    column names; each group is read with a single union_by_name read_parquet
+    call so DuckDB can parallelize across files and row groups. All changed
+    partitions are replaced and recorded in load_ledger in one transaction;
+    with parquet storage the new partition directories are staged and only
+    swapped in right before it commits.
+
+    Each group's files are read once into a temp table (spilled to disk when
+    large); the load_file_stats of each file, and with `clean` the rows
+    breaking a cleaning rule counted per rule and partition into load_rejects,
+    are aggregated from it, and only its valid rows are written.
+    Returns (loaded, skipped, failed) lists of partitions.
+    """
+    ledger = ledger or {}
+    limiter = TokenBucket(rate, capacity=workers) if rate else None
+    loaded, skipped, failed = [], [], []
+    groups = {}
+
+    # Split the machine's memory and threads between the worker connections
+    global _worker_share
+    _worker_share = 1.0 / workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(partition_checksum, *part, base=base, limiter=limiter, mirror=mirror): part
+            for part in partitions
+        }
+        checksums = {}
+        for future, part in futures.items():
+            try:
+                checksum = future.result()
+            except Exception as e:
+                failed.append(part)
+                logger.error(f"Failed to check {part[0]} trip data for {part[1]}-{part[2]}: {e}")
+                continue
+            if checksum == ledger.get(part):
+                skipped.append(part)
+            else:
+                checksums[part] = checksum
+
+        # Temporary downloads of the whole load are on disk at once
+        if mirror is not None and not mirror.persistent:
+            mirror.reserve(list(checksums))
+
+        futures = {
+            pool.submit(inspect_partition, *part, base=base, limiter=limiter, mirror=mirror): part
+            for part in checksums
+        }
+        for future, part in futures.items():
+            try:
+                path, names, row_count = future.result()
+            except Exception as e:
+                failed.append(part)
+                logger.error(f"Failed to inspect {part[0]} trip data for {part[1]}-{part[2]}: {e}")
+                continue
+            groups.setdefault((part[0], names), []).append((part, checksums[part], path, row_count))
+
+    if not groups:
+        return loaded, skipped, failed
+
+    for (taxi_type, names), files in groups.items():
+        if len(groups) > 1:
+            logger.info(f"{len(files)} {taxi_type} files use source columns {names}")
+
+    # Parquet output of every group, swapped into the warehouse only once all
+    # SQL work succeeded, so a rollback never leaves new partition directories
+    staged = []
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        con.execute("""
+            CREATE OR REPLACE TEMP TABLE scan_files (
+                taxi_type VARCHAR, path VARCHAR, source_year SMALLINT, source_month UTINYINT
+            );
+        """)
+        for (taxi_type, names), files in groups.items():
+            con.executemany(
+                "INSERT INTO scan_files VALUES (?, ?, ?, ?);",
+                [[taxi_type, path, int(y), int(m)] for (_, y, m), _, path, _ in files]
+            )
+
+        # Clear every partition being replaced before any new rows go in
+        if trips_backend(con) == 'table':
+            con.execute(f"""
+                DELETE FROM {TRIPS_TABLE}
+                WHERE (taxi_type, source_year, source_month) IN (
+                    SELECT (taxi_type::taxi_type_enum, source_year, source_month) FROM scan_files
+                );
+            """)
+
+        for (taxi_type, names), files in groups.items():
+            paths = [path for _, _, path, _ in files]
+            scan = f"""
+                SELECT
+                s.taxi_type::taxi_type_enum AS taxi_type,
+                {select_names(names, 'f')},
+                s.source_year,
+                s.source_month
+                FROM read_parquet(?, union_by_name = true, filename = true) f
+                JOIN scan_files s ON s.path = f.filename AND s.taxi_type = ?
+            """
+            # Read the group's files once; the stats, reject counts and rows
+            # written all come from this staged copy
+            con.execute(f"CREATE OR REPLACE TEMP TABLE scan_group AS {scan};", [paths, taxi_type])
+            valid = f"WHERE {valid_predicate()}" if clean else ""
+            stats = {
+                (year, month): tuple(values)
+                for year, month, *values in con.execute(f"""
+                    SELECT source_year, source_month, {TRIP_STATS}
+                    FROM scan_group {valid}
+                    GROUP BY ALL;
+                """).fetchall()
+            }
+            counts = {}
+            if clean:
+                # Junk rows are only counted per rule, never written
+                for year, month, rule, count in con.execute(f"""
+                    SELECT source_year, source_month, rejected_by, COUNT(*)
+                    FROM (SELECT source_year, source_month, {rejection_case()} AS rejected_by FROM scan_group)
+                    WHERE rejected_by IS NOT NULL
+                    GROUP BY ALL;
+                """).fetchall():
+                    counts.setdefault((year, month), {})[rule] = count
+            for (_, year, month), _, _, row_count in files:
+                key = (int(year), int(month))
+                if clean:
+                    record_rejects(con, taxi_type, year, month, counts.get(key, {}))
+                record_file_stats(con, taxi_type, year, month, row_count, stats.get(key, (0, 0.0, 0, 0, 0)))
+
+            rows = f"SELECT * FROM scan_group {valid}"
+            if trips_backend(con) == 'parquet':
+                staged.append(stage_partitions(
+                    con, rows, replace=[(t, int(y), int(m)) for (t, y, m), _, _, _ in files]
+                ))
+            else:
+                con.execute(f"INSERT INTO {TRIPS_TABLE} BY NAME {rows};")
+            con.execute("DROP TABLE scan_group;")
+            for part, checksum, _, row_count in files:
+                record_partition(con, *part, checksum, row_count, filtered=clean)
+                loaded.append(part)
+            logger.info(f"Added {len(files)} {taxi_type} trip files in one scan")
+
+        while staged:
+            swap_partitions(con, *staged.pop(0))
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        for staging, _ in staged:
+            discard_staging(staging)
+        raise
+
+    return loaded, skipped, failed
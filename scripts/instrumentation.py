@@ -0,0 +1,245 @@
+import argparse
+import atexit
+import duckdb
+import functools
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+from settings import METRICS_FILE, QUERY_PROFILE
+
+logger = logging.getLogger(__name__)
+
+# One id per process, so records of one script run can be grouped
+RUN_ID = uuid.uuid4().hex[:12]
+
+# Statements whose result is only the number of rows they changed
+_COUNTING = re.compile(r"^\s*(INSERT|UPDATE|DELETE|COPY|CREATE\s+(OR\s+REPLACE\s+)?(TEMP\s+|TEMPORARY\s+)?TABLE\s+\S+\s+AS)\b",
+                       re.IGNORECASE)
+
+_lock = threading.Lock()
+_current_stage = None
+
+
+def write_record(record, path=None):
+    """
+    Appends one metrics record to the JSON lines file
+    """
+    record = dict(record, run_id=RUN_ID, recorded_at=time.time())
+    with _lock:
+        with open(path or METRICS_FILE, 'a') as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+def _operators(node, depth=0):
+    """
+    Flattens DuckDB's JSON profile tree into [{operator, timing, cardinality, depth}]
+    """
+    operators = []
+    for child in node.get('children', []):
+        operators.append({
+            'operator': child.get('operator_name') or child.get('operator_type'),
+            'timing': child.get('operator_timing'),
+            'cardinality': child.get('operator_cardinality'),
+            'rows_scanned': child.get('operator_rows_scanned'),
+            'depth': depth,
+        })
+        operators.extend(_operators(child, depth + 1))
+    return operators
+
+
+class InstrumentedConnection:
+    """
+    Wraps a DuckDB connection so every execute/executemany is timed and
+    written to the metrics file with its stage, label and rows affected.
+
+    The label defaults to the calling function and line. Statements that only
+    return a changed-row count (INSERT, UPDATE, DELETE, COPY, CREATE TABLE AS)
+    have that count read into `rowcount`; their result is consumed.
+    With `profile`, DuckDB's JSON profile (operator timings and cardinalities)
+    is stored with each record. DuckDB only completes a profile once the result
+    has been fetched, so in that mode a record is written when the next
+    statement starts (or at exit). Everything else is passed to the connection.
+    """
+
+    def __init__(self, con, stage=None, profile=QUERY_PROFILE, metrics_file=None):
+        self._con = con
+        self.stage = stage
+        self.profile = profile
+        self.metrics_file = metrics_file
+        self.rowcount = -1
+        self._pending = None
+        if profile:
+            con.execute("SET enable_profiling = 'no_output';")
+            atexit.register(self._flush)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def _label(self):
+        frame = sys._getframe(2)
+        return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}"
+
+    def _record(self, sql, label, started, wall, rows, error=None):
+        record = {
+            'kind': 'query',
+            'stage': self.stage or _current_stage,
+            'label': label,
+            'sql': re.sub(r"\s+", " ", sql).strip()[:1000],
+            'started_at': started,
+            'wall_s': wall,
+            'rows': rows,
+            'error': error,
+        }
+        if self.profile and error is None:
+            self._pending = record
+        else:
+            write_record(record, self.metrics_file)
+
+    def _flush(self):
+        """
+        Writes the pending record of the previous statement with its profile
+        """
+        record, self._pending = self._pending, None
+        if record is None:
+            return
+        try:
+            info = json.loads(self._con.get_profiling_information(format='json'))
+            record['profile'] = {
+                'latency': info.get('latency'),
+                'cpu_time': info.get('cpu_time'),
+                'rows_returned': info.get('rows_returned'),
+                'cumulative_cardinality': info.get('cumulative_cardinality'),
+                'peak_buffer_memory': info.get('system_peak_buffer_memory'),
+                'peak_temp_dir_size': info.get('system_peak_temp_dir_size'),
+                'operators': _operators(info),
+            }
+            if record['rows'] is None:
+                record['rows'] = info.get('rows_returned')
+        except (duckdb.Error, ValueError):
+            pass  # statements like BEGIN/COMMIT have no profile
+        write_record(record, self.metrics_file)
+
+    def execute(self, sql, parameters=None, label=None):
+        label = label or self._label()
+        self._flush()
+        started, start = time.time(), time.perf_counter()
+        try:
+            result = self._con.execute(sql, parameters or [])
+        except Exception as e:
+            self._record(sql, label, started, time.perf_counter() - start, None, error=str(e))
+            raise
+        rows = None
+        if _COUNTING.match(sql):
+            row = result.fetchone()
+            rows = self.rowcount = row[0] if row else 0
+        self._record(sql, label, started, time.perf_counter() - start, rows)
+        return result
+
+    def executemany(self, sql, parameters=None, label=None):
+        label = label or self._label()
+        self._flush()
+        started, start = time.time(), time.perf_counter()
+        try:
+            result = self._con.executemany(sql, parameters or [])
+        except Exception as e:
+            self._record(sql, label, started, time.perf_counter() - start, None, error=str(e))
+            raise
+        self._record(sql, label, started, time.perf_counter() - start, len(parameters or []))
+        return result
+
+
+def instrument(con, stage=None):
+    """
+    Returns `con` wrapped in an InstrumentedConnection
+    """
+    return InstrumentedConnection(con, stage=stage)
+
+
+def timed_stage(stage):
+    """
+    Decorator recording the wall time of a pipeline stage. Queries run inside
+    it without an explicit stage are attributed to it.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global _current_stage
+            _current_stage = stage
+            started, start = time.time(), time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                write_record({'kind': 'stage', 'stage': stage, 'label': func.__name__,
+                              'started_at': started, 'wall_s': time.perf_counter() - start})
+                _current_stage = None
+        return wrapper
+    return decorate
+
+
+def summary(path=None, top=10, stage=None, all_runs=False):
+    """
+    Prints the top-N slowest statements per stage, aggregated by label.
+    By default only the latest run of each stage is included.
+    """
+    con = duckdb.connect()
+    con.execute("""
+        CREATE TABLE metrics AS
+        SELECT * FROM read_json(?, format = 'newline_delimited', columns = {
+            'kind': 'VARCHAR', 'run_id': 'VARCHAR', 'stage': 'VARCHAR', 'label': 'VARCHAR',
+            'sql': 'VARCHAR', 'started_at': 'DOUBLE', 'wall_s': 'DOUBLE', 'rows': 'BIGINT',
+            'error': 'VARCHAR'
+        });
+    """, [path or METRICS_FILE])
+    runs = "" if all_runs else """
+        AND run_id IN (
+            SELECT arg_max(run_id, started_at) FROM metrics WHERE kind = 'stage' GROUP BY stage
+        )
+    """
+    where = f"stage = '{stage}'" if stage else "true"
+
+    for name, wall_s, label in con.execute(f"""
+        SELECT stage, wall_s, label FROM metrics
+        WHERE kind = 'stage' AND {where} {runs}
+        ORDER BY started_at;
+    """).fetchall():
+        print(f"Stage {name} ({label}): {wall_s:.2f}s")
+
+    rows = con.execute(f"""
+        SELECT stage, label, COUNT(*) AS calls, SUM(wall_s) AS total_s, MAX(wall_s) AS max_s,
+        SUM(rows) AS rows, COUNT(error) AS errors, any_value(sql) AS sql
+        FROM metrics
+        WHERE kind = 'query' AND {where} {runs}
+        GROUP BY stage, label
+        QUALIFY row_number() OVER (PARTITION BY stage ORDER BY SUM(wall_s) DESC) <= {int(top)}
+        ORDER BY stage, total_s DESC;
+    """).fetchall()
+    current = None
+    for name, label, calls, total_s, max_s, row_count, errors, sql in rows:
+        if name != current:
+            current = name
+            print(f"\nTop {top} statements in {name or 'unknown'} stage")
+            print(f"{'total s':>9} {'max s':>8} {'calls':>6} {'rows':>12}  label")
+        print(f"{total_s:>9.3f} {max_s:>8.3f} {calls:>6} {row_count if row_count is not None else '':>12}  "
+              f"{label}{' (' + str(errors) + ' errors)' if errors else ''}")
+        print(f"{'':>40}{sql[:100]}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Summarize the query metrics of the pipeline scripts")
+    parser.add_argument('--file', default=METRICS_FILE, help="Metrics JSON lines file")
+    parser.add_argument('--top', type=int, default=10, help="Statements listed per stage")
+    parser.add_argument('--stage', default=None, help="Only this stage (load, clean, analysis)")
+    parser.add_argument('--all-runs', action='store_true',
+                        help="Aggregate every recorded run instead of the latest run of each stage")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    summary(args.file, top=args.top, stage=args.stage, all_runs=args.all_runs)
@@ -0,0 +1,245 @@
+import hashlib
+import logging
+
+from fetcher import RangeFetcher
+from settings import source_url
+from storage import TRIPS_TABLE
+
+logger = logging.getLogger(__name__)
+
+
+def create_ledger(con):
+    """
+    Creates the load_ledger table recording which source partitions are loaded
+    """
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS load_ledger (
+            taxi_type VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            source_checksum VARCHAR,
+            row_count BIGINT,
+            loaded_at TIMESTAMP,
+            PRIMARY KEY (taxi_type, year, month)
+        );
+    """)
+    # True when the cleaning rules were applied while loading (filter-on-load mode);
+    # clean.py then only deduplicates the partition (see pending_clean)
+    con.execute("""
+        ALTER TABLE load_ledger ADD COLUMN IF NOT EXISTS filtered BOOLEAN DEFAULT false;
+    """)
+    # Last time clean.py removed rows from the partition; with loaded_at this
+    # tells the incremental dbt models which partitions to recompute
+    con.execute("""
+        ALTER TABLE load_ledger ADD COLUMN IF NOT EXISTS cleaned_at TIMESTAMP;
+    """)
+
+
+def read_ledger(con):
+    """
+    Returns {(taxi_type, year, month): source_checksum} for every loaded partition
+    """
+    rows = con.execute("""
+        SELECT taxi_type, year, month, source_checksum FROM load_ledger;
+    """).fetchall()
+    return {(t, y, f"{m:02d}"): checksum for t, y, m, checksum in rows}
+
+
+def record_partition(con, taxi_type, year, month, checksum, row_count, filtered=False):
+    """
+    Upserts the ledger entry for one partition. Called inside the same
+    transaction that replaces the partition's rows.
+    """
+    con.execute("""
+        INSERT OR REPLACE INTO load_ledger
+            (taxi_type, year, month, source_checksum, row_count, loaded_at, filtered)
+        VALUES (?, ?, ?, ?, ?, current_timestamp, ?);
+    """, [taxi_type, int(year), int(month), checksum, row_count, filtered])
+
+
+# Aggregates kept per loaded file in load_file_stats, after source_rows:
+# loaded_rows, distance_sum, distance_values, passengers_sum, passengers_values
+TRIP_STATS = """
+    COUNT(*), SUM(distance)::DOUBLE, COUNT(distance),
+    SUM(passenger_count)::BIGINT, COUNT(passenger_count)
+"""
+
+
+def create_file_stats(con):
+    """
+    Creates the load_file_stats table: per source file, its footer row count
+    and the rows, sums and non-null counts of the trips loaded from it, written
+    with the partition's rows. Load summaries and raw row counts merge these
+    instead of scanning trips.
+    """
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS load_file_stats (
+            taxi_type VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            source_rows BIGINT,
+            loaded_rows BIGINT,
+            distance_sum DOUBLE,
+            distance_values BIGINT,
+            passengers_sum BIGINT,
+            passengers_values BIGINT,
+            loaded_at TIMESTAMP,
+            PRIMARY KEY (taxi_type, year, month)
+        );
+    """)
+
+
+def record_file_stats(con, taxi_type, year, month, source_rows, stats):
+    """
+    Upserts one file's stats; `stats` holds the TRIP_STATS aggregates in order.
+    Called inside the transaction that replaces the partition's rows.
+    """
+    con.execute("""
+        INSERT OR REPLACE INTO load_file_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, current_timestamp);
+    """, [taxi_type, int(year), int(month), source_rows, *stats])
+
+
+def measure_partitions(con, partitions):
+    """
+    TRIP_STATS of loaded (taxi_type, year, month) partitions, from trips.
+    Returns {partition: stats}; partitions without rows get zeros.
+    """
+    con.execute("""
+        CREATE OR REPLACE TEMP TABLE measured_partitions (taxi_type VARCHAR, year INTEGER, month INTEGER);
+    """)
+    con.executemany(
+        "INSERT INTO measured_partitions VALUES (?, ?, ?);",
+        [[taxi_type, int(year), int(month)] for taxi_type, year, month in partitions]
+    )
+    rows = con.execute(f"""
+        SELECT taxi_type::VARCHAR, source_year, source_month, {TRIP_STATS}
+        FROM {TRIPS_TABLE}
+        WHERE (taxi_type::VARCHAR, source_year, source_month) IN (SELECT * FROM measured_partitions)
+        GROUP BY ALL;
+    """).fetchall()
+    measured = {(t, int(y), int(m)): tuple(stats) for t, y, m, *stats in rows}
+    return {
+        (t, y, m): measured.get((t, int(y), int(m)), (0, 0.0, 0, 0, 0))
+        for t, y, m in partitions
+    }
+
+
+def fleet_summary(con):
+    """
+    Returns [(taxi_type, trips, avg_distance, avg_passengers)] for the loaded
+    trips, merged from load_file_stats. Partitions loaded before the table
+    existed are measured from trips once and recorded.
+    """
+    missing = con.execute("""
+        SELECT taxi_type, year, month, row_count FROM load_ledger
+        ANTI JOIN load_file_stats USING (taxi_type, year, month);
+    """).fetchall()
+    if missing:
+        logger.info(f"Measuring {len(missing)} partitions loaded without file stats")
+        measured = measure_partitions(con, [row[:3] for row in missing])
+        for taxi_type, year, month, row_count in missing:
+            record_file_stats(con, taxi_type, year, month, row_count, measured[(taxi_type, year, month)])
+    return con.execute("""
+        SELECT taxi_type,
+        SUM(loaded_rows)::BIGINT,
+        SUM(distance_sum) / NULLIF(SUM(distance_values), 0),
+        SUM(passengers_sum) / NULLIF(SUM(passengers_values), 0)
+        FROM load_file_stats
+        GROUP BY taxi_type
+        ORDER BY taxi_type::taxi_type_enum;
+    """).fetchall()
+
+
+def mark_cleaned(con, partitions):
+    """
+    Stamps cleaned_at on the given (taxi_type, year, month) partitions
+    """
+    for taxi_type, year, month in partitions:
+        con.execute("""
+            UPDATE load_ledger SET cleaned_at = current_timestamp
+            WHERE taxi_type = ? AND year = ? AND month = ?;
+        """, [taxi_type, int(year), int(month)])
+
+
+def source_checksum(taxi_type, year, month, base=None, mirror=None):
+    """
+    Returns a version token for one source file without decoding it.
+    Mirrored files use their sha256, local files are hashed, and other remote
+    files (including TemporaryDownloads) use the ETag/Last-Modified/Content-Length
+    of a HEAD request, so unchanged files are skipped before any download. The
+    HEAD goes through the mirror's RangeFetcher, so it is retried the same way.
+    """
+    if mirror is not None and mirror.persistent:
+        mirror.fetch(taxi_type, year, month)
+        entry = mirror.entry(taxi_type, year, month)
+        if entry is not None:
+            return f"sha256:{entry['sha256']}"
+
+    url = source_url(taxi_type, year, month, base)
+    if url.startswith(('http://', 'https://')):
+        info = mirror.head(taxi_type, year, month) if mirror is not None else RangeFetcher().head(url)
+        return "http:" + "|".join(
+            '' if info[k] is None else str(info[k]) for k in ('etag', 'last_modified', 'size')
+        )
+
+    digest = hashlib.sha256()
+    with open(url, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+
+def create_clean_checkpoints(con):
+    """
+    Creates the clean_checkpoints table: one row per partition clean.py has
+    finished, committed in the same transaction as the partition's cleaned rows
+    """
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS clean_checkpoints (
+            taxi_type VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            loaded_at TIMESTAMP,
+            rules VARCHAR,
+            dedupe VARCHAR,
+            rejected_rows BIGINT,
+            duplicate_rows BIGINT,
+            completed_at TIMESTAMP,
+            PRIMARY KEY (taxi_type, year, month)
+        );
+    """)
+
+
+def pending_clean(con, rules, dedupe):
+    """
+    Returns the (taxi_type, year, month, filtered) partitions still to clean,
+    oldest first: those without a checkpoint for their current load, for the
+    current `rules` version, or with duplicates left in when `dedupe` asks for
+    removal. `filtered` is true when the load applied the cleaning rules and
+    the partition was not cleaned since, so only deduplication is left to do.
+    """
+    return con.execute("""
+        SELECT l.taxi_type, l.year, l.month,
+        coalesce(l.filtered, false) AND c.loaded_at IS DISTINCT FROM l.loaded_at
+        FROM load_ledger l
+        LEFT JOIN clean_checkpoints c
+          ON c.taxi_type = l.taxi_type AND c.year = l.year AND c.month = l.month
+        WHERE c.taxi_type IS NULL
+        OR c.loaded_at IS DISTINCT FROM l.loaded_at
+        OR c.rules != ?
+        OR (c.dedupe = 'off' AND ? != 'off')
+        ORDER BY l.year, l.month, l.taxi_type;
+    """, [rules, dedupe]).fetchall()
+
+
+def record_clean(con, partition, rules, dedupe, rejected, duplicates):
+    """
+    Checkpoints one cleaned partition against its current ledger load
+    """
+    taxi_type, year, month = partition
+    con.execute("""
+        INSERT OR REPLACE INTO clean_checkpoints
+        SELECT taxi_type, year, month, loaded_at, ?, ?, ?, ?, current_timestamp
+        FROM load_ledger
+        WHERE taxi_type = ? AND year = ? AND month = ?;
+    """, [rules, dedupe, rejected, duplicates, taxi_type, int(year), int(month)])
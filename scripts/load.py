@@ -1,7 +1,15 @@
-import duckdb
-import os
+import argparse
 import logging
-import time
+
+from connection import connect
+from ingest import ingest_multi_file, ingest_partitions
+from instrumentation import timed_stage
+from ledger import create_file_stats, create_ledger, fleet_summary, read_ledger
+from fetcher import RangeFetcher
+from mirror import ParquetMirror, TemporaryDownloads
+from rules import create_rejects_table
+from settings import MIRROR_DIR, SOURCE_BASE, STORAGE_BACKEND, TAXI_TYPES, YEARS, partitions
+from storage import create_trips
 
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
@@ -10,148 +18,150 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-# Initial files used to load in January 2024, build out schema for tables
-yellowtrip_file = "https://d37ci6vzurychx.cloudfront.net/trip-data/yellow_tripdata_2024-01.parquet"
-greentrip_file = "https://d37ci6vzurychx.cloudfront.net/trip-data/green_tripdata_2024-01.parquet"
-
-def load_parquet_files():
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load TLC trip data into DuckDB")
+    parser.add_argument('--source', default=SOURCE_BASE,
+                        help="Base URL or local directory holding the monthly parquet files")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Maximum number of files fetched and decoded at once")
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help="Maximum requests per second to a remote source (0 disables the limit)")
+    parser.add_argument('--mirror', default=MIRROR_DIR,
+                        help="Directory of the local parquet mirror; without a mirror, http(s) files "
+                             "are downloaded to temporary files deleted after the load, which need free "
+                             "space for every file loaded (about 50-150 MB per month and fleet)")
+    parser.add_argument('--mirror-max-gb', type=float, default=None,
+                        help="Evict least recently used mirrored files beyond this size "
+                             "(mirrors to ./mirror unless --mirror is given)")
+    parser.add_argument('--offline', action='store_true',
+                        help="Only read files already in the mirror, never touch the network")
+    parser.add_argument('--revalidate', action='store_true',
+                        help="Check mirrored files against the upstream ETag before using them")
+    parser.add_argument('--connections', type=int, default=4,
+                        help="Byte ranges of one file downloaded at once")
+    parser.add_argument('--retries', type=int, default=5,
+                        help="Retries per download request before a file counts as failed")
+    parser.add_argument('--scan', choices=['multi-file', 'per-file'], default='multi-file',
+                        help="Load with a few multi-file scans or one concurrent fetch per file")
+    parser.add_argument('--clean-on-load', action='store_true',
+                        help="Apply the cleaning rules while loading instead of in clean.py")
+    parser.add_argument('--storage', choices=['table', 'parquet'], default=STORAGE_BACKEND,
+                        help="Store trips in DuckDB tables or hive-partitioned parquet files")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only load partitions that are new or changed since the last load")
+    parser.add_argument('--years', type=int, nargs='+', default=YEARS,
+                        help="Years to load (default: all of 2015-2024)")
+    return parser.parse_args()
+
+
+@timed_stage('load')
+def load_parquet_files(source=None, workers=4, rate=1.0, mirror=None, incremental=False,
+                       scan='multi-file', clean_on_load=False, storage=STORAGE_BACKEND, years=None):
     """
     Loads yellow and green taxi trip data for years 2015-2024 into DuckDB tables
     Also loads vehicle emissions data from CSV file
+
+    Monthly files are fetched and decoded concurrently by `workers` threads,
+    throttled to `rate` requests per second, and appended by a single writer.
+    If a ParquetMirror is given, files are read from the local mirror instead;
+    `mirror` may also be TemporaryDownloads, which fetches remote files for
+    this load only.
+
+    With `incremental`, only partitions missing from load_ledger or whose source
+    checksum changed are loaded, each replaced in its own transaction.
+
+    The default `scan='multi-file'` maps every file onto the canonical schema
+    via its parquet footer and reads them in a few union_by_name scans;
+    'per-file' decodes each file separately in the worker pool.
+
+    With `clean_on_load`, the rules in rules.py filter rows during the scan and
+    rejected rows are only counted in load_rejects; clean.py then skips its
+    delete pass for those partitions.
+
+    All fleets go into one `trips` table keyed by a taxi_type enum, with
+    yellow_tripdata/green_tripdata kept as views. With `storage='parquet'`,
+    trips are written as taxi_type=/year=/month= partitioned parquet under the
+    warehouse directory and `trips` is a view over the files.
+
+    Row counts, sums and non-null counts of every loaded file are kept in
+    load_file_stats, and the closing summary is merged from them rather than
+    scanned from trips.
     """
 
     con = None
-    # Creating list of months with proper formatting
-    all_months = [f"{i:02d}" for i in range(1, 13)] 
-    years = list(range(2015, 2025)) # Years 2015 through 2024
 
     try:
-        # Connect to local DuckDB instance
-        con = duckdb.connect(database='emissions.duckdb', read_only=False)
+        # Connect to local DuckDB instance, sized for this machine (see connection.py)
+        con = connect('load')
         logger.info("Connected to DuckDB instance")
 
-        # Dropping yellow trip if pre-existing
+        create_ledger(con)
+        create_file_stats(con)
+        create_rejects_table(con)
 
-        ## Checking if yellow trip table exists
-        con.execute(f"""
-            DROP TABLE IF EXISTS yellow_tripdata;
-        """)
-        logger.info("Dropped yellow trip table if exists")
-
-        ## Checking if green trip table exists
-        con.execute("""
-            DROP TABLE IF EXISTS green_tripdata;
-        """)
-        logger.info("Dropped green trip table if exists")
+        # A full load drops and recreates the trips table; an incremental load keeps it
+        if not incremental:
+            con.execute("DELETE FROM load_ledger;")
+            con.execute("DELETE FROM load_file_stats;")
+        create_trips(con, storage=storage, full=not incremental)
+        logger.info(f"Set up trips table ({storage} storage) and per-fleet views")
 
         con.execute("""
             DROP TABLE IF EXISTS vehicle_emissions;
         """)
         logger.info("Dropped vehicle emissions table if exists")
 
-        # Creating tables
-
-        ## Yellow trip table, only reading in needed variables
-        # This originally creates the table with only 2024-01 data.
-        con.execute(f"""
-                    CREATE TABLE yellow_tripdata AS
-                    SELECT
-                    --- renaming pickup and dropoff for consistency between tables
-                    tpep_pickup_datetime AS pickup_datetime, 
-                    tpep_dropoff_datetime AS dropoff_datetime,
-                    passenger_count,
-                    trip_distance AS distance
-                    FROM read_parquet('{yellowtrip_file}');
-                    """)
-        logger.info("Imported yellow trip parquet file to DuckDB table")
-
-        ## Green trip table
-        # This originally creates the table with only 2024-01 data.
-        con.execute(f"""
-                    CREATE TABLE green_tripdata AS
-                    SELECT 
-                    lpep_pickup_datetime AS pickup_datetime, 
-                    lpep_dropoff_datetime AS dropoff_datetime,
-                    passenger_count,
-                    trip_distance AS distance
-                    FROM read_parquet('{greentrip_file}');
-                    """)
-        logger.info("Imported green trip parquet file to DuckDB table")
-
         ## Carbon Emissions Table, read from local csv file
         con.execute("""
             CREATE TABLE vehicle_emissions
                 AS
             SELECT
             vehicle_type,
-            co2_grams_per_mile
+            co2_grams_per_mile,
+            mpg_city,
+            mpg_highway
             FROM read_csv('data/vehicle_emissions.csv');
         """)
         logger.info("Imported emissions csv file to DuckDB table")
 
-        # Loop over files to add all years, skips 01 2024(used to create table originally)
-        for year in years:
-            for month in all_months:
-                # Skip the first month of 2024 since it was used for CREATE TABLE
-                if year == 2024 and month == '01':
-                    continue
-
-                # URL for parquet files, updated for each month/year for every iteration
-                yellow_url = f"https://d37ci6vzurychx.cloudfront.net/trip-data/yellow_tripdata_{year}-{month}.parquet"
-                green_url = f"https://d37ci6vzurychx.cloudfront.net/trip-data/green_tripdata_{year}-{month}.parquet"
-
-                ## Reading parquet and inserting into yellowtrip table
-                con.execute(f"""
-                INSERT INTO yellow_tripdata
-                SELECT tpep_pickup_datetime, tpep_dropoff_datetime, 
-                passenger_count, trip_distance
-                FROM read_parquet('{yellow_url}');
-                """)
-                logger.info(f"Added yellow trip data for {year}-{month}")
-
-                ## Reading parquet and inserting into greentrip table
-                con.execute(f"""
-                INSERT INTO green_tripdata
-                SELECT lpep_pickup_datetime, lpep_dropoff_datetime, 
-                passenger_count, trip_distance
-                FROM read_parquet('{green_url}');
-                """)
-                logger.info(f"Added green trip data for {year}-{month}")
-
-                # Breaking for 30 seconds between iterations to not overload
-                time.sleep(30)
-                logger.info(f'Pausing for 30 seconds after {year}-{month}') 
-                                
-        ## Counting rows from each table, saving to vars
-
-        # Fetching raw row counts
-        yellow_count = con.execute("SELECT COUNT(*) FROM yellow_tripdata").fetchone()[0]
-        green_count = con.execute("SELECT COUNT(*) FROM green_tripdata").fetchone()[0]
+        ## Fleet lookup joining trips to their vehicle_emissions row
+        con.execute("""
+            CREATE OR REPLACE TABLE fleets (taxi_type taxi_type_enum, vehicle_type VARCHAR);
+        """)
+        con.executemany(
+            "INSERT INTO fleets VALUES (?, ?);",
+            [[taxi_type, config['vehicle_type']] for taxi_type, config in TAXI_TYPES.items()]
+        )
+
+        # Fetch every month in parallel; the rate limiter replaces the old 30 second pause
+        logger.info(f"Loading with {workers} workers at up to {rate} requests/s ({scan} scan)")
+        ledger = read_ledger(con) if incremental else None
+        ingest = ingest_multi_file if scan == 'multi-file' else ingest_partitions
+        loaded, skipped, failed = ingest(
+            con, partitions(years=years), base=source, workers=workers, rate=rate, mirror=mirror,
+            ledger=ledger, clean=clean_on_load
+        )
+        print(f"Loaded {len(loaded)} partitions, skipped {len(skipped)} unchanged")
+        logger.info(f"Loaded {len(loaded)} partitions, skipped {len(skipped)} unchanged")
+        if failed:
+            print(f"Failed to load {len(failed)} files, see load.log")
+            logger.warning(f"Failed partitions: {failed}")
+
+        ## Rows and averages for every fleet, merged from the per-file stats
+        fleet_stats = fleet_summary(con)
         vehicle_count = con.execute("SELECT COUNT(*) FROM vehicle_emissions").fetchone()[0]
-        
-        # Finding avg distance and passenger numbers 
-        yellow_stats = con.execute("""
-        SELECT AVG(distance) as avg_distance,
-        AVG(passenger_count) as avg_passengers
-        FROM yellow_tripdata;
-        """).fetchone()
-
-        green_stats = con.execute("""
-        SELECT AVG(distance) as avg_distance,
-        AVG(passenger_count) as avg_passengers
-        FROM green_tripdata;
-        """).fetchone()
 
         # Outputting to console
-        print(f"Yellow Trip Rows: {yellow_count:,}")
-        print(f"Green Trip Rows: {green_count:,}")
+        for taxi_type, count, _, _ in fleet_stats:
+            print(f"{taxi_type.capitalize()} Trip Rows: {count:,}")
         print(f"Vehicle Emissions Rows: {vehicle_count}")
-        print(f"\nYellow Trip Stats - Avg Distance: {yellow_stats[0]:.2f} miles, Avg Passengers: {yellow_stats[1]:.2f}")
-        print(f"Green Trip Stats - Avg Distance: {green_stats[0]:.2f} miles, Avg Passengers: {green_stats[1]:.2f}")
+        print()
+        for taxi_type, _, avg_distance, avg_passengers in fleet_stats:
+            print(f"{taxi_type.capitalize()} Trip Stats - Avg Distance: {avg_distance:.2f} miles, Avg Passengers: {avg_passengers:.2f}")
 
         # Logging
-        logger.info(f"Yellow trips: {yellow_count:,}, Avg distance: {yellow_stats[0]:.2f}")
-        logger.info(f"Green trips: {green_count:,}, Avg distance: {green_stats[0]:.2f}")
+        for taxi_type, count, avg_distance, _ in fleet_stats:
+            logger.info(f"{taxi_type.capitalize()} trips: {count:,}, Avg distance: {avg_distance:.2f}")
 
     # If an error occurs, saves to log and prints to console
     except Exception as e:
@@ -160,4 +170,29 @@ def load_parquet_files():
 
 # Calls the script to execute
 if __name__ == "__main__":
-    load_parquet_files()
\ No newline at end of file
+    args = parse_args()
+    mirror, downloads = None, None
+    # Remote files are always downloaded with the RangeFetcher, so a dropped
+    # connection is retried and resumed and a truncated file is never loaded
+    fetcher = RangeFetcher(connections=args.connections, retries=args.retries)
+    if args.mirror or args.mirror_max_gb or args.offline:
+        mirror = ParquetMirror(
+            args.mirror or 'mirror', base=args.source, offline=args.offline,
+            revalidate=args.revalidate,
+            max_bytes=int(args.mirror_max_gb * 1024**3) if args.mirror_max_gb else None,
+            fetcher=fetcher,
+        )
+    elif args.source.startswith(('http://', 'https://')):
+        mirror = downloads = TemporaryDownloads(base=args.source, fetcher=fetcher)
+    try:
+        load_parquet_files(
+            source=args.source, workers=args.workers, rate=args.rate, mirror=mirror,
+            incremental=args.incremental, scan=args.scan, clean_on_load=args.clean_on_load,
+            storage=args.storage, years=args.years
+        )
+    finally:
+        # Mirrored files the load read may only be evicted once it is done
+        if downloads is not None:
+            downloads.cleanup()
+        elif mirror is not None:
+            mirror.release()
\ No newline at end of file
@@ -0,0 +1,284 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from fetcher import RangeFetcher
+from settings import source_file_name, source_url
+
+logger = logging.getLogger(__name__)
+
+
+class MirrorMiss(Exception):
+    """
+    Raised in offline mode when a requested file is not in the local mirror
+    """
+
+
+class ParquetMirror:
+    """
+    Content-addressed local copy of the TLC parquet files.
+
+    Each file is downloaded once and stored under objects/ by its sha256.
+    manifest.json maps file names to their size, ETag, Last-Modified, checksum
+    and last use time. Least recently used files are evicted to stay under
+    `max_bytes`, except files handed out since the last release(): a load may
+    still read those, so the mirror can exceed the cap until the load is done.
+    In offline mode the network is never touched.
+
+    Downloads go through `fetcher` (a RangeFetcher by default), so they are
+    retried, resumed from partial/ after an interruption and only stored once
+    they validate as parquet.
+    """
+
+    # Entries carry the sha256 of the content, used as the ledger checksum
+    persistent = True
+
+    def __init__(self, root, base=None, max_bytes=None, offline=False, revalidate=False, fetcher=None):
+        self.root = root
+        self.base = base
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.revalidate = revalidate
+        self.fetcher = fetcher or RangeFetcher()
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self.lock = threading.Lock()
+        # sha256 of every object returned by fetch() since the last release()
+        self.pinned = set()
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self):
+        # Write to a temp file then rename so a crash never leaves a torn manifest
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, 'objects', sha256[:2], f"{sha256}.parquet")
+
+    def entry(self, taxi_type, year, month):
+        """
+        Returns the manifest entry for one file, or None if it is not mirrored
+        """
+        return self.manifest.get(source_file_name(taxi_type, year, month))
+
+    def head(self, taxi_type, year, month):
+        """
+        Upstream response headers of one remote file: {size, etag, last_modified}
+        """
+        return self.fetcher.head(source_url(taxi_type, year, month, self.base))
+
+    def fetch(self, taxi_type, year, month):
+        """
+        Returns a local path for one monthly file, downloading it if needed
+        """
+        name = source_file_name(taxi_type, year, month)
+        url = source_url(taxi_type, year, month, self.base)
+
+        # Local directories are already local, nothing to mirror
+        if not url.startswith(('http://', 'https://')):
+            return url
+
+        with self.lock:
+            entry = self.manifest.get(name)
+        if entry and os.path.exists(self.object_path(entry['sha256'])):
+            if self.offline or not self.revalidate or not self._changed(url, entry):
+                self._touch(name, entry['sha256'])
+                return self.object_path(entry['sha256'])
+            logger.info(f"Upstream copy of {name} changed, downloading again")
+
+        if self.offline:
+            raise MirrorMiss(f"{name} is not in the mirror and offline mode is on")
+
+        return self._download(name, url)
+
+    def _changed(self, url, entry):
+        """
+        Conditional HEAD request against the recorded ETag/Last-Modified
+        """
+        request = urllib.request.Request(url, method='HEAD')
+        if entry.get('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        if entry.get('last_modified'):
+            request.add_header('If-Modified-Since', entry['last_modified'])
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.headers.get('ETag', entry.get('etag')) != entry.get('etag')
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return False
+            raise
+
+    def _download(self, name, url):
+        # A fixed partial path per file, so an interrupted download resumes on the next run
+        tmp = os.path.join(self.root, 'partial', name)
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        info = self.fetcher.fetch(url, tmp)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp, 'rb') as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+                    size += len(chunk)
+            return self._store(name, tmp, digest.hexdigest(), size, info['etag'], info['last_modified'])
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _store(self, name, tmp, sha256, size, etag=None, last_modified=None):
+        """
+        Moves a verified download into objects/ and records it in the manifest
+        """
+        path = self.object_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            self._evict(size)
+            self.pinned.add(sha256)
+            if not os.path.exists(path):
+                shutil.move(tmp, path)
+            self.manifest[name] = {
+                'sha256': sha256,
+                'size': size,
+                'etag': etag,
+                'last_modified': last_modified,
+                'fetched_at': time.time(),
+                'last_used': time.time(),
+            }
+            self._write_manifest()
+        logger.info(f"Mirrored {name} ({size:,} bytes, sha256 {sha256[:12]})")
+        return path
+
+    def _touch(self, name, sha256):
+        with self.lock:
+            self.manifest[name]['last_used'] = time.time()
+            self.pinned.add(sha256)
+            self._write_manifest()
+
+    def release(self):
+        """
+        Called once the load reading the mirrored files is committed or rolled
+        back: unpins them and evicts down to the cap again
+        """
+        with self.lock:
+            self.pinned.clear()
+            self._evict(0)
+
+    def total_bytes(self):
+        # Identical content is stored once, so count each object a single time
+        return sum({e['sha256']: e['size'] for e in self.manifest.values()}.values())
+
+    def _evict(self, incoming):
+        """
+        Removes least recently used files until `incoming` more bytes fit under the cap.
+        Pinned files are kept even if that leaves the mirror over the cap.
+        Must be called with the lock held.
+        """
+        if not self.max_bytes:
+            return
+        for name in sorted(self.manifest, key=lambda n: self.manifest[n]['last_used']):
+            if self.total_bytes() + incoming <= self.max_bytes:
+                break
+            if self.manifest[name]['sha256'] in self.pinned:
+                continue
+            entry = self.manifest.pop(name)
+            # Another name may still point at the same content
+            if not any(e['sha256'] == entry['sha256'] for e in self.manifest.values()):
+                path = self.object_path(entry['sha256'])
+                if os.path.exists(path):
+                    os.remove(path)
+            logger.info(f"Evicted {name} from mirror")
+        self._write_manifest()
+
+
+class TemporaryDownloads:
+    """
+    Remote source files downloaded for a single load, without a mirror.
+
+    Same fetch/entry interface as ParquetMirror, and downloads go through
+    `fetcher` the same way, but files land in a fresh temporary directory
+    (under `root`, default the system temp directory) and nothing is kept:
+    cleanup() deletes them all once the load is done. Every file of the load
+    is on disk at once, so reserve() checks the free space before downloading.
+    """
+
+    persistent = False
+
+    def __init__(self, base=None, fetcher=None, root=None):
+        self.base = base
+        self.fetcher = fetcher or RangeFetcher()
+        self.root = tempfile.mkdtemp(prefix='tlc-download-', dir=root)
+        self.paths = {}
+        self.heads = {}
+        self.lock = threading.Lock()
+
+    def entry(self, taxi_type, year, month):
+        # Nothing is kept between runs, so every file is a network request
+        return None
+
+    def head(self, taxi_type, year, month):
+        """
+        Upstream response headers of one remote file: {size, etag, last_modified}.
+        Requested once per load; reserve() reuses them.
+        """
+        name = source_file_name(taxi_type, year, month)
+        with self.lock:
+            if name in self.heads:
+                return self.heads[name]
+        info = self.fetcher.head(source_url(taxi_type, year, month, self.base))
+        with self.lock:
+            self.heads[name] = info
+        return info
+
+    def reserve(self, partitions):
+        """
+        Checks that the remote files of `partitions` not downloaded yet fit in
+        the free space of the download directory. Raises OSError if they do not.
+        """
+        needed = 0
+        for taxi_type, year, month in partitions:
+            url = source_url(taxi_type, year, month, self.base)
+            if url.startswith(('http://', 'https://')) and source_file_name(taxi_type, year, month) not in self.paths:
+                needed += self.head(taxi_type, year, month)['size'] or 0
+        free = shutil.disk_usage(self.root).free
+        if needed > free:
+            raise OSError(
+                f"Downloading {len(partitions)} files needs {needed / 1024**3:.2f} GB in {self.root}, "
+                f"only {free / 1024**3:.2f} GB free; use a mirror with --mirror-max-gb or load fewer years"
+            )
+        logger.info(f"Downloading {needed:,} bytes to {self.root} ({free:,} bytes free)")
+
+    def fetch(self, taxi_type, year, month):
+        """
+        Returns a local path for one monthly file, downloading it on first use
+        """
+        name = source_file_name(taxi_type, year, month)
+        url = source_url(taxi_type, year, month, self.base)
+        if not url.startswith(('http://', 'https://')):
+            return url
+        with self.lock:
+            if name in self.paths:
+                return self.paths[name]
+        path = os.path.join(self.root, name)
+        self.fetcher.fetch(url, path)
+        with self.lock:
+            self.paths[name] = path
+        return path
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        logger.info(f"Deleted {len(self.paths)} downloaded files")
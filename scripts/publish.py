@@ -0,0 +1,130 @@
+import argparse
+import glob
+import logging
+import os
+import time
+
+from connection import connect
+from instrumentation import timed_stage
+from query_cache import data_version
+from settings import DB_PATH, REPLICA_DIR, REPLICA_KEEP, REPLICA_POINTER, TAXI_TYPES, current_replica
+
+logging.basicConfig(
+    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+    filename='publish.log'
+)
+logger = logging.getLogger(__name__)
+
+# Tables copied into a replica: the dbt outputs plus what readers need to
+# interpret them and to compute the data version (see query_cache.py)
+PUBLISHED_TABLES = ['trips_transformed', 'emissions_rollup', 'trips_sample', 'trip_sketches', 'fleets',
+                    'vehicle_emissions', 'load_ledger']
+
+# Models that must be rebuilt after the last load or clean before publishing
+MODELS = ['trips_transformed', 'emissions_rollup', 'trips_sample', 'trip_sketches']
+
+
+def check_fresh(con):
+    """
+    Raises ValueError unless every model exists and was built after the
+    latest load or clean of any partition, i.e. transform ran on the current data
+    """
+    existing = {row[0] for row in con.execute("""
+        SELECT table_name FROM information_schema.tables WHERE table_schema = 'main';
+    """).fetchall()}
+    missing = [table for table in PUBLISHED_TABLES if table not in existing]
+    if missing:
+        raise ValueError(f"Cannot publish, missing tables: {', '.join(missing)}")
+
+    changed = con.execute("SELECT MAX(GREATEST(loaded_at, cleaned_at)) FROM load_ledger;").fetchone()[0]
+    for model in MODELS:
+        built = con.execute(f"SELECT MAX(transformed_at) FROM {model};").fetchone()[0]
+        if changed is not None and (built is None or built < changed):
+            raise ValueError(f"Cannot publish, {model} was built before the last load/clean ({built} < {changed})")
+
+
+def prune(replica_dir, keep):
+    """
+    Removes all but the `keep` newest replicas. The current one is never removed;
+    readers still holding an older file keep reading it until they close it.
+    """
+    current = current_replica(replica_dir)
+    snapshots = sorted(glob.glob(os.path.join(replica_dir, 'emissions-*.duckdb')), reverse=True)
+    for path in snapshots[keep:]:
+        if path != current:
+            os.remove(path)
+            logger.info(f"Removed old replica {path}")
+
+
+@timed_stage('publish')
+def publish(replica_dir=None, keep=None, force=False):
+    """
+    Copies the transformed tables of DB_PATH into a new, never modified
+    DuckDB file under REPLICA_DIR and points `current` at it.
+    Returns the path of the current replica.
+    """
+    replica_dir = replica_dir or REPLICA_DIR
+    keep = keep or REPLICA_KEEP
+    try:
+        os.makedirs(replica_dir, exist_ok=True)
+        con = connect('publish', database=':memory:')
+        con.execute(f"ATTACH '{DB_PATH}' AS source (READ_ONLY);")
+        con.execute("USE source;")
+        if not force:
+            check_fresh(con)
+
+        version = data_version(con)
+        current = current_replica(replica_dir)
+        if current and not force and os.path.basename(current).endswith(f"-{version[:12]}.duckdb"):
+            print(f"Data unchanged since {current}, nothing to publish")
+            logger.info(f"Data version {version[:12]} already published as {current}")
+            return current
+
+        name = f"emissions-{time.strftime('%Y%m%dT%H%M%S')}-{version[:12]}.duckdb"
+        path = os.path.join(replica_dir, name)
+        # Build under a temporary name so readers never see a partial replica
+        partial = path + '.partial'
+        if os.path.exists(partial):
+            os.remove(partial)
+        con.execute(f"ATTACH '{partial}' AS replica;")
+        for table in PUBLISHED_TABLES:
+            con.execute(f"CREATE TABLE replica.{table} AS SELECT * FROM source.{table};")
+            logger.info(f"Copied {table} to {name}")
+        for taxi_type, fleet in TAXI_TYPES.items():
+            con.execute(f"""
+                CREATE VIEW replica.{fleet['table']}_transformed AS
+                SELECT * EXCLUDE (taxi_type) FROM replica.trips_transformed WHERE taxi_type = '{taxi_type}';
+            """)
+        con.execute("CHECKPOINT replica;")
+        con.execute("DETACH replica;")
+        con.close()
+        os.replace(partial, path)
+
+        # Swap the pointer atomically; new readers open the new replica
+        pointer = os.path.join(replica_dir, REPLICA_POINTER)
+        with open(pointer + '.tmp', 'w') as f:
+            f.write(name)
+        os.replace(pointer + '.tmp', pointer)
+        print(f"Published {path}")
+        logger.info(f"Published data version {version[:12]} as {path}")
+
+        prune(replica_dir, keep)
+        return path
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Publish the transformed tables to an immutable read replica")
+    parser.add_argument('--replica-dir', default=REPLICA_DIR, help="Directory of the published replicas")
+    parser.add_argument('--keep', type=int, default=REPLICA_KEEP, help="Replicas kept on disk")
+    parser.add_argument('--force', action='store_true',
+                        help="Publish even if the models are older than the last load/clean")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    publish(args.replica_dir, args.keep, args.force)
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_sql(sql):
+    """
+    Collapses whitespace and drops a trailing semicolon, so formatting-only
+    differences map to the same cache entry
+    """
+    return re.sub(r"\s+", " ", sql).strip().rstrip(';').strip()
+
+
+# dbt models the reports read; a rebuild of any of them changes the data version
+REPORT_MODELS = ['emissions_rollup', 'trips_sample', 'trip_sketches']
+
+
+def data_version(con):
+    """
+    Token that changes whenever the data behind the reports can have changed:
+    every load_ledger row (checksum, row count, load and clean times) plus the
+    last build of each of the REPORT_MODELS
+    """
+    digest = hashlib.sha256()
+    for row in con.execute("""
+        SELECT taxi_type, year, month, source_checksum, row_count, loaded_at, cleaned_at
+        FROM load_ledger ORDER BY taxi_type, year, month;
+    """).fetchall():
+        digest.update(repr(row).encode())
+    built = {row[0] for row in con.execute("""
+        SELECT table_name FROM information_schema.tables
+        WHERE table_schema = 'main' AND table_name IN (SELECT unnest(?::VARCHAR[]));
+    """, [REPORT_MODELS]).fetchall()}
+    for model in REPORT_MODELS:
+        if model in built:
+            digest.update(repr(con.execute(f"SELECT MAX(transformed_at) FROM {model};").fetchone()).encode())
+    return digest.hexdigest()
+
+
+class QueryCache:
+    """
+    Persistent cache of query results keyed on the normalized SQL, its
+    parameters and the data version.
+
+    Results are pickled under entries/ by key; manifest.json records each
+    entry's size and last use time. Least recently used entries are evicted
+    to stay under `max_bytes`. Entries for an old data version are never hit
+    again and age out through eviction.
+
+    Hits only update last use times in memory; the manifest is written when
+    entries are stored or evicted and by flush() at the end of a run. Each
+    write merges this run's changes into the manifest on disk, so report
+    runs sharing the cache keep each other's entries.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        # Keys this run stored or used, and keys it evicted, not yet in manifest.json
+        self.changed = set()
+        self.removed = set()
+        os.makedirs(os.path.join(root, 'entries'), exist_ok=True)
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self):
+        manifest = self._read_manifest()
+        for key in self.removed:
+            manifest.pop(key, None)
+        for key in self.changed:
+            if key in self.manifest:
+                entry = dict(self.manifest[key])
+                entry['last_used'] = max(entry['last_used'], manifest.get(key, entry)['last_used'])
+                manifest[key] = entry
+        # A unique temp file renamed into place: concurrent runs never share a
+        # temp file and a crash never leaves a torn manifest
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.json.part')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+        self.manifest = manifest
+        self.changed.clear()
+        self.removed.clear()
+
+    def flush(self):
+        """
+        Writes the last use times of this run's cache hits to manifest.json
+        """
+        if self.changed or self.removed:
+            self._write_manifest()
+
+    def entry_path(self, key):
+        return os.path.join(self.root, 'entries', f"{key}.pkl")
+
+    def key(self, con, sql, params=None):
+        # The data version is read once per cache object, i.e. once per report run
+        if self.version is None:
+            self.version = data_version(con)
+        text = "\n".join([self.version, normalize_sql(sql), repr(list(params or []))])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def fetchall(self, con, sql, params=None):
+        """
+        Returns the rows of `sql`, from the cache when the same query already
+        ran against the same data version
+        """
+        key = self.key(con, sql, params)
+        path = self.entry_path(key)
+        if key in self.manifest and os.path.exists(path):
+            with open(path, 'rb') as f:
+                rows = pickle.load(f)
+            self.hits += 1
+            self.manifest[key]['last_used'] = time.time()
+            self.changed.add(key)
+            return rows
+
+        self.misses += 1
+        rows = con.execute(sql, params or []).fetchall()
+        self._store(key, rows)
+        return rows
+
+    def _store(self, key, rows):
+        data = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.max_bytes and len(data) > self.max_bytes:
+            return
+        self._evict(len(data))
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self.entry_path(key))
+        self.manifest[key] = {'size': len(data), 'created_at': time.time(), 'last_used': time.time()}
+        self.changed.add(key)
+        self._write_manifest()
+
+    def total_bytes(self):
+        return sum(e['size'] for e in self.manifest.values())
+
+    def _evict(self, incoming):
+        """
+        Removes least recently used entries until `incoming` more bytes fit under the cap
+        """
+        if not self.max_bytes:
+            return
+        for key in sorted(self.manifest, key=lambda k: self.manifest[k]['last_used']):
+            if self.total_bytes() + incoming <= self.max_bytes:
+                break
+            self.manifest.pop(key)
+            self.changed.discard(key)
+            self.removed.add(key)
+            if os.path.exists(self.entry_path(key)):
+                os.remove(self.entry_path(key))
+            logger.info(f"Evicted query result {key[:12]} from cache")
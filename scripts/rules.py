@@ -0,0 +1,84 @@
+import hashlib
+
+from settings import YEARS
+
+# Cleaning rules shared by clean.py (post-load mode) and load.py (filter-on-load mode).
+# Each rule is (name, description used in log messages, predicate matching INVALID rows).
+# Order matters: a row breaking several rules is attributed to the first one.
+# clean.py only ever applied the other rules to pickups inside the date range,
+# so the date range rule comes first to keep its per-year counts unchanged.
+RULES = [
+    ('out_of_range', "records outside of date range",
+     f"pickup_datetime < TIMESTAMP '{YEARS[0]}-01-01' "
+     f"OR pickup_datetime >= TIMESTAMP '{YEARS[-1] + 1}-01-01'"),
+    ('no_passengers', "rows with no passengers",
+     "passenger_count = 0 OR passenger_count IS NULL"),
+    ('zero_distance', "rows with trip len 0",
+     "distance <= 0 OR distance IS NULL"),
+    ('over_100_miles', "rows with trip len > 100",
+     "distance > 100"),
+    ('over_one_day', "rows with trips > 1 day",
+     "date_diff('second', pickup_datetime, dropoff_datetime) > 86400 "
+     "OR pickup_datetime IS NULL OR dropoff_datetime IS NULL"),
+]
+
+
+def rule_predicate(name):
+    """
+    Returns the NULL-safe predicate matching rows that break one rule
+    """
+    predicate = next(p for n, _, p in RULES if n == name)
+    return f"COALESCE(({predicate}), false)"
+
+
+def rejection_case():
+    """
+    Returns a CASE expression naming the first rule a row breaks, or NULL if it is valid
+    """
+    branches = "\n".join(f"WHEN {rule_predicate(name)} THEN '{name}'" for name, _, _ in RULES)
+    return f"CASE\n{branches}\nEND"
+
+
+def valid_predicate():
+    """
+    Returns a predicate that is true only for rows passing every rule
+    """
+    return " AND ".join(f"NOT {rule_predicate(name)}" for name, _, _ in RULES)
+
+
+def rules_version():
+    """
+    Short hash of the rule predicates, stored with clean checkpoints so
+    partitions cleaned under other rules are cleaned again
+    """
+    return hashlib.sha256(valid_predicate().encode()).hexdigest()[:12]
+
+
+def create_rejects_table(con):
+    """
+    Side table of rows rejected during filter-on-load, per rule and partition
+    """
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS load_rejects (
+            taxi_type VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            rule VARCHAR,
+            rejected_rows BIGINT,
+            recorded_at TIMESTAMP,
+            PRIMARY KEY (taxi_type, year, month, rule)
+        );
+    """)
+
+
+def record_rejects(con, taxi_type, year, month, rejects):
+    """
+    Replaces the reject counts for one partition with {rule: rejected_rows}
+    """
+    con.execute("""
+        DELETE FROM load_rejects WHERE taxi_type = ? AND year = ? AND month = ?;
+    """, [taxi_type, int(year), int(month)])
+    for rule, rejected in rejects.items():
+        con.execute("""
+            INSERT INTO load_rejects VALUES (?, ?, ?, ?, ?, current_timestamp);
+        """, [taxi_type, int(year), int(month), rule, rejected])
@@ -0,0 +1,129 @@
+import argparse
+import logging
+from statistics import NormalDist
+
+from connection import connect
+from settings import DB_PATH, TAXI_TYPES, current_replica
+
+logger = logging.getLogger(__name__)
+
+# Approximate answers from the trips_sample model (dbt/models/trips_sample.sql),
+# a stratified sample with one stratum per fleet and source month.
+#
+# The total of a measure y over the trips in a group (e.g. hour_of_day = 8) is
+# estimated per stratum h as N_h / n_h * sum(y over sampled trips in the group),
+# summed over strata. Its variance is the usual stratified estimator variance
+#   sum_h N_h^2 * (1 - n_h / N_h) * s_h^2 / n_h
+# with s_h^2 the sample variance within stratum h of y * [trip in group].
+
+ESTIMATE_SQL = """
+    WITH per_stratum AS (
+        SELECT taxi_type, {column} AS value,
+        ANY_VALUE(stratum_rows)::DOUBLE AS population,
+        ANY_VALUE(stratum_sample)::DOUBLE AS sampled,
+        SUM({measure})::DOUBLE AS y,
+        SUM({measure}::DOUBLE * {measure}::DOUBLE) AS y2,
+        COUNT(*) AS sample_rows
+        FROM trips_sample
+        WHERE {where}
+        GROUP BY taxi_type, source_year, source_month, {column}
+    ),
+    totals AS (
+        SELECT taxi_type, value,
+        SUM(population / sampled * y) AS estimate,
+        SUM(CASE WHEN sampled > 1
+            THEN population * population * (1 - sampled / population)
+                 * GREATEST(y2 - y * y / sampled, 0) / (sampled - 1) / sampled
+            ELSE 0 END) AS variance,
+        SUM(sample_rows) AS sample_rows
+        FROM per_stratum
+        GROUP BY taxi_type, value
+    )
+    SELECT taxi_type, value, estimate,
+    estimate - ? * sqrt(variance) AS low,
+    estimate + ? * sqrt(variance) AS high,
+    sample_rows
+    FROM totals
+    ORDER BY taxi_type, estimate DESC;
+"""
+
+
+def z_score(confidence):
+    """
+    Two-sided normal quantile for a confidence level, e.g. 1.96 for 0.95
+    """
+    if not 0 < confidence < 1:
+        raise ValueError(f"Confidence must be between 0 and 1, got {confidence}")
+    return NormalDist().inv_cdf((1 + confidence) / 2)
+
+
+def estimate_by(con, column, measure='trip_co2_kgs', where="true", confidence=0.95, cache=None):
+    """
+    Estimated total of `measure` per fleet and `column` with a `confidence`
+    interval. Pass measure='1' to estimate trip counts.
+    Returns {taxi_type: [(value, estimate, low, high, sample_rows)]} ordered
+    by estimate, largest first.
+    """
+    sql = ESTIMATE_SQL.format(column=column, measure=measure, where=where)
+    z = z_score(confidence)
+    rows = cache.fetchall(con, sql, [z, z]) if cache is not None else con.execute(sql, [z, z]).fetchall()
+    totals = {}
+    for taxi_type, *estimate in rows:
+        totals.setdefault(taxi_type, []).append(tuple(estimate))
+    return totals
+
+
+def sample_max(con, measure='trip_co2_kgs', cache=None):
+    """
+    Largest `measure` per fleet in the sample, a lower bound of the true maximum
+    """
+    sql = f"SELECT taxi_type, MAX({measure}) FROM trips_sample GROUP BY taxi_type;"
+    return dict(cache.fetchall(con, sql) if cache is not None else con.execute(sql).fetchall())
+
+
+def coverage(con, grain, column, confidence=0.95):
+    """
+    Compares the estimated co2 per fleet and `column` with the exact totals
+    of the emissions_rollup cube. Returns [(taxi_type, value, exact, estimate,
+    low, high)] and the share of exact totals inside their interval.
+    """
+    exact = dict(
+        ((taxi_type, value), total) for taxi_type, value, total in con.execute(f"""
+            SELECT taxi_type, {column}, SUM(total_co2_kgs)
+            FROM emissions_rollup WHERE grain = ?
+            GROUP BY taxi_type, {column};
+        """, [grain]).fetchall()
+    )
+    rows = []
+    for taxi_type, estimates in estimate_by(con, column, confidence=confidence).items():
+        for value, estimate, low, high, _ in estimates:
+            rows.append((taxi_type, value, exact.get((taxi_type, value)), estimate, low, high))
+    inside = sum(1 for row in rows if row[2] is not None and row[4] <= row[2] <= row[5])
+    return rows, inside / len(rows) if rows else None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare sample estimates of co2 per hour/day/week/month/year with the exact totals"
+    )
+    parser.add_argument('grain', choices=['hour', 'day', 'week', 'month', 'year'])
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--primary', action='store_true', help="Read the primary database, not the replica")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    columns = {'hour': 'hour_of_day', 'day': 'day_of_week', 'week': 'week_of_year',
+               'month': 'month_of_year', 'year': 'specified_year'}
+    database = (None if args.primary else current_replica()) or DB_PATH
+    con = connect('analysis', database=database, read_only=True)
+    rows, share = coverage(con, args.grain, columns[args.grain], args.confidence)
+    for taxi_type in TAXI_TYPES:
+        for row_type, value, exact, estimate, low, high in rows:
+            if row_type != taxi_type:
+                continue
+            print(f"{taxi_type:<8} {str(value):>5} exact {exact or 0:>16,.1f} estimate {estimate:>16,.1f} "
+                  f"[{low:,.1f}, {high:,.1f}]")
+    if share is not None:
+        print(f"{share:.0%} of exact totals inside their {args.confidence:.0%} interval")
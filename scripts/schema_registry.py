@@ -0,0 +1,97 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Canonical trip schema every source file is mapped onto, in table column order.
+# Types are the narrowest that hold every valid trip: passenger counts fit in a
+# byte and distances need no more than float precision. Out of range source
+# values become NULL through TRY_CAST and are dropped by the cleaning rules.
+CANONICAL_COLUMNS = [
+    ('pickup_datetime', 'TIMESTAMP'),
+    ('dropoff_datetime', 'TIMESTAMP'),
+    ('passenger_count', 'UTINYINT'),
+    ('distance', 'FLOAT'),
+]
+
+# Source file partition stored with every trip
+PARTITION_COLUMNS = [
+    ('source_year', 'SMALLINT'),
+    ('source_month', 'UTINYINT'),
+]
+
+# Source column names seen across TLC file vintages (matched case-insensitively)
+COLUMN_ALIASES = {
+    'pickup_datetime': ['tpep_pickup_datetime', 'lpep_pickup_datetime', 'pickup_datetime',
+                        'trip_pickup_datetime'],
+    'dropoff_datetime': ['tpep_dropoff_datetime', 'lpep_dropoff_datetime', 'dropoff_datetime',
+                         'trip_dropoff_datetime'],
+    'passenger_count': ['passenger_count'],
+    'distance': ['trip_distance', 'distance'],
+}
+
+
+class SchemaMismatch(Exception):
+    """
+    Raised when a source file has no column for one of the canonical fields
+    """
+
+
+def inspect_file(con, path):
+    """
+    Returns [(column_name, column_type)] for one parquet file.
+    Only the footer is read, not the row data.
+    """
+    rows = con.execute("DESCRIBE SELECT * FROM read_parquet(?);", [path]).fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+
+def map_columns(columns):
+    """
+    Maps a file's columns onto the canonical schema.
+    Returns {canonical_name: (source_name, source_type)}.
+    """
+    by_lower = {name.lower(): (name, col_type) for name, col_type in columns}
+    mapping = {}
+    for canonical, _ in CANONICAL_COLUMNS:
+        match = next((by_lower[a] for a in COLUMN_ALIASES[canonical] if a in by_lower), None)
+        if match is None:
+            raise SchemaMismatch(f"No source column for {canonical} in {[c[0] for c in columns]}")
+        mapping[canonical] = match
+    return mapping
+
+
+def signature(mapping):
+    """
+    Files with the same source column names can share one union_by_name scan;
+    type differences between them are resolved by the explicit casts.
+    """
+    return tuple(mapping[canonical][0] for canonical, _ in CANONICAL_COLUMNS)
+
+
+def select_list(mapping, alias=None):
+    """
+    Returns the SELECT expressions mapping source columns onto the canonical
+    schema, casting wherever the source type differs
+    """
+    prefix = f"{alias}." if alias else ''
+    expressions = []
+    for canonical, canonical_type in CANONICAL_COLUMNS:
+        source, source_type = mapping[canonical]
+        column = f'{prefix}"{source}"'
+        if source_type != canonical_type:
+            # TRY_CAST keeps bad values as NULL so cleaning can count and drop them
+            column = f"TRY_CAST({column} AS {canonical_type})"
+        expressions.append(f"{column} AS {canonical}")
+    return ",\n        ".join(expressions)
+
+
+def select_names(names, alias=None):
+    """
+    Like select_list but for a scan over several files whose types may differ
+    (union_by_name picks the widest type), so every column is cast explicitly
+    """
+    prefix = f"{alias}." if alias else ''
+    return ",\n        ".join(
+        f'TRY_CAST({prefix}"{source}" AS {canonical_type}) AS {canonical}'
+        for source, (canonical, canonical_type) in zip(names, CANONICAL_COLUMNS)
+    )
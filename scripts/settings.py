@@ -0,0 +1,100 @@
+import os
+
+# Shared configuration for the load, clean, transform and analysis scripts
+
+# Location of the local DuckDB database (override with EMISSIONS_DB)
+DB_PATH = os.environ.get('EMISSIONS_DB', 'emissions.duckdb')
+
+# Base location of the monthly TLC parquet files. Can be an http(s) URL or a
+# local directory of fixture files laid out with the same file names.
+SOURCE_BASE = os.environ.get(
+    'TLC_SOURCE', 'https://d37ci6vzurychx.cloudfront.net/trip-data'
+)
+
+# Local content-addressed mirror of the source files (set TLC_MIRROR to enable by default)
+MIRROR_DIR = os.environ.get('TLC_MIRROR')
+
+# Where trips are stored: 'table' keeps them inside the DuckDB file, 'parquet'
+# writes hive-partitioned files under WAREHOUSE_DIR exposed through views
+STORAGE_BACKEND = os.environ.get('TRIP_STORAGE', 'table')
+WAREHOUSE_DIR = os.environ.get('TRIP_WAREHOUSE', 'warehouse')
+
+# Emissions model for trip_co2_kgs in transform.py, see emissions_model.py
+EMISSIONS_MODEL = os.environ.get('EMISSIONS_MODEL', 'constant')
+
+# Immutable read replicas written by publish.py after clean + transform. Readers
+# (analysis.py, dashboards) query the current replica while loads write DB_PATH.
+REPLICA_DIR = os.environ.get('EMISSIONS_REPLICA_DIR', 'replica')
+REPLICA_KEEP = int(os.environ.get('REPLICA_KEEP', '3'))
+# File in REPLICA_DIR naming the current replica; replaced atomically on publish
+REPLICA_POINTER = 'current'
+
+# Persistent result cache for analysis.py queries, bounded by QUERY_CACHE_MAX_MB
+QUERY_CACHE_DIR = os.environ.get('QUERY_CACHE_DIR', '.query_cache')
+QUERY_CACHE_MAX_MB = float(os.environ.get('QUERY_CACHE_MAX_MB', '64'))
+
+# Query and stage metrics written by instrumentation.py; set QUERY_PROFILE=1 to
+# also store DuckDB's JSON profile (operator timings and cardinalities) per query
+METRICS_FILE = os.environ.get('METRICS_FILE', 'metrics.jsonl')
+QUERY_PROFILE = os.environ.get('QUERY_PROFILE', '') not in ('', '0', 'false')
+
+# Rows per parquet row group; DuckDB parallelizes scans per row group
+PARQUET_ROW_GROUP_SIZE = 122880
+
+# Years 2015 through 2024 and properly formatted months
+YEARS = list(range(2015, 2025))
+MONTHS = [f"{i:02d}" for i in range(1, 13)]
+
+# Per-fleet settings: name of the compatibility view over the trips table, and
+# the vehicle_emissions row used for the fleet. A new fleet (e.g. FHV) only
+# needs an entry here and matching source files.
+TAXI_TYPES = {
+    'yellow': {'table': 'yellow_tripdata', 'vehicle_type': 'yellow_taxi'},
+    'green': {'table': 'green_tripdata', 'vehicle_type': 'green_taxi'},
+}
+
+
+def source_file_name(taxi_type, year, month):
+    """
+    Returns the TLC file name for one fleet/month, e.g. yellow_tripdata_2024-01.parquet
+    """
+    return f"{taxi_type}_tripdata_{year}-{month}.parquet"
+
+
+def source_url(taxi_type, year, month, base=None):
+    """
+    Returns the location of one monthly parquet file under the given base
+    (an http(s) URL or a local directory)
+    """
+    base = base or SOURCE_BASE
+    name = source_file_name(taxi_type, year, month)
+    if base.startswith(('http://', 'https://', 's3://')):
+        return f"{base.rstrip('/')}/{name}"
+    return os.path.join(base, name)
+
+
+def partitions(years=None, months=None, taxi_types=None):
+    """
+    Returns every (taxi_type, year, month) partition to load, in chronological order
+    """
+    return [
+        (taxi_type, year, month)
+        for year in (years or YEARS)
+        for month in (months or MONTHS)
+        for taxi_type in (taxi_types or TAXI_TYPES)
+    ]
+
+
+def current_replica(replica_dir=None):
+    """
+    Returns the path of the most recently published replica, or None when
+    nothing has been published yet
+    """
+    replica_dir = replica_dir or REPLICA_DIR
+    try:
+        with open(os.path.join(replica_dir, REPLICA_POINTER)) as f:
+            name = f.read().strip()
+    except OSError:
+        return None
+    path = os.path.join(replica_dir, name)
+    return path if name and os.path.exists(path) else None
@@ -0,0 +1,158 @@
+import argparse
+import logging
+
+from connection import connect
+from settings import DB_PATH, current_replica
+
+logger = logging.getLogger(__name__)
+
+# Quantiles of trip_co2_kgs and avg_mph from the trip_sketches model
+# (dbt/models/trip_sketches.sql). Sketches of any set of partitions and hours
+# are merged by summing their bucket counts; the q-quantile is the first
+# bucket whose cumulative count reaches q * trips, read back as the
+# bucket's midpoint 2 * gamma^i / (gamma + 1), which is within the sketch's
+# relative accuracy of a true trip value.
+
+MEASURES = ['trip_co2_kgs', 'avg_mph']
+QUANTILES = [0.5, 0.95, 0.99]
+
+# Dimensions sketches are kept per, and so can be grouped by
+GROUP_COLUMNS = ['taxi_type', 'source_year', 'source_month', 'hour_of_day']
+
+# Bucket holding values <= 0
+ZERO_BUCKET = -32768
+
+QUANTILE_SQL = """
+    WITH merged AS (
+        SELECT {groups}, bucket, SUM(trips) AS trips, ANY_VALUE(relative_accuracy) AS alpha
+        FROM trip_sketches
+        WHERE measure = ? AND {where}
+        GROUP BY {groups}, bucket
+    ),
+    ranked AS (
+        SELECT *,
+        SUM(trips) OVER (PARTITION BY {groups} ORDER BY bucket) AS cumulative,
+        SUM(trips) OVER (PARTITION BY {groups}) AS total
+        FROM merged
+    ),
+    picked AS (
+        SELECT {groups}, q,
+        MIN(bucket) FILTER (WHERE cumulative >= q * total) AS bucket,
+        ANY_VALUE(alpha) AS alpha,
+        ANY_VALUE(total) AS total
+        FROM ranked, unnest(?::DOUBLE[]) AS quantiles(q)
+        GROUP BY {groups}, q
+    )
+    SELECT {groups}, q,
+    CASE WHEN bucket = {zero} THEN 0
+        ELSE 2 * pow((1 + alpha) / (1 - alpha), bucket) / ((1 + alpha) / (1 - alpha) + 1)
+    END AS value,
+    total
+    FROM picked
+    ORDER BY {groups}, q;
+"""
+
+
+def sketch_filters(taxi_types=None, start=None, end=None, hours=None):
+    """
+    WHERE clause and parameters selecting fleets, a (year, month) range and hours of day
+    """
+    clauses, params = [], []
+    if taxi_types:
+        clauses.append(f"taxi_type IN ({', '.join('?' * len(taxi_types))})")
+        params += list(taxi_types)
+    if start:
+        clauses.append("source_year::INTEGER * 100 + source_month >= ?")
+        params.append(start[0] * 100 + start[1])
+    if end:
+        clauses.append("source_year::INTEGER * 100 + source_month <= ?")
+        params.append(end[0] * 100 + end[1])
+    if hours:
+        clauses.append(f"hour_of_day IN ({', '.join('?' * len(hours))})")
+        params += [int(hour) for hour in hours]
+    return " AND ".join(clauses) or "true", params
+
+
+def quantiles(con, measure='trip_co2_kgs', qs=None, group_by=('taxi_type',), taxi_types=None,
+              start=None, end=None, hours=None, cache=None):
+    """
+    Quantiles `qs` of `measure` per `group_by` group (a subset of
+    GROUP_COLUMNS), over the fleets, (year, month) range [start, end] and hours
+    given. Returns {group values: ({q: value}, trips)}.
+    """
+    if measure not in MEASURES:
+        raise ValueError(f"No sketches of {measure}, expected one of {', '.join(MEASURES)}")
+    unknown = [column for column in group_by if column not in GROUP_COLUMNS]
+    if not group_by or unknown:
+        raise ValueError(f"Group by one or more of {', '.join(GROUP_COLUMNS)}")
+    groups = ", ".join(group_by)
+    where, params = sketch_filters(taxi_types, start, end, hours)
+    sql = QUANTILE_SQL.format(groups=groups, where=where, zero=ZERO_BUCKET)
+    params = [measure] + params + [list(qs or QUANTILES)]
+    rows = cache.fetchall(con, sql, params) if cache is not None else con.execute(sql, params).fetchall()
+
+    results = {}
+    width = len(group_by)
+    for row in rows:
+        key, (q, value, total) = row[:width], row[width:]
+        values, _ = results.setdefault(key, ({}, total))
+        values[q] = value
+    return results
+
+
+def exact_quantiles(con, measure, qs, group_by, taxi_types=None, start=None, end=None, hours=None):
+    """
+    The same quantiles computed exactly from trips_transformed, for checking the sketches
+    """
+    groups = ", ".join(group_by)
+    where, params = sketch_filters(taxi_types, start, end, hours)
+    rows = con.execute(f"""
+        SELECT {groups}, quantile_disc({measure}, ?::DOUBLE[])
+        FROM trips_transformed
+        WHERE {where} AND isfinite({measure})
+        GROUP BY {groups};
+    """, [list(qs)] + params).fetchall()
+    return {row[:-1]: dict(zip(qs, row[-1])) for row in rows}
+
+
+def parse_month(text):
+    year, month = text.split('-')
+    return int(year), int(month)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Trip co2 and speed quantiles from the mergeable sketches")
+    parser.add_argument('--measure', choices=MEASURES, default='trip_co2_kgs')
+    parser.add_argument('--quantiles', type=float, nargs='+', default=QUANTILES)
+    parser.add_argument('--by', nargs='+', choices=GROUP_COLUMNS, default=['taxi_type'], help="Group columns")
+    parser.add_argument('--taxi-types', nargs='+', default=None)
+    parser.add_argument('--from', dest='start', type=parse_month, default=None, help="First month, YYYY-MM")
+    parser.add_argument('--to', dest='end', type=parse_month, default=None, help="Last month, YYYY-MM")
+    parser.add_argument('--hours', type=int, nargs='+', default=None, help="Hours of day")
+    parser.add_argument('--check', action='store_true',
+                        help="Also compute the exact quantiles from trips_transformed and show the error")
+    parser.add_argument('--primary', action='store_true', help="Read the primary database, not the replica")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    database = (None if args.primary else current_replica()) or DB_PATH
+    con = connect('analysis', database=database, read_only=True)
+    filters = dict(taxi_types=args.taxi_types, start=args.start, end=args.end, hours=args.hours)
+    results = quantiles(con, args.measure, args.quantiles, args.by, **filters)
+    exact = exact_quantiles(con, args.measure, args.quantiles, args.by, **filters) if args.check else {}
+    worst = 0.0
+    for key, (values, total) in results.items():
+        parts = []
+        for q, value in values.items():
+            part = f"p{q * 100:g}={value:,.3f}"
+            if key in exact:
+                true = exact[key][q]
+                error = abs(value - true) / true if true else 0.0
+                worst = max(worst, error)
+                part += f" (exact {true:,.3f})"
+            parts.append(part)
+        print(f"{' '.join(str(k) for k in key):<20} {total:>12,} trips  {'  '.join(parts)}")
+    if exact:
+        print(f"Largest relative error: {worst:.2%}")
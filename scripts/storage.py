@@ -0,0 +1,275 @@
+import glob
+import logging
+import os
+import shutil
+import uuid
+
+from schema_registry import CANONICAL_COLUMNS, PARTITION_COLUMNS
+from settings import PARQUET_ROW_GROUP_SIZE, TAXI_TYPES, WAREHOUSE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Single fact table holding every fleet's trips, keyed by the taxi_type enum
+TRIPS_TABLE = 'trips'
+
+# Trip columns stored in the parquet files; taxi_type, source_year and
+# source_month become the taxi_type=/year=/month= hive partition directories
+TRIP_COLUMNS = [name for name, _ in CANONICAL_COLUMNS]
+
+# (name, type) of every trips column after taxi_type
+TRIPS_SCHEMA = CANONICAL_COLUMNS + PARTITION_COLUMNS
+
+
+def table_columns(con, table):
+    """
+    Returns the column names of a table or view, in order
+    """
+    return [row[0] for row in con.execute(f"DESCRIBE {table};").fetchall()]
+
+
+def relation_type(con, name):
+    """
+    Returns 'table', 'view' or None for a relation in the main schema
+    """
+    row = con.execute("""
+        SELECT table_type FROM information_schema.tables
+        WHERE table_schema = 'main' AND table_name = ?;
+    """, [name]).fetchone()
+    if row is None:
+        return None
+    return 'view' if row[0] == 'VIEW' else 'table'
+
+
+def drop_relation(con, name):
+    """
+    Drops a table or view by name if it exists
+    """
+    kind = relation_type(con, name)
+    if kind is not None:
+        con.execute(f"DROP {kind.upper()} {name};")
+
+
+def trips_backend(con):
+    """
+    'parquet' when trips are a view over the hive-partitioned warehouse,
+    otherwise 'table'
+    """
+    return 'parquet' if relation_type(con, TRIPS_TABLE) == 'view' else 'table'
+
+
+def enum_values(con):
+    """
+    Returns the values of the taxi_type_enum type, or None if it does not exist
+    """
+    row = con.execute("""
+        SELECT labels FROM duckdb_types() WHERE type_name = 'taxi_type_enum';
+    """).fetchone()
+    return row[0] if row else None
+
+
+def partition_dir(taxi_type=None, year=None, month=None, table=TRIPS_TABLE):
+    """
+    Absolute warehouse directory for all rows of `table`, a fleet, or one of
+    its year/month partitions. Absolute so the views also resolve when dbt
+    runs from the dbt/ folder.
+    """
+    path = os.path.join(os.path.abspath(WAREHOUSE_DIR), table)
+    if taxi_type is not None:
+        path = os.path.join(path, f"taxi_type={taxi_type}")
+    if year is not None:
+        path = os.path.join(path, f"year={int(year)}", f"month={int(month)}")
+    return path
+
+
+def existing_partitions(table=TRIPS_TABLE):
+    """
+    Returns [(taxi_type, year, month)] for every partition directory of `table` in the warehouse
+    """
+    parts = []
+    for path in glob.glob(os.path.join(partition_dir(table=table), 'taxi_type=*', 'year=*', 'month=*')):
+        month_dir, year_dir = os.path.basename(path), os.path.basename(os.path.dirname(path))
+        fleet_dir = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        parts.append((fleet_dir.split('=')[1], int(year_dir.split('=')[1]), int(month_dir.split('=')[1])))
+    return sorted(parts)
+
+
+def refresh_view(con):
+    """
+    (Re)creates the trips view over the parquet partitions
+    """
+    files = os.path.join(partition_dir(), '*', '*', '*', '*.parquet')
+    if glob.glob(files):
+        source = f"""
+            SELECT taxi_type::taxi_type_enum AS taxi_type, {', '.join(TRIP_COLUMNS)},
+            year AS source_year, month AS source_month
+            FROM read_parquet('{files}', hive_partitioning = true,
+                              hive_types = {{'taxi_type': VARCHAR, 'year': SMALLINT, 'month': UTINYINT}})
+        """
+    else:
+        # No partitions yet, expose an empty relation with the right types
+        columns = ", ".join(f"NULL::{col_type} AS {name}" for name, col_type in TRIPS_SCHEMA)
+        source = f"SELECT NULL::taxi_type_enum AS taxi_type, {columns} WHERE false"
+    con.execute(f"CREATE OR REPLACE VIEW {TRIPS_TABLE} AS {source};")
+
+
+def create_fleet_views(con):
+    """
+    Compatibility views with the old per-fleet table names and columns,
+    so the dbt sources and ad-hoc queries keep working
+    """
+    for taxi_type, config in TAXI_TYPES.items():
+        # Databases from before the unified table still hold per-fleet tables
+        if relation_type(con, config['table']) == 'table':
+            drop_relation(con, config['table'])
+        con.execute(f"""
+            CREATE OR REPLACE VIEW {config['table']} AS
+            SELECT {', '.join(TRIP_COLUMNS)}, source_year, source_month
+            FROM {TRIPS_TABLE}
+            WHERE taxi_type = '{taxi_type}';
+        """)
+
+
+def create_trips(con, storage='table', full=True):
+    """
+    Sets up the trips relation on the chosen backend plus the per-fleet views.
+    A full load starts empty; an incremental load keeps existing trips, which
+    requires the same backend and fleets as the previous load.
+    """
+    fleets = list(TAXI_TYPES)
+    if not full:
+        current = relation_type(con, TRIPS_TABLE)
+        if current is not None and current != ('view' if storage == 'parquet' else 'table'):
+            raise ValueError(f"trips are not stored as {storage}, run a full load first")
+        if current is not None and enum_values(con) != fleets:
+            raise ValueError("the set of fleets changed, run a full load first")
+
+    if full:
+        for config in TAXI_TYPES.values():
+            drop_relation(con, config['table'])
+        drop_relation(con, TRIPS_TABLE)
+        # Only recreate the enum when fleets were added or removed
+        if enum_values(con) not in (None, fleets):
+            con.execute("DROP TYPE taxi_type_enum;")
+        if os.path.exists(partition_dir()):
+            shutil.rmtree(partition_dir())
+
+    if enum_values(con) is None:
+        labels = ", ".join(f"'{t}'" for t in fleets)
+        con.execute(f"CREATE TYPE taxi_type_enum AS ENUM ({labels});")
+
+    if storage == 'parquet':
+        os.makedirs(partition_dir(), exist_ok=True)
+        refresh_view(con)
+    else:
+        # source_year/source_month identify the source file, used to replace a month atomically
+        columns = ",\n".join(f"{name} {col_type}" for name, col_type in TRIPS_SCHEMA)
+        con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {TRIPS_TABLE} (
+                taxi_type taxi_type_enum,
+                {columns}
+            );
+        """)
+    create_fleet_views(con)
+
+
+def stage_partitions(con, select_sql, params=None, replace=None):
+    """
+    Writes the rows of `select_sql` (taxi_type, trip columns, source_year,
+    source_month) as zstd parquet partitions into a new staging directory of
+    the warehouse, leaving the live partitions untouched. Returns (staging
+    directory, partitions to swap) for swap_partitions; see write_partitions
+    for `replace`.
+    """
+    root = os.path.abspath(WAREHOUSE_DIR)
+    staging = os.path.join(root, '.staging', uuid.uuid4().hex)
+    os.makedirs(staging)
+    try:
+        con.execute(f"""
+            COPY (
+                SELECT taxi_type, {', '.join(TRIP_COLUMNS)},
+                source_year AS year, source_month AS month
+                FROM ({select_sql})
+            ) TO '{staging}' (
+                FORMAT parquet, PARTITION_BY (taxi_type, year, month), COMPRESSION zstd,
+                ROW_GROUP_SIZE {PARQUET_ROW_GROUP_SIZE}
+            );
+        """, params or [])
+
+        targets = set(existing_partitions()) if replace is None else {
+            (t, int(y), int(m)) for t, y, m in replace
+        }
+        for path in glob.glob(os.path.join(staging, 'taxi_type=*', 'year=*', 'month=*')):
+            month_dir, year_dir = os.path.basename(path), os.path.basename(os.path.dirname(path))
+            fleet_dir = os.path.basename(os.path.dirname(os.path.dirname(path)))
+            part = (fleet_dir.split('=')[1], int(year_dir.split('=')[1]), int(month_dir.split('=')[1]))
+            # Rows for partitions outside `replace` would silently duplicate data
+            if replace is not None and part not in targets:
+                raise ValueError(f"Query produced rows for unexpected partition {part}")
+            targets.add(part)
+    except Exception:
+        discard_staging(staging)
+        raise
+    return staging, targets
+
+
+def swap_partitions(con, staging, targets):
+    """
+    Swaps the staged `targets` into the warehouse: each partition directory is
+    replaced with a rename, so readers see whole months only, or removed if
+    nothing was staged for it. The staging directory is deleted afterwards.
+    """
+    try:
+        for taxi_type, year, month in sorted(targets):
+            dest = partition_dir(taxi_type, year, month)
+            new = os.path.join(staging, f"taxi_type={taxi_type}", f"year={year}", f"month={month}")
+            old = f"{dest}.old-{uuid.uuid4().hex}"
+            if os.path.exists(dest):
+                os.rename(dest, old)
+            if os.path.exists(new):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.rename(new, dest)
+            if os.path.exists(old):
+                shutil.rmtree(old)
+    finally:
+        discard_staging(staging)
+
+    refresh_view(con)
+    logger.info(f"Wrote {len(targets)} parquet partitions")
+    return sorted(targets)
+
+
+def discard_staging(staging):
+    """
+    Deletes a staging directory, e.g. when the transaction it was written for rolls back
+    """
+    shutil.rmtree(staging, ignore_errors=True)
+
+
+def write_partitions(con, select_sql, params=None, replace=None):
+    """
+    Writes the rows of `select_sql` (taxi_type, trip columns, source_year,
+    source_month) as zstd parquet partitions and swaps them into the warehouse.
+
+    `replace` lists the (taxi_type, year, month) partitions being replaced: each
+    is swapped for its new files, or removed if the query produced no rows for
+    it. None replaces every existing partition (a full rewrite). Each partition
+    directory is swapped with a rename, so readers see whole months only.
+    """
+    staging, targets = stage_partitions(con, select_sql, params, replace)
+    return swap_partitions(con, staging, targets)
+
+
+def replace_partition(con, partition, select_sql, params=None):
+    """
+    Replaces the trips of one (taxi_type, year, month) partition with the rows
+    of `select_sql`, on either backend. Run it inside the caller's transaction.
+    """
+    if trips_backend(con) == 'parquet':
+        write_partitions(con, select_sql, params, replace=[partition])
+    else:
+        taxi_type, year, month = partition
+        con.execute(f"""
+            DELETE FROM {TRIPS_TABLE}
+            WHERE taxi_type = ? AND source_year = ? AND source_month = ?;
+        """, [taxi_type, int(year), int(month)])
+        con.execute(f"INSERT INTO {TRIPS_TABLE} {select_sql};", params or [])
@@ -0,0 +1,161 @@
+import argparse
+import calendar
+import hashlib
+import logging
+import os
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from settings import MONTHS, TAXI_TYPES, YEARS, source_file_name
+
+logging.basicConfig(
+    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+    filename='synthetic.log'
+)
+logger = logging.getLogger(__name__)
+
+# Column prefix of the pickup/dropoff timestamps in each fleet's TLC files
+COLUMN_PREFIX = {'yellow': 'tpep', 'green': 'lpep'}
+
+# Trips per month relative to yellow; green cabs carry roughly a tenth as many
+FLEET_SCALE = {'yellow': 1.0, 'green': 0.1}
+
+# Share of pickups per hour of day, shaped like the real TLC profile
+HOUR_WEIGHTS = np.array([
+    3.0, 2.2, 1.6, 1.1, 0.8, 0.8, 1.6, 2.9, 3.8, 4.0, 4.1, 4.3,
+    4.5, 4.6, 4.9, 5.0, 5.1, 5.6, 6.3, 6.3, 5.8, 5.6, 5.1, 4.0,
+])
+
+# Passenger count distribution for 1-6 passengers
+PASSENGER_WEIGHTS = np.array([0.72, 0.14, 0.05, 0.03, 0.04, 0.02])
+
+# Kinds of dirty rows injected, in equal shares of the dirty fraction.
+# Each breaks exactly one cleaning rule (duplicates copy a clean row).
+DIRTY_KINDS = ['no_passengers', 'null_passengers', 'zero_distance', 'over_100_miles',
+               'over_one_day', 'out_of_range', 'duplicate']
+
+
+def month_seed(seed, taxi_type, year, month):
+    """
+    Seed for one file, so each file is reproducible on its own
+    """
+    digest = hashlib.sha256(f"{seed}:{taxi_type}:{year}:{month}".encode()).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+def generate_month(taxi_type, year, month, rows, seed=0, dirty_fraction=0.02):
+    """
+    Returns an Arrow table of `rows` NYC-like trips for one fleet and month,
+    with the real TLC column names and `dirty_fraction` of rows that break
+    one cleaning rule each
+    """
+    rng = np.random.default_rng(month_seed(seed, taxi_type, year, month))
+    year, month = int(year), int(month)
+    days = calendar.monthrange(year, month)[1]
+    start = np.datetime64(datetime(year, month, 1), 'us')
+
+    # Pickup: uniform day, hour from the daily profile, uniform within the hour
+    day = rng.integers(0, days, rows)
+    hour = rng.choice(24, rows, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+    within = rng.integers(0, 3600 * 10**6, rows)
+    pickup = start + (day * 86400 + hour * 3600).astype('timedelta64[s]') + within.astype('timedelta64[us]')
+
+    # Distance is log-normal (median ~1.8 miles), speed depends on the hour
+    distance = np.round(rng.lognormal(np.log(1.8), 0.9, rows), 2).clip(0.01, 60)
+    rush = np.isin(hour, [7, 8, 9, 16, 17, 18, 19])
+    mph = np.clip(rng.normal(np.where(rush, 9.0, 13.0), 3.0), 2.0, 45.0)
+    duration = (distance / mph * 3600 * 10**6).astype('int64') + rng.integers(30, 240, rows) * 10**6
+    dropoff = pickup + duration.astype('timedelta64[us]')
+
+    passengers = (rng.choice(6, rows, p=PASSENGER_WEIGHTS) + 1).astype('float64')
+    fare = np.round(3.0 + distance * 2.5 + duration / 10**6 / 60 * 0.5, 2)
+    tip = np.round(fare * rng.choice([0.0, 0.15, 0.2, 0.25], rows), 2)
+
+    # Inject dirty rows; duplicates are copies of clean rows appended at the end
+    dirty = int(rows * dirty_fraction)
+    chosen = rng.choice(rows, dirty, replace=False)
+    kinds = np.array(DIRTY_KINDS)[np.arange(dirty) % len(DIRTY_KINDS)]
+    valid = np.ones(rows, dtype=bool)
+    for kind in DIRTY_KINDS[:-1]:
+        idx = chosen[kinds == kind]
+        valid[idx] = False
+        if kind == 'no_passengers':
+            passengers[idx] = 0
+        elif kind == 'null_passengers':
+            passengers[idx] = np.nan
+        elif kind == 'zero_distance':
+            distance[idx] = 0
+        elif kind == 'over_100_miles':
+            distance[idx] = np.round(rng.uniform(100.5, 500, len(idx)), 2)
+        elif kind == 'over_one_day':
+            dropoff[idx] = pickup[idx] + np.timedelta64(2, 'D')
+        elif kind == 'out_of_range':
+            pickup[idx] = pickup[idx] - np.timedelta64(366 * (year - YEARS[0] + 1), 'D')
+            dropoff[idx] = pickup[idx] + np.timedelta64(15, 'm')
+    copies = rng.choice(np.flatnonzero(valid), min(int((kinds == 'duplicate').sum()), int(valid.sum())), replace=False)
+    order = np.concatenate([np.arange(rows), copies])
+
+    prefix = COLUMN_PREFIX.get(taxi_type)
+    pickup_name = f"{prefix}_pickup_datetime" if prefix else 'pickup_datetime'
+    dropoff_name = f"{prefix}_dropoff_datetime" if prefix else 'dropoff_datetime'
+    return pa.table({
+        'VendorID': pa.array(rng.choice([1, 2], rows)[order], pa.int32()),
+        pickup_name: pa.array(pickup[order], pa.timestamp('us')),
+        dropoff_name: pa.array(dropoff[order], pa.timestamp('us')),
+        'passenger_count': pa.array(passengers[order], pa.float64(), from_pandas=True),
+        'trip_distance': pa.array(distance[order], pa.float64()),
+        'RatecodeID': pa.array(np.ones(len(order)), pa.float64()),
+        'PULocationID': pa.array(rng.integers(1, 264, rows)[order], pa.int32()),
+        'DOLocationID': pa.array(rng.integers(1, 264, rows)[order], pa.int32()),
+        'payment_type': pa.array(rng.choice([1, 2], rows, p=[0.7, 0.3])[order], pa.int64()),
+        'fare_amount': pa.array(fare[order], pa.float64()),
+        'tip_amount': pa.array(tip[order], pa.float64()),
+        'total_amount': pa.array(np.round(fare + tip + 1.0, 2)[order], pa.float64()),
+    })
+
+
+def write_dataset(out_dir, years=None, months=None, taxi_types=None, rows=100_000,
+                  seed=0, dirty_fraction=0.02):
+    """
+    Writes one parquet file per fleet and month under `out_dir`, named like the
+    TLC files so load.py can use the directory as --source. `rows` is the yellow
+    trips per month; other fleets are scaled by FLEET_SCALE.
+    Returns the number of trips written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    total = 0
+    for year in (years or YEARS):
+        for month in (months or MONTHS):
+            for taxi_type in (taxi_types or TAXI_TYPES):
+                count = max(1, int(rows * FLEET_SCALE.get(taxi_type, 0.1)))
+                table = generate_month(taxi_type, year, month, count, seed, dirty_fraction)
+                pq.write_table(table, os.path.join(out_dir, source_file_name(taxi_type, year, month)),
+                               compression='snappy')
+                total += table.num_rows
+        logger.info(f"Wrote synthetic trips for {year}")
+    logger.info(f"Wrote {total:,} synthetic trips to {out_dir}")
+    return total
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate synthetic TLC trip files")
+    parser.add_argument('--out', default='synthetic_data', help="Output directory")
+    parser.add_argument('--years', type=int, nargs='+', default=YEARS, help="Years to generate")
+    parser.add_argument('--months', nargs='+', default=MONTHS, help="Months to generate, as 01-12")
+    parser.add_argument('--taxi-types', nargs='+', default=list(TAXI_TYPES), help="Fleets to generate")
+    parser.add_argument('--rows', type=int, default=100_000, help="Yellow trips per month")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed; same seed, same files")
+    parser.add_argument('--dirty-fraction', type=float, default=0.02,
+                        help="Share of rows breaking a cleaning rule or duplicating another row")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    months = [f"{int(m):02d}" for m in args.months]
+    total = write_dataset(args.out, args.years, months, args.taxi_types, args.rows,
+                          args.seed, args.dirty_fraction)
+    print(f"Wrote {total:,} synthetic trips to {args.out}")
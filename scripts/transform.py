@@ -1,4 +1,306 @@
-import duckdb
+import argparse
+import json
 import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from connection import connect, cpu_count, resource_settings, temp_directory
+from dbt_macros import DBT_DIR, dbt_macros
+from emissions_model import MODELS, SQL_MODELS, register
+from instrumentation import timed_stage
+from settings import DB_PATH, EMISSIONS_MODEL, TAXI_TYPES
+from storage import drop_relation, existing_partitions, partition_dir, relation_type, table_columns
 
 # Used DBT for transform
+
+logging.basicConfig(
+    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+    filename='transform.log'
+)
+logger = logging.getLogger(__name__)
+
+# Parallel mode writes transformed partitions here as
+# taxi_type=/year=/month=/data.parquet and exposes them as this relation
+TRANSFORMED_TABLE = 'trips_transformed'
+
+# Transform of one partition: the columns of dbt/models/trips_transformed.sql,
+# rendered from its macros (see dbt_macros.py), for the partition's trips.
+# Partition columns come from the directory names.
+TRANSFORM_SQL = """
+    SELECT
+    t.pickup_datetime, t.dropoff_datetime, t.passenger_count, t.distance,
+    {columns}
+    FROM trips t
+    JOIN fleets f ON f.taxi_type = t.taxi_type
+    JOIN vehicle_emissions ve ON ve.vehicle_type = f.vehicle_type
+    WHERE t.taxi_type = ? AND t.source_year = ? AND t.source_month = ?
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the dbt models")
+    parser.add_argument('--full-refresh', action='store_true',
+                        help="Rebuild the incremental models from scratch")
+    parser.add_argument('--select', default=None, help="dbt node selection, e.g. emissions_rollup")
+    parser.add_argument('--parallel', action='store_true',
+                        help="Transform partitions in worker processes to parquet instead of in dbt")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Worker processes in --parallel mode (default: one per CPU)")
+    parser.add_argument('--emissions-model', choices=list(MODELS), default=EMISSIONS_MODEL,
+                        help="trip_co2_kgs model; with dbt, --full-refresh after changing it")
+    return parser.parse_args()
+
+
+def dbt_env():
+    """
+    Environment for dbt: the database path and the DuckDB settings for the
+    transform stage, read by dbt/profiles.yml
+    """
+    config = resource_settings('transform')
+    return dict(
+        os.environ,
+        DBT_PROJECT_DIR=DBT_DIR,
+        EMISSIONS_DB=os.path.abspath(DB_PATH),
+        DUCKDB_MEMORY_LIMIT=config['memory_limit'],
+        DUCKDB_THREADS=str(config['threads']),
+        DUCKDB_TEMP_DIR=config['temp_directory'],
+        DUCKDB_MAX_TEMP_SIZE=config['max_temp_directory_size'],
+    )
+
+
+def run_dbt(full_refresh=False, select=None, exclude=None, model=EMISSIONS_MODEL):
+    env = dbt_env()
+    logger.info(
+        f"Running dbt with memory_limit={env['DUCKDB_MEMORY_LIMIT']}, threads={env['DUCKDB_THREADS']}, "
+        f"emissions model {model}"
+    )
+    command = ['dbt', 'run', '--project-dir', DBT_DIR, '--profiles-dir', DBT_DIR,
+               '--vars', json.dumps({'emissions_model': model})]
+    if model not in SQL_MODELS:
+        # Only models computed by a UDF need the plugin registering them
+        command += ['--target', 'udf']
+    if full_refresh:
+        command.append('--full-refresh')
+    if select:
+        command += ['--select', select]
+    if exclude:
+        command += ['--exclude', *exclude]
+    subprocess.run(command, env=env, check=True)
+    logger.info("dbt run finished")
+
+
+def transformed_file(taxi_type, year, month):
+    return os.path.join(partition_dir(taxi_type, year, month, table=TRANSFORMED_TABLE), 'data.parquet')
+
+
+# Spill directory of this worker process, set by init_worker
+_worker_temp_dir = None
+
+
+def init_worker(base):
+    """
+    Pool initializer: DuckDB's spill files are per process, so each worker
+    spills into its own directory under the shared `base`
+    """
+    global _worker_temp_dir
+    _worker_temp_dir = os.path.join(base, f"worker-{os.getpid()}")
+
+
+def transform_partition(partition, share, select_sql):
+    """
+    Worker: transforms one (taxi_type, year, month) partition of the cleaned
+    trips into its parquet file with `select_sql` (TRANSFORM_SQL rendered),
+    over a read-only connection of its own with the emissions model UDFs
+    registered on it. The file is written under a temporary name and renamed
+    into place. Returns the partition and its row count.
+    """
+    taxi_type, year, month = partition
+    con = connect('transform', read_only=True, share=share, temp_dir=_worker_temp_dir)
+    try:
+        register(con)
+        path = transformed_file(taxi_type, year, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{uuid.uuid4().hex}.partial"
+        con.execute(f"""
+            COPY ({select_sql}) TO '{partial}' (FORMAT parquet, COMPRESSION zstd);
+        """, [taxi_type, int(year), int(month)])
+        rows = con.rowcount
+        os.replace(partial, path)
+        return partition, rows
+    finally:
+        con.close()
+
+
+def pending_partitions(con, full_refresh=False, model=EMISSIONS_MODEL):
+    """
+    Returns the ledger partitions to transform, oldest first: those without a
+    transformed file, transformed before their last load/clean or with another
+    emissions model. Also returns the transformed partitions no longer in the ledger.
+    """
+    ledger = con.execute("""
+        SELECT taxi_type, year, month, greatest(loaded_at, coalesce(cleaned_at, loaded_at))
+        FROM load_ledger
+        ORDER BY year, month, taxi_type;
+    """).fetchall()
+    done = {}
+    if not full_refresh and relation_type(con, 'transform_partitions') == 'table':
+        # Partitions recorded before the model was tracked used the constant model
+        used = 'emissions_model' if 'emissions_model' in table_columns(con, 'transform_partitions') else 'NULL'
+        done = {
+            (taxi_type, year, month): (transformed_at, used_model)
+            for taxi_type, year, month, transformed_at, used_model in con.execute(f"""
+                SELECT taxi_type, year, month, transformed_at, coalesce({used}, 'constant')
+                FROM transform_partitions;
+            """).fetchall()
+        }
+    pending = [
+        row[:3] for row in ledger
+        if row[:3] not in done or done[row[:3]][0] < row[3] or done[row[:3]][1] != model
+        or not os.path.exists(transformed_file(*row[:3]))
+    ]
+    current = {row[:3] for row in ledger}
+    stale = [p for p in existing_partitions(table=TRANSFORMED_TABLE) if p not in current]
+    return pending, stale
+
+
+def register_transformed(con, macros):
+    """
+    Exposes the transformed parquet partitions as trips_transformed plus the
+    per-fleet *_tripdata_transformed views, with the dbt model's column order
+    and compact types
+    """
+    drop_relation(con, TRANSFORMED_TABLE)
+    files = os.path.join(partition_dir(table=TRANSFORMED_TABLE), '*', '*', '*', '*.parquet')
+    con.execute(f"""
+        CREATE VIEW {TRANSFORMED_TABLE} AS
+        SELECT taxi_type::taxi_type_enum AS taxi_type, pickup_datetime, dropoff_datetime,
+        passenger_count, distance, year AS source_year, month AS source_month,
+        trip_co2_kgs, avg_mph, hour_of_day,
+        day_of_week::{macros.day_of_week_enum()} AS day_of_week,
+        week_of_year,
+        month_of_year::{macros.month_of_year_enum()} AS month_of_year,
+        specified_year, transformed_at
+        FROM read_parquet('{files}', hive_partitioning = true,
+                          hive_types = {{'taxi_type': VARCHAR, 'year': SMALLINT, 'month': UTINYINT}});
+    """)
+    for taxi_type, config in TAXI_TYPES.items():
+        name = f"{config['table']}_transformed"
+        drop_relation(con, name)
+        con.execute(f"""
+            CREATE VIEW {name} AS
+            SELECT * EXCLUDE (taxi_type) FROM {TRANSFORMED_TABLE} WHERE taxi_type = '{taxi_type}';
+        """)
+
+
+def record_partitions(con, transformed, stale, full_refresh=False, model=EMISSIONS_MODEL):
+    """
+    Records the partitions transformed with emissions `model` and removes the stale ones
+    """
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS transform_partitions (
+            taxi_type VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            row_count BIGINT,
+            transformed_at TIMESTAMP,
+            PRIMARY KEY (taxi_type, year, month)
+        );
+    """)
+    con.execute("""
+        ALTER TABLE transform_partitions ADD COLUMN IF NOT EXISTS emissions_model VARCHAR;
+    """)
+    if full_refresh:
+        con.execute("DELETE FROM transform_partitions;")
+    for (taxi_type, year, month), rows in transformed:
+        con.execute("""
+            INSERT OR REPLACE INTO transform_partitions
+                (taxi_type, year, month, row_count, transformed_at, emissions_model)
+            VALUES (?, ?, ?, ?, current_timestamp, ?);
+        """, [taxi_type, int(year), int(month), rows, model])
+    for taxi_type, year, month in stale:
+        shutil.rmtree(partition_dir(taxi_type, year, month, table=TRANSFORMED_TABLE), ignore_errors=True)
+        con.execute("""
+            DELETE FROM transform_partitions WHERE taxi_type = ? AND year = ? AND month = ?;
+        """, [taxi_type, int(year), int(month)])
+
+
+@timed_stage('transform')
+def transform_parallel(workers=None, full_refresh=False, model=EMISSIONS_MODEL):
+    """
+    Transforms each changed (taxi_type, year, month) partition in a pool of
+    `workers` processes (default one per CPU), each with its own read-only
+    DuckDB connection and an equal share of memory, writing one parquet file
+    per partition with trip_co2_kgs from the emissions `model`. Then registers
+    trips_transformed and the per-fleet *_tripdata_transformed views over the
+    files and runs the downstream dbt models (rollup, sample, sketches) on them.
+    """
+    try:
+        workers = workers or cpu_count()
+        con = connect('transform', read_only=True)
+        pending, stale = pending_partitions(con, full_refresh, model)
+        con.close()
+        macros = dbt_macros(emissions_model=model)
+        select_sql = TRANSFORM_SQL.format(columns=macros.trip_transform_columns())
+        logger.info(f"Transforming {len(pending)} partitions with {workers} workers, removing {len(stale)}")
+
+        transformed, failed = [], []
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                                 initargs=(temp_directory(DB_PATH),)) as pool:
+            futures = {pool.submit(transform_partition, p, 1.0 / workers, select_sql): p for p in pending}
+            for future in as_completed(futures):
+                taxi_type, year, month = futures[future]
+                try:
+                    transformed.append(future.result())
+                    logger.info(f"Transformed {taxi_type} {year}-{month:02d}: {transformed[-1][1]} trips")
+                except Exception as e:
+                    failed.append(futures[future])
+                    logger.error(f"Transforming {taxi_type} {year}-{month:02d} failed: {e}")
+
+        # Finished partitions are recorded even if others failed, so a rerun only redoes the failures
+        con = connect('transform')
+        record_partitions(con, transformed, stale, full_refresh, model)
+        if existing_partitions(table=TRANSFORMED_TABLE):
+            register_transformed(con, macros)
+        con.close()
+        if failed:
+            raise RuntimeError(f"{len(failed)} partitions failed to transform, rerun to retry them")
+        print(f"Transformed {len(transformed)} partitions with {workers} workers")
+
+        # The transformed relations are ours; dbt only builds the models on top of them
+        exclude = [TRANSFORMED_TABLE] + [f"{c['table']}_transformed" for c in TAXI_TYPES.values()]
+        run_dbt(full_refresh, exclude=exclude, model=model)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+
+
+@timed_stage('transform')
+def run_models(full_refresh=False, select=None, model=EMISSIONS_MODEL):
+    """
+    Runs `dbt run` with DuckDB sized for this machine (see connection.py)
+    """
+    try:
+        # Leaving parallel mode: let dbt build trips_transformed as a table again
+        con = connect('transform')
+        if relation_type(con, TRANSFORMED_TABLE) == 'view':
+            drop_relation(con, TRANSFORMED_TABLE)
+            drop_relation(con, 'transform_partitions')
+        con.close()
+        run_dbt(full_refresh, select, model=model)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.parallel:
+        transform_parallel(args.workers, args.full_refresh, args.emissions_model)
+    else:
+        run_models(full_refresh=args.full_refresh, select=args.select, model=args.emissions_model)
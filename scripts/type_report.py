@@ -0,0 +1,140 @@
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from connection import connect
+from settings import DB_PATH
+
+# Configure logging to write to type_report.log with timestamp, level, and message
+logging.basicConfig(
+    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+    filename='type_report.log'
+)
+logger = logging.getLogger(__name__)
+
+# Column types used before the compact schema: whatever the parquet files
+# carried, BIGINT date parts and strftime strings for the calendar names
+WIDE_TYPES = {
+    'taxi_type': 'VARCHAR',
+    'passenger_count': 'BIGINT',
+    'distance': 'DOUBLE',
+    'source_year': 'INTEGER',
+    'source_month': 'INTEGER',
+    'trip_co2_kgs': 'DOUBLE',
+    'avg_mph': 'DOUBLE',
+    'hour_of_day': 'BIGINT',
+    'day_of_week': 'VARCHAR',
+    'week_of_year': 'BIGINT',
+    'month_of_year': 'VARCHAR',
+    'specified_year': 'BIGINT',
+}
+
+# Representative analysis queries, timed on both layouts
+QUERIES = {
+    'co2 by hour': "SELECT taxi_type, hour_of_day, SUM(trip_co2_kgs) FROM t GROUP BY ALL",
+    'co2 by day': "SELECT taxi_type, day_of_week, SUM(trip_co2_kgs) FROM t GROUP BY ALL",
+    'co2 by week': "SELECT taxi_type, week_of_year, SUM(trip_co2_kgs) FROM t GROUP BY ALL",
+    'co2 by month': "SELECT taxi_type, month_of_year, SUM(trip_co2_kgs) FROM t GROUP BY ALL",
+    'trip stats': "SELECT taxi_type, AVG(distance), AVG(passenger_count), MAX(trip_co2_kgs) FROM t GROUP BY ALL",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare storage size and query time of the compact and the old wide column types"
+    )
+    parser.add_argument('--table', default='trips_transformed',
+                        help="Relation to copy into both layouts")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs per query; the fastest is reported")
+    return parser.parse_args()
+
+
+def layouts(con, table):
+    """
+    Returns {layout: select_sql} for the compact (current) and wide (old) types
+    """
+    columns = [row[0] for row in con.execute(f"DESCRIBE {table};").fetchall()]
+    wide = ", ".join(
+        f"{c}::{WIDE_TYPES[c]} AS {c}" if c in WIDE_TYPES else c for c in columns
+    )
+    return {
+        'wide': f"SELECT {wide} FROM {table}",
+        'compact': f"SELECT * FROM {table}",
+    }
+
+
+def measure(con, name, select_sql, scratch, repeat):
+    """
+    Copies `select_sql` into its own database file, then returns the file size
+    and the best time of each query against it
+    """
+    path = os.path.join(scratch, f"{name}.duckdb")
+    con.execute(f"ATTACH '{path}' AS {name};")
+    con.execute(f"CREATE TABLE {name}.t AS {select_sql};")
+    con.execute(f"DETACH {name};")
+    size = os.path.getsize(path)
+
+    layout = connect('analysis', database=path, read_only=True)
+    timings = {}
+    for label, query in QUERIES.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            layout.execute(query).fetchall()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[label] = best
+    layout.close()
+    return size, timings
+
+
+def type_report(table='trips_transformed', repeat=3):
+    """
+    Before/after report for the compact column types: builds the table once
+    with the old wide types and once with the current ones, then prints file
+    size and query time side by side
+    """
+    con = None
+
+    try:
+        # In-memory connection with the emissions database attached read-only,
+        # so the scratch layouts can be attached writable next to it
+        con = connect('analysis', database=':memory:')
+        con.execute(f"ATTACH '{DB_PATH}' AS emissions (READ_ONLY);")
+        con.execute("USE emissions;")
+        logger.info("Connected to DuckDB instance")
+        rows = con.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+
+        results = {}
+        with tempfile.TemporaryDirectory() as scratch:
+            for name, select_sql in layouts(con, table).items():
+                results[name] = measure(con, name, select_sql, scratch, repeat)
+                logger.info(f"Measured {name} layout of {table}")
+
+        wide_size, wide_times = results['wide']
+        compact_size, compact_times = results['compact']
+        lines = [
+            f"{table}: {rows:,} rows",
+            f"{'':<16}{'wide':>12}{'compact':>12}{'ratio':>8}",
+            f"{'storage (MB)':<16}{wide_size / 1024**2:>12.1f}{compact_size / 1024**2:>12.1f}"
+            f"{compact_size / wide_size:>8.2f}",
+        ]
+        for label in QUERIES:
+            lines.append(
+                f"{label + ' (ms)':<16}{wide_times[label] * 1000:>12.1f}{compact_times[label] * 1000:>12.1f}"
+                f"{compact_times[label] / wide_times[label]:>8.2f}"
+            )
+        for line in lines:
+            print(line)
+            logger.info(line)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    args = parse_args()
+    type_report(table=args.table, repeat=args.repeat)
@@ -0,0 +1,95 @@
+import duckdb
+import numpy as np
+import pytest
+
+from emissions_model import MODELS, SQL_MODELS, co2_sql, register
+
+# (distance, minutes, co2_grams_per_mile, mpg_city, mpg_highway): speeds on
+# both sides of and between the city/highway cycle speeds, plus trips
+# without a usable speed and a fleet without mpg figures
+TRIPS = [
+    (1.0, 30, 404, 20, 28),
+    (5.0, 30, 404, 20, 28),
+    (10.6, 30, 404, 20, 28),
+    (17.5, 30, 404, 20, 28),
+    (24.15, 30, 404, 20, 28),
+    (40.0, 30, 300, 48, 40),
+    (3.0, 0, 404, 20, 28),
+    (0.0, 0, 404, 20, 28),
+    (2.0, -10, 404, 20, 28),
+    (2.0, None, 404, 20, 28),
+    (0.0, 12, 404, 20, 28),
+    (6.0, 15, 404, None, 28),
+]
+
+
+@pytest.fixture
+def con():
+    con = duckdb.connect()
+    con.execute("""
+        CREATE TABLE trips AS
+        SELECT 'fleet' || i AS taxi_type, distance::FLOAT AS distance,
+        TIMESTAMP '2024-01-01 08:00:00' AS pickup_datetime,
+        TIMESTAMP '2024-01-01 08:00:00' + to_minutes(minutes) AS dropoff_datetime,
+        co2_grams_per_mile, mpg_city, mpg_highway, i
+        FROM (VALUES %s) v(i, distance, minutes, co2_grams_per_mile, mpg_city, mpg_highway);
+    """ % ", ".join(
+        f"({i}, {d}, {'NULL' if m is None else m}, {g}, {'NULL' if c is None else c}, {h})"
+        for i, (d, m, g, c, h) in enumerate(TRIPS)
+    ))
+    con.execute("""
+        CREATE TABLE fleets AS SELECT taxi_type, taxi_type AS vehicle_type FROM trips;
+    """)
+    con.execute("""
+        CREATE TABLE vehicle_emissions AS
+        SELECT taxi_type AS vehicle_type, co2_grams_per_mile::BIGINT AS co2_grams_per_mile,
+        mpg_city::BIGINT AS mpg_city, mpg_highway::BIGINT AS mpg_highway
+        FROM trips;
+    """)
+    register(con)
+    yield con
+    con.close()
+
+
+def trip_co2_kgs(con, sql):
+    return np.array([
+        np.nan if value is None else value
+        for value, in con.execute(f"""
+            SELECT {sql}
+            FROM trips t
+            JOIN fleets f ON f.taxi_type = t.taxi_type
+            JOIN vehicle_emissions ve ON ve.vehicle_type = f.vehicle_type
+            ORDER BY t.i;
+        """).fetchall()
+    ], dtype=np.float64)
+
+
+def expected(model):
+    distance, minutes, co2, city, highway = (
+        np.array([np.nan if v is None else v for v in column], dtype=np.float64) for column in zip(*TRIPS)
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return MODELS[model](distance, co2, city, highway, distance / (minutes / 60.0)).astype(np.float32)
+
+
+@pytest.mark.parametrize('model', SQL_MODELS)
+def test_sql_macro_matches_model(con, model):
+    np.testing.assert_allclose(trip_co2_kgs(con, co2_sql(model)), expected(model), rtol=1e-6)
+
+
+@pytest.mark.parametrize('model', list(MODELS))
+def test_udf_matches_model(con, model):
+    np.testing.assert_allclose(trip_co2_kgs(con, co2_sql(model, udf=True)), expected(model), rtol=1e-6)
+
+
+def test_speed_model_scales_by_speed(con):
+    speed = trip_co2_kgs(con, co2_sql('speed'))
+    flat = trip_co2_kgs(con, co2_sql('constant'))
+    # Slow trips burn more than the combined rate, highway trips less
+    assert speed[0] > flat[0] and speed[4] < flat[4]
+    # City and highway speeds beyond the cycle speeds use the plain city/highway rates
+    assert speed[0] / flat[0] == pytest.approx(speed[1] / flat[1], rel=1e-6)
+    # Trips without a usable speed keep the flat rate
+    np.testing.assert_allclose(speed[6:11], flat[6:11], rtol=1e-6)
+    # No mpg figures, no estimate
+    assert np.isnan(speed[11])
@@ -0,0 +1,177 @@
+import http.server
+import json
+import os
+import re
+import threading
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from fetcher import CorruptParquet, FetchError, RangeFetcher, validate_parquet
+
+CHUNK = 4096
+
+
+class SourceServer(http.server.ThreadingHTTPServer):
+    """
+    Local HTTP server for one file with byte-range support. `fail` maps a GET
+    (range start, or None for a whole-file GET) or 'HEAD' to how many times to
+    answer it with HTTP 503; `truncate` serves the file's leading bytes as if whole.
+    """
+
+    def __init__(self, data):
+        super().__init__(('127.0.0.1', 0), RangeHandler)
+        self.data = data
+        self.fail = {}
+        self.gets = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/trips.parquet"
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, status, length):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', '"v1"')
+        self.send_header('Accept-Ranges', 'bytes')
+
+    def do_HEAD(self):
+        if self.server.fail.get('HEAD'):
+            self.server.fail['HEAD'] -= 1
+            self._headers(503, 0)
+            self.end_headers()
+            return
+        self._headers(200, len(self.server.data))
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.server.data
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        start = int(match.group(1)) if match else None
+        self.server.gets.append(start)
+        if self.server.fail.get(start):
+            self.server.fail[start] -= 1
+            self._headers(503, 0)
+            self.end_headers()
+            return
+        if match:
+            body = data[start:int(match.group(2)) + 1]
+            self._headers(206, len(body))
+            self.send_header('Content-Range', f"bytes {start}-{start + len(body) - 1}/{len(data)}")
+        else:
+            body = data
+            self._headers(200, len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def parquet_bytes(tmp_path):
+    table = pa.table({
+        'pickup_datetime': pa.array(range(20000), pa.int64()),
+        'distance': pa.array([i / 7 for i in range(20000)], pa.float64()),
+    })
+    path = tmp_path / 'source.parquet'
+    pq.write_table(table, path, row_group_size=2000, compression='none')
+    return path.read_bytes()
+
+
+@pytest.fixture
+def server(parquet_bytes):
+    server = SourceServer(parquet_bytes)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fetcher(retries=3):
+    return RangeFetcher(connections=2, chunk_bytes=CHUNK, retries=retries, backoff=0)
+
+
+def test_interrupted_download_resumes_missing_ranges(server, tmp_path):
+    path = str(tmp_path / 'trips.parquet')
+    chunks = list(range(0, len(server.data), CHUNK))
+    failed = chunks[len(chunks) // 2]
+    server.fail[failed] = 1
+
+    with pytest.raises(FetchError):
+        fetcher(retries=0).fetch(server.url, path)
+    assert not os.path.exists(path)
+    with open(path + '.part.json') as f:
+        done = json.load(f)['done']
+    assert done and failed not in done
+
+    server.gets.clear()
+    info = fetcher().fetch(server.url, path)
+    # Only the ranges the first attempt did not finish are requested again
+    assert sorted(server.gets) == [start for start in chunks if start not in done]
+    assert info['size'] == len(server.data)
+    with open(path, 'rb') as f:
+        assert f.read() == server.data
+    assert not os.path.exists(path + '.part') and not os.path.exists(path + '.part.json')
+
+
+def test_head_is_retried(server):
+    server.fail['HEAD'] = 2
+
+    info = fetcher().head(server.url)
+    assert info['size'] == len(server.data) and info['etag'] == '"v1"'
+
+
+def test_transient_error_is_retried(server, tmp_path):
+    path = str(tmp_path / 'trips.parquet')
+    server.fail[0] = 2
+
+    fetcher(retries=2).fetch(server.url, path)
+    assert server.gets.count(0) == 3
+    assert validate_parquet(path) == 20000
+
+
+def test_persistent_error_fails_after_retries(server, tmp_path):
+    path = str(tmp_path / 'trips.parquet')
+    server.fail[0] = 10
+
+    with pytest.raises(FetchError, match='503'):
+        fetcher(retries=2).fetch(server.url, path)
+    assert server.gets.count(0) == 3
+    assert not os.path.exists(path)
+
+
+def test_truncated_download_is_rejected(server, tmp_path):
+    path = str(tmp_path / 'trips.parquet')
+    server.data = server.data[:-100]
+
+    with pytest.raises(CorruptParquet):
+        fetcher(retries=1).fetch(server.url, path)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
+
+
+@pytest.mark.parametrize('cut', [1, 8, 100, 5000])
+def test_validate_parquet_rejects_truncated_file(parquet_bytes, tmp_path, cut):
+    path = tmp_path / 'truncated.parquet'
+    path.write_bytes(parquet_bytes[:-cut])
+
+    with pytest.raises(CorruptParquet):
+        validate_parquet(str(path))
+    with pytest.raises(CorruptParquet):
+        validate_parquet(str(path), expected_size=len(parquet_bytes))
+
+
+def test_validate_parquet_rejects_missing_data_section(parquet_bytes, tmp_path):
+    # Cut from the middle: the footer is intact but points past the data
+    path = tmp_path / 'gap.parquet'
+    path.write_bytes(parquet_bytes[:1000] + parquet_bytes[-2000:])
+
+    with pytest.raises(CorruptParquet, match='outside the data section|unreadable footer'):
+        validate_parquet(str(path))
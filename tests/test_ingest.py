@@ -0,0 +1,396 @@
+import collections
+import functools
+import http.server
+import logging
+import os
+import threading
+import time
+
+import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pytest
+
+import ingest
+import mirror
+from ingest import TokenBucket, ingest_multi_file, ingest_partitions
+from ledger import create_file_stats, create_ledger, read_ledger
+from mirror import ParquetMirror, TemporaryDownloads
+from rules import create_rejects_table
+from storage import create_trips
+
+MONTHS = [f"{month:02d}" for month in range(1, 7)]
+ROWS = 500
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    """
+    Six months of yellow and green files in the TLC layout, ROWS trips each,
+    with each vintage's own pickup/dropoff column names
+    """
+    monkeypatch.chdir(tmp_path)
+    base = tmp_path / 'source'
+    base.mkdir()
+    for taxi_type, prefix in [('yellow', 'tpep'), ('green', 'lpep')]:
+        for month in MONTHS:
+            pickup = pa.array(
+                [f"2024-{month}-01 00:{i % 60:02d}:00" for i in range(ROWS)]
+            ).cast(pa.timestamp('us'))
+            table = pa.table({
+                f"{prefix}_pickup_datetime": pickup,
+                f"{prefix}_dropoff_datetime": pc.add(pickup, pa.scalar(600_000_000, pa.duration('us'))),
+                'passenger_count': pa.array([1 + i % 4 for i in range(ROWS)], pa.int64()),
+                'trip_distance': pa.array([0.5 + i / 100 for i in range(ROWS)], pa.float64()),
+            })
+            pq.write_table(table, base / f"{taxi_type}_tripdata_2024-{month}.parquet")
+    return str(base)
+
+
+@pytest.fixture
+def con(tmp_path):
+    con = duckdb.connect(str(tmp_path / 'emissions.duckdb'))
+    create_ledger(con)
+    create_file_stats(con)
+    create_rejects_table(con)
+    create_trips(con, storage='table')
+    yield con
+    con.close()
+
+
+@pytest.fixture
+def parquet_con(tmp_path, source):
+    """
+    A database storing trips as parquet partitions under tmp_path/warehouse
+    """
+    con = duckdb.connect(str(tmp_path / 'parquet.duckdb'))
+    create_ledger(con)
+    create_file_stats(con)
+    create_rejects_table(con)
+    create_trips(con, storage='parquet')
+    yield con
+    con.close()
+
+
+def partitions():
+    return [(taxi_type, 2024, month) for month in MONTHS for taxi_type in ['yellow', 'green']]
+
+
+def rewrite(source, taxi_type, month, change):
+    """
+    Replaces one source file with `change(table)` of its contents
+    """
+    path = os.path.join(source, f"{taxi_type}_tripdata_2024-{month}.parquet")
+    pq.write_table(change(pq.read_table(path)), path)
+
+
+def replace_column(table, name, values, arrow_type):
+    return table.set_column(table.schema.get_field_index(name), name, pa.array(values, arrow_type))
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=5)
+    start = time.monotonic()
+    for _ in range(30):
+        bucket.acquire()
+    elapsed = time.monotonic() - start
+    # The first `capacity` tokens are a burst, the other 25 come at 50/s
+    assert 0.45 <= elapsed < 1.0
+
+
+def test_token_bucket_is_shared_between_threads():
+    bucket = TokenBucket(rate=100, capacity=1)
+    acquired = []
+
+    def worker():
+        for _ in range(10):
+            bucket.acquire()
+            acquired.append(time.monotonic())
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(acquired) == 40
+    assert time.monotonic() - start >= 0.38
+    # No window of 0.1s holds more than the 10 tokens it refills plus the burst
+    acquired.sort()
+    assert all(b - a >= 0.09 for a, b in zip(acquired, acquired[11:]))
+
+
+def test_token_bucket_without_rate_never_blocks():
+    bucket = TokenBucket(rate=0)
+    start = time.monotonic()
+    for _ in range(1000):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.1
+
+
+def test_ingest_caps_concurrent_fetches_and_buffered_files(source, con, monkeypatch):
+    workers = 2
+    fetch = ingest.fetch_partition
+    lock = threading.Lock()
+    state = {'running': 0, 'max_running': 0, 'started': 0, 'written': 0, 'max_buffered': 0}
+
+    def slow_fetch(*args, **kwargs):
+        with lock:
+            state['running'] += 1
+            state['started'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+            state['max_buffered'] = max(state['max_buffered'], state['started'] - state['written'])
+        try:
+            time.sleep(0.02)
+            return fetch(*args, **kwargs)
+        finally:
+            with lock:
+                state['running'] -= 1
+
+    def write(con, taxi_type, year, month, fetched):
+        # A slow writer lets fetched files pile up if nothing bounds them
+        time.sleep(0.05)
+        with lock:
+            state['written'] += 1
+
+    monkeypatch.setattr(ingest, 'fetch_partition', slow_fetch)
+    loaded, skipped, failed = ingest_partitions(con, partitions(), base=source, workers=workers, write=write)
+
+    assert len(loaded) == len(partitions()) and not skipped and not failed
+    assert state['max_running'] == workers
+    assert state['max_buffered'] <= 2 * workers
+
+
+@pytest.fixture
+def http_source(source):
+    """
+    The source files served over HTTP by a local static file server
+    """
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=source)
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_ingest_rate_limits_remote_fetches(http_source, con, tmp_path):
+    downloads = TemporaryDownloads(base=http_source, root=str(tmp_path))
+    start = time.monotonic()
+    try:
+        loaded, _, failed = ingest_partitions(
+            con, partitions(), base=http_source, workers=4, rate=20, mirror=downloads
+        )
+    finally:
+        downloads.cleanup()
+
+    assert len(loaded) == 12 and not failed
+    # A burst of `workers` requests, then the remaining 8 at 20 per second
+    assert time.monotonic() - start >= 0.38
+
+
+def test_multi_file_checks_download_space_first(http_source, con, tmp_path, monkeypatch):
+    usage = collections.namedtuple('usage', 'total used free')
+    monkeypatch.setattr(mirror.shutil, 'disk_usage', lambda path: usage(10**6, 10**6 - 1000, 1000))
+    downloads = TemporaryDownloads(base=http_source, root=str(tmp_path))
+    try:
+        with pytest.raises(OSError, match="GB free"):
+            ingest_multi_file(con, partitions(), base=http_source, workers=4, mirror=downloads)
+        # Refused before any file was downloaded
+        assert not os.listdir(downloads.root)
+    finally:
+        downloads.cleanup()
+
+
+def test_multi_file_keeps_mirrored_files_until_released(source, http_source, con, tmp_path):
+    # A cap with room for about two of the twelve files
+    size = os.path.getsize(os.path.join(source, 'yellow_tripdata_2024-01.parquet'))
+    store = ParquetMirror(str(tmp_path / 'mirror'), base=http_source, max_bytes=2 * size + size // 2)
+
+    loaded, skipped, failed = ingest_multi_file(con, partitions(), base=http_source, workers=4, mirror=store)
+
+    assert len(loaded) == 12 and not skipped and not failed
+    assert con.execute("SELECT COUNT(*) FROM trips;").fetchone()[0] == 12 * ROWS
+    assert store.total_bytes() > store.max_bytes
+    store.release()
+    assert 0 < store.total_bytes() <= store.max_bytes
+    assert len(list((tmp_path / 'mirror' / 'objects').glob('*/*.parquet'))) == len(store.manifest)
+
+
+def test_ingest_does_not_rate_limit_local_files(source, con):
+    start = time.monotonic()
+    loaded, _, _ = ingest_partitions(con, partitions(), base=source, workers=4, rate=1)
+
+    assert len(loaded) == 12
+    # At 1 request per second the 8 files after the burst would take 8s
+    assert time.monotonic() - start < 4
+
+
+def test_ingest_writes_from_one_thread(source, con, monkeypatch):
+    writers = set()
+    replace = ingest.replace_partition
+
+    def write(con, taxi_type, year, month, fetched):
+        writers.add(threading.get_ident())
+        replace(con, taxi_type, year, month, fetched)
+
+    loaded, skipped, failed = ingest_partitions(con, partitions(), base=source, workers=4, write=write)
+
+    assert writers == {threading.get_ident()}
+    assert len(loaded) == 12 and not skipped and not failed
+    assert con.execute("SELECT COUNT(*) FROM trips;").fetchone()[0] == 12 * ROWS
+    assert con.execute("""
+        SELECT COUNT(*), SUM(row_count) FROM load_ledger;
+    """).fetchone() == (12, 12 * ROWS)
+    assert con.execute("""
+        SELECT taxi_type::VARCHAR, source_month, COUNT(*) FROM trips GROUP BY ALL ORDER BY ALL;
+    """).fetchall() == [(t, m, ROWS) for t in ['green', 'yellow'] for m in range(1, 7)]
+
+
+def test_ingest_skips_unchanged_partitions(source, con):
+    ingest_partitions(con, partitions(), base=source, workers=4)
+    loaded, skipped, failed = ingest_partitions(
+        con, partitions(), base=source, workers=4, ledger=read_ledger(con)
+    )
+    assert not loaded and len(skipped) == 12 and not failed
+    assert con.execute("SELECT COUNT(*) FROM trips;").fetchone()[0] == 12 * ROWS
+
+
+def test_multi_file_rollback_leaves_parquet_partitions(source, parquet_con, tmp_path, monkeypatch):
+    ingest_multi_file(parquet_con, partitions(), base=source, workers=4)
+    files = sorted((tmp_path / 'warehouse').rglob('*.parquet'))
+    for month in MONTHS:
+        rewrite(source, 'yellow', month, lambda table: table.slice(0, ROWS // 2))
+
+    # The yellow group is staged, then the green group fails before COMMIT
+    record = ingest.record_partition
+
+    def fail_green(con, taxi_type, *args, **kwargs):
+        if taxi_type == 'green':
+            raise RuntimeError("disk full")
+        record(con, taxi_type, *args, **kwargs)
+
+    monkeypatch.setattr(ingest, 'record_partition', fail_green)
+    with pytest.raises(RuntimeError):
+        ingest_multi_file(parquet_con, partitions(), base=source, workers=4)
+
+    assert sorted((tmp_path / 'warehouse').rglob('*.parquet')) == files
+    assert not list((tmp_path / 'warehouse' / '.staging').iterdir())
+    assert parquet_con.execute("SELECT COUNT(*) FROM trips;").fetchone()[0] == 12 * ROWS
+
+
+def old_vintage(table):
+    # Early yellow files: other column names and passenger counts stored as doubles
+    return pa.table({
+        'Trip_Pickup_DateTime': table['tpep_pickup_datetime'],
+        'Trip_Dropoff_DateTime': table['tpep_dropoff_datetime'],
+        'passenger_count': table['passenger_count'].cast(pa.float64()),
+        'Trip_Distance': table['trip_distance'],
+    })
+
+
+def test_multi_file_groups_by_source_columns_and_casts_types(source, con, caplog):
+    for month in ['01', '02', '03']:
+        rewrite(source, 'yellow', month, old_vintage)
+    # Same column names as the other new files, but a double passenger count
+    # that does not fit the canonical UTINYINT in its first row
+    rewrite(source, 'yellow', '04', lambda table: replace_column(
+        table, 'passenger_count', [300.0] + table['passenger_count'].to_pylist()[1:], pa.float64()
+    ))
+    caplog.set_level(logging.INFO, logger='ingest')
+
+    loaded, skipped, failed = ingest_multi_file(con, partitions(), base=source, workers=4)
+
+    assert len(loaded) == 12 and not skipped and not failed
+    assert sorted(r.getMessage() for r in caplog.records if r.getMessage().startswith('Added')) == [
+        'Added 3 yellow trip files in one scan',
+        'Added 3 yellow trip files in one scan',
+        'Added 6 green trip files in one scan',
+    ]
+    assert con.execute("SELECT DISTINCT typeof(passenger_count) FROM trips;").fetchall() == [('UTINYINT',)]
+    passengers = sum(1 + i % 4 for i in range(ROWS))
+    assert con.execute("""
+        SELECT taxi_type::VARCHAR, source_month, COUNT(*), COUNT(passenger_count), SUM(passenger_count)
+        FROM trips GROUP BY ALL ORDER BY ALL;
+    """).fetchall() == [
+        (t, m, ROWS, ROWS - 1, passengers - 1) if (t, m) == ('yellow', 4) else (t, m, ROWS, ROWS, passengers)
+        for t in ['green', 'yellow'] for m in range(1, 7)
+    ]
+
+
+def test_multi_file_replaces_groups_in_one_transaction(source, con, monkeypatch):
+    ingest_multi_file(con, partitions(), base=source, workers=4)
+    ledger = read_ledger(con)
+    for month in MONTHS:
+        rewrite(source, 'yellow', month, lambda table: table.slice(0, ROWS // 2))
+
+    record = ingest.record_partition
+
+    def fail_green(con, taxi_type, *args, **kwargs):
+        if taxi_type == 'green':
+            raise RuntimeError("disk full")
+        record(con, taxi_type, *args, **kwargs)
+
+    monkeypatch.setattr(ingest, 'record_partition', fail_green)
+    with pytest.raises(RuntimeError):
+        ingest_multi_file(con, partitions(), base=source, workers=4)
+    # The yellow group was already written when green failed, and rolled back with it
+    assert con.execute("SELECT COUNT(*) FROM trips;").fetchone()[0] == 12 * ROWS
+    assert read_ledger(con) == ledger
+
+    monkeypatch.setattr(ingest, 'record_partition', record)
+    ingest_multi_file(con, partitions(), base=source, workers=4)
+    assert con.execute("""
+        SELECT taxi_type::VARCHAR, COUNT(*) FROM trips GROUP BY ALL ORDER BY ALL;
+    """).fetchall() == [('green', 6 * ROWS), ('yellow', 6 * (ROWS // 2))]
+
+
+def test_multi_file_skips_unchanged_partitions(source, con):
+    ingest_multi_file(con, partitions(), base=source, workers=4)
+    rewrite(source, 'yellow', '03', lambda table: table.slice(0, ROWS // 2))
+
+    loaded, skipped, failed = ingest_multi_file(
+        con, partitions(), base=source, workers=4, ledger=read_ledger(con)
+    )
+
+    assert loaded == [('yellow', 2024, '03')] and len(skipped) == 11 and not failed
+    assert con.execute("SELECT COUNT(*) FROM trips;").fetchone()[0] == 12 * ROWS - ROWS // 2
+    assert con.execute("""
+        SELECT source_rows, loaded_rows FROM load_file_stats
+        WHERE taxi_type = 'yellow' AND year = 2024 AND month = 3;
+    """).fetchone() == (ROWS // 2, ROWS // 2)
+
+
+def test_multi_file_clean_on_load_counts_rejects(source, con):
+    def junk(table):
+        passengers = table['passenger_count'].to_pylist()
+        distance = table['trip_distance'].to_pylist()
+        passengers[:10] = [0] * 10
+        distance[10:15] = [0.0] * 5
+        distance[15:17] = [150.0] * 2
+        table = replace_column(table, 'passenger_count', passengers, pa.int64())
+        return replace_column(table, 'trip_distance', distance, pa.float64())
+
+    rewrite(source, 'green', '01', junk)
+
+    loaded, _, failed = ingest_multi_file(con, partitions(), base=source, workers=4, clean=True)
+
+    assert len(loaded) == 12 and not failed
+    assert con.execute("""
+        SELECT taxi_type, year, month, rule, rejected_rows FROM load_rejects ORDER BY rule;
+    """).fetchall() == [
+        ('green', 2024, 1, 'no_passengers', 10),
+        ('green', 2024, 1, 'over_100_miles', 2),
+        ('green', 2024, 1, 'zero_distance', 5),
+    ]
+    assert con.execute("""
+        SELECT COUNT(*) FROM trips WHERE taxi_type = 'green' AND source_month = 1;
+    """).fetchone()[0] == ROWS - 17
+    assert con.execute("""
+        SELECT source_rows, loaded_rows FROM load_file_stats
+        WHERE taxi_type = 'green' AND year = 2024 AND month = 1;
+    """).fetchone() == (ROWS, ROWS - 17)
+    assert con.execute("SELECT bool_and(filtered) FROM load_ledger;").fetchone()[0]